@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Any
+
+from telethon import Button
+
+from benchmarks.synthetic import generate_todo_text, WORDS
+from todo_list_bot.bot import ViewerStore
+from todo_list_bot.directory_index import DirectoryListing
+from todo_list_bot.operations import AppendLines
+from todo_list_bot.persistence import ViewerPersistence
+from todo_list_bot.response import Response
+from todo_list_bot.todo_list import TodoList, TodoContainer
+from todo_list_bot.todo_viewer import TodoViewer
+
+APPEND_LINES = [
+    "Shopping",
+    "- milk",
+    "-- semi skimmed",
+    "- eggs",
+    "## Later",
+    "- taxes",
+]
+
+
+def measure(func: Callable[[Any], None], setup: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeat):
+        # Setup is run outside the timed region, so benchmarks which mutate or memoise get a fresh target each run
+        target = setup()
+        start = time.perf_counter()
+        func(target)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "median_ms": round(statistics.median(timings), 4),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 4),
+        "min_ms": round(timings[0], 4),
+        "runs": repeat
+    }
+
+
+def deepest_path(todo: TodoList) -> List[str]:
+    deepest: TodoContainer = todo.root_section
+    for node in todo.root_section.walk():
+        if len(node.path) > len(deepest.path):
+            deepest = node
+    return deepest.path
+
+
+def widest_node(todo: TodoList) -> TodoContainer:
+    return max(todo.root_section.walk(), key=lambda node: sum(1 for _ in node.children()))
+
+
+def parsed(path: str) -> TodoList:
+    todo = TodoList(path)
+    todo.parse()
+    return todo
+
+
+def viewer_for(chat_id: int, todo: TodoList, path: List[str]) -> TodoViewer:
+    viewer = TodoViewer(chat_id)
+    viewer.current_todo = todo
+    viewer.current_todo_path = path
+    return viewer
+
+
+def run_benchmarks(args: argparse.Namespace, directory: str) -> Dict[str, Dict[str, float]]:
+    text = generate_todo_text(
+        args.items,
+        depth=args.depth,
+        fan_out=args.fan_out,
+        section_depth=args.section_depth,
+        done_ratio=args.done_ratio,
+        inp_ratio=args.inp_ratio
+    )
+    lines = text.split("\n")
+    path = os.path.join(directory, "todo.md")
+    with open(path, "w") as f:
+        f.write(text)
+    todo = parsed(path)
+    node_path = deepest_path(todo)
+    widest = widest_node(todo)
+    small_text = generate_todo_text(50).split("\n")
+    store = ViewerStore(directory)
+    for chat_id in range(args.viewers):
+        viewer = viewer_for(chat_id, todo, node_path)
+        viewer._file_list = [f"list-{n}.md" for n in range(20)]
+        store.add_viewer(viewer)
+        store.menus.add(chat_id, 1, Response("cached", [Button.inline("item", "item:0")] * 10))
+    persistence = ViewerPersistence(store, os.path.join(directory, "viewer_store"), 0)
+    os.makedirs(persistence.directory)
+    buttons = [Button.inline(node.name, f"item:{node.node_id}") for node in widest.children()]
+    folder = os.path.join(directory, "folder")
+    os.makedirs(folder)
+    for n in range(args.files):
+        with open(os.path.join(folder, f"{WORDS[n % len(WORDS)]}-{n}.md"), "w"):
+            pass
+    listing = DirectoryListing.scan(folder)
+    # The letter index is built once per listing, so build it outside the timed runs
+    _ = listing.initials
+
+    def small_todo() -> TodoList:
+        small = TodoList(path)
+        small.parse_lines(small_text)
+        return small
+
+    def uncached_viewer() -> TodoViewer:
+        # No node ID forces the by-name resolution used after a restart
+        return viewer_for(0, todo, node_path)
+
+    def dirty_persistence() -> ViewerPersistence:
+        for dirty_chat in range(args.viewers):
+            persistence.mark_dirty(dirty_chat)
+        return persistence
+
+    def paged_response() -> Response:
+        response = Response("", buttons)
+        response.page = (response.pages + 1) // 2
+        return response
+
+    repeat = args.repeat
+    return {
+        "parse": measure(lambda target: target.parse(), lambda: TodoList(path), repeat),
+        "parse_lines": measure(lambda target: target.parse_lines(lines), lambda: TodoList(path), repeat),
+        "to_text": measure(lambda target: target.to_text(target.root_section), lambda: parsed(path), repeat),
+        "to_text_cached": measure(lambda target: target.to_text(target.root_section), lambda: todo, repeat),
+        "current_section": measure(lambda target: target.current_section(), uncached_viewer, repeat),
+        "append_normalisation": measure(
+            lambda target: AppendLines([], APPEND_LINES).append_to(target, target.root_section),
+            small_todo,
+            repeat
+        ),
+        "response_buttons": measure(lambda target: target.buttons(), paged_response, repeat),
+        "listing_page": measure(
+            lambda target: target.render_listing(None, listing, False, args.files // 12 + 1).buttons(),
+            lambda: TodoViewer(0),
+            repeat
+        ),
+        "viewer_chat_to_json": measure(lambda target: target.chat_to_json(0), lambda: store, repeat),
+        "viewer_persistence_flush": measure(lambda target: asyncio.run(target.flush()), dirty_persistence, repeat),
+    }
+
+
+def check_results(
+        results: Dict[str, Dict[str, float]],
+        thresholds: Optional[Dict[str, float]],
+        baseline: Optional[Dict[str, Dict[str, float]]],
+        tolerance: float,
+        slack_ms: float
+) -> List[str]:
+    failures = []
+    for name, result in results.items():
+        if thresholds is not None and name in thresholds and result["median_ms"] > thresholds[name]:
+            failures.append(f"{name}: median {result['median_ms']}ms exceeds threshold {thresholds[name]}ms")
+        if baseline is not None and name in baseline:
+            # Sub-millisecond benchmarks jitter by more than the tolerance, so small absolute changes are allowed
+            limit = max(baseline[name]["median_ms"] * tolerance, baseline[name]["median_ms"] + slack_ms)
+            if result["median_ms"] > limit:
+                failures.append(
+                    f"{name}: median {result['median_ms']}ms is over {tolerance}x baseline {baseline[name]['median_ms']}ms"
+                )
+    return failures
+
+
+def load_json(filename: Optional[str]) -> Optional[Dict]:
+    if filename is None:
+        return None
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time the parse, render and edit hot paths on a synthetic todo list")
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fan-out", type=int, default=5)
+    parser.add_argument("--section-depth", type=int, default=2)
+    parser.add_argument("--done-ratio", type=float, default=0.3)
+    parser.add_argument("--inp-ratio", type=float, default=0.1)
+    parser.add_argument("--viewers", type=int, default=100, help="Number of chats saved by the persistence benchmark")
+    parser.add_argument("--files", type=int, default=5000, help="Number of files in the folder listed")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", help="File to write the results to, as JSON")
+    parser.add_argument("--thresholds", help="JSON file of maximum median milliseconds per benchmark")
+    parser.add_argument("--baseline", help="Results file from a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="Allowed slowdown relative to the baseline")
+    parser.add_argument("--slack-ms", type=float, default=0.05, help="Allowed slowdown in milliseconds on any benchmark")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        results = run_benchmarks(args, directory)
+    output = {
+        "config": {key: value for key, value in vars(args).items() if key not in ["output", "thresholds", "baseline"]},
+        "results": results
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+    baseline = load_json(args.baseline)
+    failures = check_results(
+        results,
+        load_json(args.thresholds),
+        baseline["results"] if baseline is not None else None,
+        args.tolerance,
+        args.slack_ms
+    )
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Any
+
+from telethon.events import NewMessage, CallbackQuery, StopPropagation
+from telethon.tl.types import KeyboardButtonCallback
+
+from benchmarks.synthetic import generate_todo_text, WORDS
+from todo_list_bot.bot import TodoListBot, BotConfig, callback_command
+
+Buttons = Optional[List[List[KeyboardButtonCallback]]]
+
+logger = logging.getLogger(__name__)
+
+
+class SentMessage:
+
+    def __init__(self, message_id: int, chat_id: int, method: str, text: str, buttons: Buttons):
+        self.id = message_id
+        self.chat_id = chat_id
+        self.method = method
+        self.text = text
+        self.buttons = buttons
+
+
+class FakeClient:
+    # Stands in for TelegramClient, running handlers in registration order as telethon does, and recording replies
+
+    def __init__(self, api_latency: float = 0) -> None:
+        self.api_latency = api_latency
+        self.handlers: List[Tuple[Callable, Any]] = []
+        self.sent: Dict[int, SentMessage] = {}
+        self.sent_count = 0
+        self.errors = 0
+
+    def add_event_handler(self, callback: Callable, event_builder: Any) -> None:
+        self.handlers.append((callback, event_builder))
+
+    async def send(self, chat_id: int, method: str, text: str, buttons: Buttons, message_id: int = None) -> SentMessage:
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        self.sent_count += 1
+        message = SentMessage(message_id or self.sent_count, chat_id, method, text, buttons)
+        self.sent[chat_id] = message
+        return message
+
+    def handles(self, event: 'FakeEvent', event_builder: Any) -> bool:
+        if isinstance(event, FakeCallbackEvent):
+            return isinstance(event_builder, CallbackQuery)
+        if not isinstance(event_builder, NewMessage):
+            return False
+        pattern = getattr(event_builder, "pattern", None)
+        return pattern is None or bool(pattern(event.message.message))
+
+    async def dispatch(self, event: 'FakeEvent') -> None:
+        for callback, event_builder in self.handlers:
+            if not self.handles(event, event_builder):
+                continue
+            try:
+                await callback(event)
+            except StopPropagation:
+                return
+            except Exception:
+                # Telethon logs handler errors and carries on, so the harness does too
+                logger.exception("Error handling %s in chat %s", type(event).__name__, event.chat_id)
+                self.errors += 1
+                return
+
+
+class FakeEvent:
+
+    def __init__(self, client: FakeClient, chat_id: int):
+        self.client = client
+        self.chat_id = chat_id
+
+
+class FakeText:
+
+    def __init__(self, message: str):
+        self.message = message
+
+
+class FakeMessageEvent(FakeEvent):
+
+    def __init__(self, client: FakeClient, chat_id: int, text: str):
+        super().__init__(client, chat_id)
+        self.message = FakeText(text)
+
+    async def respond(self, text: str, parse_mode: str = None, buttons: Buttons = None) -> SentMessage:
+        return await self.client.send(self.chat_id, "respond", text, buttons)
+
+    async def reply(self, text: str, parse_mode: str = None, buttons: Buttons = None) -> SentMessage:
+        return await self.client.send(self.chat_id, "reply", text, buttons)
+
+
+class FakeCallbackEvent(FakeEvent):
+
+    def __init__(self, client: FakeClient, chat_id: int, message_id: int, data: bytes):
+        super().__init__(client, chat_id)
+        self.message_id = message_id
+        self.data = data
+
+    async def edit(self, text: str, parse_mode: str = None, buttons: Buttons = None) -> SentMessage:
+        return await self.client.send(self.chat_id, "edit", text, buttons, self.message_id)
+
+    async def answer(self, *args, **kwargs) -> None:
+        pass
+
+
+class SimulatedChat:
+
+    def __init__(self, bot: TodoListBot, client: FakeClient, chat_id: int, args: argparse.Namespace):
+        self.bot = bot
+        self.client = client
+        self.chat_id = chat_id
+        self.args = args
+        self.rand = random.Random(chat_id)
+        self.latencies: Dict[str, List[float]] = {}
+
+    def next_event(self) -> Tuple[str, FakeEvent]:
+        last = self.client.sent.get(self.chat_id)
+        if last is None:
+            return "start", FakeMessageEvent(self.client, self.chat_id, "/start")
+        viewer = self.bot.viewer_store.get_viewer(self.chat_id)
+        if viewer.current_todo_file is not None and self.rand.random() < self.args.edit_ratio:
+            text = f"- {self.rand.choice(WORDS)} {self.rand.choice(WORDS)}"
+            return "text", FakeMessageEvent(self.client, self.chat_id, text)
+        buttons = [
+            button for row in (last.buttons or []) for button in row
+            if button.data.split(b":", 1)[0].decode() not in self.args.skip
+        ]
+        if not buttons:
+            return "start", FakeMessageEvent(self.client, self.chat_id, "/start")
+        data = self.rand.choice(buttons).data
+        return callback_command(data), FakeCallbackEvent(self.client, self.chat_id, last.id, data)
+
+    async def run(self) -> None:
+        for _ in range(self.args.actions):
+            kind, event = self.next_event()
+            start = time.perf_counter()
+            await self.client.dispatch(event)
+            # Handlers run on the bot's dispatcher and edits are sent by its outbox, so wait for both to finish
+            await self.bot.dispatcher.join(self.chat_id)
+            await self.bot.outbox.join(self.chat_id)
+            self.latencies.setdefault(kind, []).append((time.perf_counter() - start) * 1000)
+            if self.args.think_time:
+                await asyncio.sleep(self.rand.uniform(0, self.args.think_time))
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    latencies = sorted(latencies)
+
+    def percentile(fraction: float) -> float:
+        return round(latencies[int(fraction * (len(latencies) - 1))], 3)
+
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(0.5),
+        "p90_ms": percentile(0.9),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(latencies[-1], 3)
+    }
+
+
+def create_lists(args: argparse.Namespace, storage_dir: str) -> None:
+    os.makedirs(storage_dir)
+    for n in range(args.lists):
+        with open(os.path.join(storage_dir, f"list-{n}.md"), "w") as f:
+            f.write(generate_todo_text(args.items, seed=n))
+
+
+async def run_load(args: argparse.Namespace) -> Dict:
+    client = FakeClient(args.api_latency_ms / 1000)
+    config = BotConfig(
+        0,
+        "",
+        "",
+        "store/",
+        list(range(args.chats)),
+        viewer_store_dir="viewer_store/",
+        io_threads=args.io_threads,
+        save_delay=args.save_delay,
+        max_concurrent_chats=args.max_concurrent_chats,
+        edit_rate_per_chat=args.edit_rate_per_chat,
+        edit_rate_global=args.edit_rate_global
+    )
+    bot = TodoListBot(config, client)
+    bot.add_handlers()
+    persistence_task = asyncio.create_task(bot.persistence.run())
+    chats = [SimulatedChat(bot, client, chat_id, args) for chat_id in range(args.chats)]
+    start = time.perf_counter()
+    await asyncio.gather(*[chat.run() for chat in chats])
+    duration = time.perf_counter() - start
+    persistence_task.cancel()
+    await bot.persistence.flush()
+    by_kind: Dict[str, List[float]] = {}
+    for chat in chats:
+        for kind, latencies in chat.latencies.items():
+            by_kind.setdefault(kind, []).extend(latencies)
+    all_latencies = [latency for latencies in by_kind.values() for latency in latencies]
+    return {
+        "events": len(all_latencies),
+        "api_calls": client.sent_count,
+        "api_calls_per_event": round(client.sent_count / len(all_latencies), 3),
+        "errors": client.errors + bot.dispatcher.failures,
+        "duration_s": round(duration, 3),
+        "throughput_per_s": round(len(all_latencies) / duration, 1),
+        "latency": percentiles(all_latencies),
+        "latency_by_command": {kind: percentiles(latencies) for kind, latencies in sorted(by_kind.items())}
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Drive the bot's handlers from many simulated chats, without Telegram")
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--actions", type=int, default=20, help="Number of messages or button presses per chat")
+    parser.add_argument("--lists", type=int, default=10, help="Number of todo lists shared between the chats")
+    parser.add_argument("--items", type=int, default=500, help="Number of items in each todo list")
+    parser.add_argument("--edit-ratio", type=float, default=0.2, help="Chance of sending text instead of a button")
+    parser.add_argument("--skip", nargs="*", default=["delete"], help="Button commands the simulated chats won't press")
+    parser.add_argument("--think-time", type=float, default=0, help="Maximum seconds each chat waits between actions")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="Simulated delay on each Telegram API call")
+    parser.add_argument("--save-delay", type=float, default=1.0)
+    parser.add_argument("--io-threads", type=int, default=4)
+    parser.add_argument("--max-concurrent-chats", type=int, default=16)
+    parser.add_argument("--edit-rate-per-chat", type=float, default=0, help="Messages per second per chat, 0 for no limit")
+    parser.add_argument("--edit-rate-global", type=float, default=0, help="Messages per second overall, 0 for no limit")
+    parser.add_argument("--output", help="File to write the results to, as JSON")
+    args = parser.parse_args()
+    output_path = os.path.abspath(args.output) if args.output else None
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # Viewers browse "store/" relative to the working directory
+        os.chdir(directory)
+        try:
+            create_lists(args, "store/")
+            results = asyncio.run(run_load(args))
+        finally:
+            os.chdir(working_dir)
+    output = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results
+    }
+    text = json.dumps(output, indent=2)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(text)
+    print(text)
+    if results["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import argparse
+import gc
+import json
+import os
+import tempfile
+import tracemalloc
+
+from benchmarks.synthetic import generate_todo_text
+from todo_list_bot.todo_list import TodoList
+
+
+def measure_tree_bytes(item_count: int) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "todo.md")
+        with open(path, "w") as f:
+            f.write(generate_todo_text(item_count))
+        gc.collect()
+        tracemalloc.start()
+        todo = TodoList(path)
+        todo.parse()
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        nodes = sum(1 for _ in todo.root_section.walk())
+    return size / nodes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure memory used per parsed todo list node")
+    parser.add_argument("--items", type=int, nargs="+", default=[1000, 10000, 50000])
+    args = parser.parse_args()
+    results = {str(items): round(measure_tree_bytes(items), 1) for items in args.items}
+    print(json.dumps({"bytes_per_node": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import random
+from typing import List, Optional
+
+STATUS_PREFIXES = ["", "DONE", "INP"]
+
+
+def generate_todo_text(
+        items: int,
+        depth: int = 3,
+        fan_out: int = 5,
+        section_depth: int = 2,
+        done_ratio: float = 0.3,
+        inp_ratio: float = 0.1,
+        seed: Optional[int] = 0
+) -> str:
+    rand = random.Random(seed)
+    lines: List[str] = []
+    item_count = 0
+    section_count = 0
+
+    def add_items(level: int) -> None:
+        nonlocal item_count
+        for _ in range(fan_out):
+            if item_count >= items:
+                return
+            roll = rand.random()
+            status = "DONE" if roll < done_ratio else "INP" if roll < done_ratio + inp_ratio else ""
+            lines.append(f"{status}{'-' * (level + 1)} Item {item_count} {rand.choice(WORDS)} {rand.choice(WORDS)}")
+            item_count += 1
+            if level + 1 < depth and rand.random() < 0.5:
+                add_items(level + 1)
+
+    def add_section(level: int) -> None:
+        nonlocal section_count
+        section_count += 1
+        lines.append("")
+        lines.append(f"{'#' * level} Section {section_count} {rand.choice(WORDS)}")
+        add_items(0)
+        if level < section_depth:
+            for _ in range(fan_out // 2 + 1):
+                if item_count >= items:
+                    return
+                add_section(level + 1)
+
+    while item_count < items:
+        add_section(1)
+    return "\n".join(lines) + "\n"
+
+
+WORDS = [
+    "milk", "eggs", "report", "email", "garden", "invoice", "laundry", "review", "tickets", "backup",
+    "dentist", "budget", "plants", "release", "notes", "groceries", "meeting", "painting", "car", "taxes",
+]
@@ -1,9 +1,12 @@
 import json
 
 from todo_list_bot.bot import TodoListBot, BotConfig
+from todo_list_bot.sharding import ShardedBot
 
 if __name__ == '__main__':
     with open("config.json", "r") as f:
         config = BotConfig.from_json(json.load(f))
-    bot = TodoListBot(config)
-    bot.start()
+    if config.shards > 1:
+        ShardedBot(config).start()
+    else:
+        TodoListBot(config).start()
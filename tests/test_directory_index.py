@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+from todo_list_bot.directory_index import DirectoryIndex
+
+
+class DirectoryIndexTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.index = DirectoryIndex()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory.name, name)
+
+    def touch(self, name: str) -> None:
+        with open(self.path(name), "w"):
+            pass
+
+    def set_mtime(self, mtime_ns: int) -> None:
+        # Filesystem timestamps can be coarse, so changes are given distinct mtimes
+        os.utime(self.directory.name, ns=(mtime_ns, mtime_ns))
+
+    def test_own_changes_keep_listing_current(self) -> None:
+        self.touch("a.md")
+        self.set_mtime(1_000_000_000)
+        listing = self.index.get(self.directory.name)
+        with self.index.adding(self.path("b.md")):
+            self.touch("b.md")
+        with self.index.removing(self.path("a.md")):
+            os.remove(self.path("a.md"))
+        self.assertIs(self.index.get(self.directory.name), listing)
+        self.assertEqual(listing.files, ["b.md"])
+
+    def test_external_change_is_not_hidden(self) -> None:
+        self.touch("a.md")
+        self.set_mtime(1_000_000_000)
+        self.index.get(self.directory.name)
+        self.touch("external.md")
+        self.set_mtime(2_000_000_000)
+        with self.index.adding(self.path("b.md")):
+            self.touch("b.md")
+        self.assertEqual(self.index.get(self.directory.name).files, ["a.md", "b.md", "external.md"])
+
+
+if __name__ == "__main__":
+    unittest.main()
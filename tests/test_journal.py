@@ -0,0 +1,141 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from todo_list_bot.document_cache import document_cache
+from todo_list_bot.journal import journal
+from todo_list_bot.operations import SetStatus, RemoveNode, operation_from_json
+from todo_list_bot.todo_list import TodoList, TodoStatus
+
+LIST = """# List
+- foo
+- bar
+"""
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "list.md")
+        with open(self.path, "w") as f:
+            f.write(LIST)
+        journal.configure(os.path.join(self.directory.name, "journal"), 2)
+        self.journal_path = journal.journal_path(self.path)
+
+    def tearDown(self) -> None:
+        journal.configure(None, 100)
+        document_cache.remove(self.path)
+        self.directory.cleanup()
+
+    def read_list(self) -> str:
+        with open(self.path) as f:
+            return f.read()
+
+    def commit(self, name: str, status: TodoStatus) -> None:
+        asyncio.run(document_cache.commit(self.path, SetStatus(["List", name], status)))
+
+    def begin_without_saving(self, operation) -> str:
+        # As if the bot stopped between appending the record and saving the list
+        todo = TodoList(self.path)
+        todo.parse()
+        undo = operation.inverse(todo)
+        operation.apply(todo)
+        return journal.begin(todo, operation, undo)
+
+    def test_recover_replays_unsaved_record(self) -> None:
+        self.commit("foo", TodoStatus.IN_PROGRESS)
+        record_id = self.begin_without_saving(SetStatus(["List", "bar"], TodoStatus.COMPLETE))
+        journal.recover()
+        self.assertEqual(self.read_list(), LIST.replace("- foo", "INP- foo").replace("- bar", "DONE- bar"))
+        self.assertEqual(journal.last_undoable(self.path)["id"], record_id)
+        # The replayed save changed the signature, so recovering again does nothing
+        journal.recover()
+        self.assertEqual(self.read_list(), LIST.replace("- foo", "INP- foo").replace("- bar", "DONE- bar"))
+
+    def test_recover_ignores_saved_record(self) -> None:
+        self.commit("foo", TodoStatus.COMPLETE)
+        with open(self.path, "w") as f:
+            f.write(LIST)
+        journal.recover()
+        self.assertEqual(self.read_list(), LIST)
+
+    def test_unterminated_record_is_ignored(self) -> None:
+        self.commit("foo", TodoStatus.COMPLETE)
+        saved = journal.last_undoable(self.path)
+        record = {"id": "cut", "path": self.path, "signature": None, "op": {}, "undo": None, "undoes": None}
+        with open(self.journal_path, "ab") as f:
+            f.write(json.dumps(record).encode()[:40])
+        journal.recover()
+        self.assertEqual(self.read_list(), LIST.replace("- foo", "DONE- foo"))
+        self.assertEqual(journal.read(self.journal_path), [saved])
+        self.assertEqual(journal.last_undoable(self.path), saved)
+
+    def test_failed_replay_is_aborted(self) -> None:
+        record_id = self.begin_without_saving(RemoveNode(["List", "bar"]))
+        with open(self.path, "r+") as f:
+            # Rewritten in place, keeping the signature the record was written against
+            stat = os.stat(self.path)
+            f.write(LIST.replace("bar", "baz"))
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        journal.recover()
+        self.assertEqual(self.read_list(), LIST.replace("bar", "baz"))
+        self.assertEqual(journal.read(self.journal_path)[-1], {"aborts": record_id})
+        self.assertIsNone(journal.last_undoable(self.path))
+
+    def test_failed_save_is_aborted(self) -> None:
+        with mock.patch.object(document_cache, "write", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.commit("foo", TodoStatus.COMPLETE)
+        records = journal.read(self.journal_path)
+        self.assertEqual(records[-1], {"aborts": records[0]["id"]})
+        self.assertIsNone(journal.last_undoable(self.path))
+        journal.recover()
+        self.assertEqual(self.read_list(), LIST)
+
+    def test_conflict_aborts_and_retries(self) -> None:
+        write = document_cache.write
+        external_changes = ["- external\n"]
+
+        def change_then_write(todo, plan):
+            # Another process saves the list once, between this commit's parse and its save
+            if external_changes:
+                with open(self.path, "a") as f:
+                    f.write(external_changes.pop())
+            write(todo, plan)
+
+        with mock.patch.object(document_cache, "write", side_effect=change_then_write):
+            self.commit("foo", TodoStatus.COMPLETE)
+        first, abort, second = journal.read(self.journal_path)
+        self.assertEqual(abort, {"aborts": first["id"]})
+        self.assertEqual(journal.last_undoable(self.path), second)
+        record = journal.last_undoable(self.path)
+        asyncio.run(document_cache.commit(self.path, operation_from_json(record["undo"]), undoes=record["id"]))
+        self.assertEqual(self.read_list(), LIST + "- external\n")
+        self.assertIsNone(journal.last_undoable(self.path))
+
+    def test_compact_keeps_latest_undoable_records(self) -> None:
+        statuses = [TodoStatus.COMPLETE, TodoStatus.IN_PROGRESS, TodoStatus.TODO] * 2
+        for status in statuses:
+            self.commit("foo", status)
+        with mock.patch.object(document_cache, "write", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.commit("bar", TodoStatus.COMPLETE)
+        self.commit("bar", TodoStatus.IN_PROGRESS)
+        records = journal.read(self.journal_path)
+        self.assertEqual(
+            [(record["op"]["path"], record["op"]["status"]) for record in records],
+            [(["List", "foo"], TodoStatus.TODO.value), (["List", "bar"], TodoStatus.IN_PROGRESS.value)]
+        )
+        # Undoing every kept record walks the list back as far as the journal remembers
+        while journal.last_undoable(self.path) is not None:
+            record = journal.last_undoable(self.path)
+            asyncio.run(document_cache.commit(self.path, operation_from_json(record["undo"]), undoes=record["id"]))
+        self.assertEqual(self.read_list(), LIST.replace("- foo", "INP- foo"))
+
+
+if __name__ == "__main__":
+    unittest.main()
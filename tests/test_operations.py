@@ -0,0 +1,146 @@
+import asyncio
+import os
+import random
+import tempfile
+import unittest
+from typing import List
+
+from benchmarks.synthetic import generate_todo_text
+from todo_list_bot.document_cache import document_cache
+from todo_list_bot.journal import journal
+from todo_list_bot.operations import SetStatus, RemoveNode, SetSubtreeStatus, AppendLines, operation_from_json, \
+    ClearCompleted, InsertSubtree, MoveNode, ReplaceNode, TodoOperation, OperationError, snapshot_node
+from todo_list_bot.todo_list import TodoList, TodoStatus, TodoItem, TodoContainer
+
+DUPLICATE_NAMES = """# List
+- foo
+-- first child
+- foo
+-- second child
+## Section
+- bar
+## Section
+- baz
+"""
+
+
+class DuplicateNameTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "list.md")
+        with open(self.path, "w") as f:
+            f.write(DUPLICATE_NAMES)
+        self.todo = TodoList(self.path)
+        self.todo.parse()
+        self.section = self.todo.root_section.sub_sections[0]
+
+    def tearDown(self) -> None:
+        journal.configure(None, 100)
+        document_cache.remove(self.path)
+        self.directory.cleanup()
+
+    def test_set_status_targets_node_id(self) -> None:
+        first, second = self.section.root_items
+        SetStatus(["List", "foo"], TodoStatus.COMPLETE, second.node_id).apply(self.todo)
+        self.assertEqual(first.status, TodoStatus.TODO)
+        self.assertEqual(second.status, TodoStatus.COMPLETE)
+
+    def test_remove_targets_node_id(self) -> None:
+        second = self.section.root_items[1]
+        RemoveNode(["List", "foo"], second.node_id).apply(self.todo)
+        self.assertIn("first child", self.todo.to_text())
+        self.assertNotIn("second child", self.todo.to_text())
+
+    def test_subtree_status_targets_node_id(self) -> None:
+        first, second = self.section.sub_sections
+        SetSubtreeStatus(["List", "Section"], TodoStatus.COMPLETE, second.node_id).apply(self.todo)
+        self.assertEqual(first.root_items[0].status, TodoStatus.TODO)
+        self.assertEqual(second.root_items[0].status, TodoStatus.COMPLETE)
+
+    def test_append_targets_node_id(self) -> None:
+        first, second = self.section.sub_sections
+        AppendLines(["List", "Section"], ["- new"], second.node_id).apply(self.todo)
+        self.assertEqual([item.name for item in first.root_items], ["bar"])
+        self.assertEqual([item.name for item in second.root_items], ["baz", "new"])
+
+    def test_stale_node_id_falls_back_to_path(self) -> None:
+        second = self.section.root_items[1]
+        operation = operation_from_json(SetStatus(["List", "foo"], TodoStatus.COMPLETE, second.node_id).to_json())
+        reparsed = TodoList(self.path)
+        reparsed.parse()
+        operation.apply(reparsed)
+        first = reparsed.root_section.sub_sections[0].root_items[0]
+        self.assertEqual(first.status, TodoStatus.COMPLETE)
+
+    def test_commit_and_undo_target_node_id(self) -> None:
+        journal.configure(os.path.join(self.directory.name, "journal"), 100)
+        todo = document_cache.get(self.path)
+        second = todo.root_section.sub_sections[0].root_items[1]
+        asyncio.run(document_cache.commit(self.path, SetStatus(["List", "foo"], TodoStatus.COMPLETE, second.node_id)))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), DUPLICATE_NAMES.replace("- foo\n-- second", "DONE- foo\n-- second"))
+        record = journal.last_undoable(self.path)
+        asyncio.run(document_cache.commit(self.path, operation_from_json(record["undo"]), undoes=record["id"]))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), DUPLICATE_NAMES)
+
+
+def random_operation(rng: random.Random, todo: TodoList) -> TodoOperation:
+    nodes: List[TodoContainer] = list(todo.root_section.walk())
+    node = rng.choice(nodes)
+    other = rng.choice(nodes)
+    kind = rng.randrange(8)
+    if kind == 0 and isinstance(node, TodoItem):
+        return SetStatus(node.path, rng.choice(list(TodoStatus)), node.node_id)
+    if kind == 1:
+        return SetSubtreeStatus(node.path, rng.choice(list(TodoStatus)), node.node_id)
+    if kind == 2:
+        return ClearCompleted(node.path, node.node_id)
+    if kind == 3 and node.parent is not None:
+        return RemoveNode(node.path, node.node_id)
+    if kind == 4 and node.parent is not None:
+        return MoveNode(node.path, other.path, node.node_id, other.node_id)
+    if kind == 5 and node.parent is not None:
+        return ReplaceNode(node.path, ["DONE- replaced", "-- INP child"], node.node_id)
+    if kind == 6 and node.parent is not None:
+        return InsertSubtree(other.path, snapshot_node(node), other.node_id)
+    return AppendLines(node.path, ["INP- added", "--DONE nested", "- plain"], node.node_id)
+
+
+def recount(node: TodoContainer) -> tuple:
+    statuses = [item.status for item in node.walk() if isinstance(item, TodoItem) and item is not node]
+    return (
+        statuses.count(TodoStatus.COMPLETE),
+        statuses.count(TodoStatus.IN_PROGRESS),
+        statuses.count(TodoStatus.TODO)
+    )
+
+
+class ProgressCountTest(unittest.TestCase):
+
+    def assert_counts(self, todo: TodoList, operation: TodoOperation) -> None:
+        for node in todo.root_section.walk():
+            self.assertEqual(node.progress, recount(node), (type(operation).__name__, node.path))
+
+    def test_counts_match_recount_after_operations_and_undo(self) -> None:
+        rng = random.Random(20)
+        todo = TodoList("list.md")
+        todo.parse_lines(generate_todo_text(80, seed=20).split("\n"))
+        for _ in range(500):
+            operation = random_operation(rng, todo)
+            undo = operation.inverse(todo)
+            before = todo.to_text()
+            try:
+                operation.apply(todo)
+            except OperationError:
+                continue
+            self.assert_counts(todo, operation)
+            if undo is not None and rng.random() < 0.5:
+                undo.apply(todo)
+                self.assert_counts(todo, undo)
+                self.assertEqual(todo.to_text(), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
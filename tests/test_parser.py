@@ -0,0 +1,128 @@
+import os
+import random
+import tempfile
+import unittest
+from typing import Iterable, Tuple, Optional, List
+
+from todo_list_bot.todo_list import TodoList, TodoSection, TodoItem, TodoStatus, SourceSpan
+
+# Characters which the parser treats specially, with a few ordinary and multi byte ones
+ALPHABET = ["#", "#", " ", " ", "-", "-", "\t", "D", "O", "N", "E", "I", "P", "a", "b", "é", "✓"]
+LINE_ENDINGS = ["\n", "\n", "\r\n"]
+
+
+class ReferenceTodoList(TodoList):
+    # The line parser as it was before it was replaced by a single regex match per line
+
+    def _parse(self, contents: Iterable[Tuple[str, Optional[SourceSpan]]], current_section: TodoSection) -> None:
+        current_item = None
+        for line, span in contents:
+            if line.strip() == "":
+                continue
+            if line.startswith("#"):
+                current_section = self.reference_section(line, current_section, span)
+                current_item = None
+            else:
+                current_item = self.reference_item(line, current_section, current_item, span)
+
+    # noinspection PyMethodMayBeStatic
+    def reference_section(
+            self,
+            line: str,
+            current_section: TodoSection,
+            source_span: Optional[SourceSpan]
+    ) -> TodoSection:
+        section_title = line.lstrip("#")
+        section_depth = len(line) - len(section_title)
+        section_title = section_title.strip()
+        if section_depth > current_section.depth:
+            parent_section = current_section
+        else:
+            while section_depth <= current_section.depth:
+                current_section = current_section.parent_section
+            parent_section = current_section
+        return TodoSection(section_title, section_depth, parent_section, source_span)
+
+    # noinspection PyMethodMayBeStatic
+    def reference_item(
+            self,
+            line: str,
+            current_section: TodoSection,
+            current_item: Optional[TodoItem],
+            source_span: Optional[SourceSpan]
+    ) -> TodoItem:
+        status = TodoStatus.TODO
+        for enum_status in TodoStatus:
+            if line.startswith(enum_status.value):
+                status = enum_status
+                line = line[len(enum_status.value):]
+                break
+        item_text = line.lstrip(" -")
+        item_depth = len(line) - len(item_text)
+        item_text = item_text.strip()
+        if current_item is None:
+            parent_item = None
+        elif item_depth > current_item.depth:
+            parent_item = current_item
+        else:
+            parent_item = current_item
+            while item_depth <= parent_item.depth:
+                if parent_item.parent_item is not None:
+                    parent_item = parent_item.parent_item
+                else:
+                    parent_item = None
+                    break
+        return TodoItem(status, item_text, item_depth, current_section, parent_item, source_span)
+
+
+def random_line(rng: random.Random) -> str:
+    prefix = rng.choice(["", "", "#", "##", "###", "DONE", "INP", "DONE-", "INP--", "- ", "--", "   "])
+    return prefix + "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 12)))
+
+
+def random_lines(rng: random.Random) -> List[str]:
+    return [random_line(rng) + rng.choice(LINE_ENDINGS) for _ in range(rng.randint(0, 40))]
+
+
+def parsed_lines(todo: TodoList) -> List[Tuple[Optional[SourceSpan], str, int]]:
+    return [
+        (node.source_span if node is not None else None, line, node.depth if node is not None else -1)
+        for node, line in todo.root_section.render_lines()
+    ]
+
+
+class ParserEquivalenceTest(unittest.TestCase):
+    iterations = 500
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "list.md")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def assert_equivalent(self, todo: TodoList, reference: TodoList, lines: List[str]) -> None:
+        self.assertEqual(todo.to_text(), reference.to_text(), lines)
+        self.assertEqual(parsed_lines(todo), parsed_lines(reference), lines)
+
+    def test_parse_matches_reference(self) -> None:
+        rng = random.Random(9)
+        for _ in range(self.iterations):
+            lines = random_lines(rng)
+            with open(self.path, "wb") as f:
+                f.write("".join(lines).encode())
+            todo = TodoList(self.path)
+            todo.parse()
+            reference = ReferenceTodoList(self.path)
+            reference.parse()
+            self.assert_equivalent(todo, reference, lines)
+
+    def test_parse_lines_matches_reference(self) -> None:
+        rng = random.Random(10)
+        for _ in range(self.iterations):
+            lines = random_lines(rng)
+            todo = TodoList(self.path)
+            todo.parse_lines(lines)
+            reference = ReferenceTodoList(self.path)
+            reference.parse_lines(lines)
+            self.assert_equivalent(todo, reference, lines)
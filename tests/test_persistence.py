@@ -0,0 +1,47 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from todo_list_bot.bot import ViewerStore
+from todo_list_bot.persistence import ViewerPersistence
+
+
+class PersistenceTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.records = os.path.join(self.directory.name, "viewer_store")
+        os.makedirs(self.records)
+        self.store = ViewerStore(self.directory.name)
+        self.persistence = ViewerPersistence(self.store, self.records, 0)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_flush_skips_evicted_chats(self) -> None:
+        self.store.create_viewer(1)
+        self.store.create_viewer(2)
+        self.persistence.mark_dirty(1)
+        self.persistence.mark_dirty(2)
+        self.store.evict(1)
+        asyncio.run(self.persistence.flush())
+        self.assertFalse(os.path.exists(self.persistence.record_path(1)))
+        with open(self.persistence.record_path(2)) as f:
+            self.assertEqual(json.load(f)["viewer"]["chat_id"], 2)
+
+    def test_load_ignores_other_json_files(self) -> None:
+        self.store.create_viewer(-100)
+        self.persistence.mark_dirty(-100)
+        asyncio.run(self.persistence.flush())
+        with open(os.path.join(self.records, "viewer_store.json"), "w") as f:
+            json.dump({"viewers": []}, f)
+        for owns_chat in [None, lambda chat_id: True]:
+            store = ViewerStore(self.directory.name)
+            ViewerPersistence(store, self.records, 0, owns_chat).load("viewer_store.json")
+            self.assertEqual(list(store.store), [-100])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import random
+import tempfile
+import unittest
+from typing import List
+
+from benchmarks.synthetic import generate_todo_text
+from todo_list_bot.operations import SetStatus, SetSubtreeStatus, RemoveNode, AppendLines, ReplaceNode, TodoOperation
+from todo_list_bot.todo_list import TodoList, TodoItem, TodoStatus, TodoContainer
+
+
+def random_operation(rng: random.Random, todo: TodoList) -> TodoOperation:
+    nodes: List[TodoContainer] = list(todo.root_section.walk())
+    items = [node for node in nodes if isinstance(node, TodoItem)]
+    node = rng.choice(nodes)
+    roll = rng.random()
+    # Status changes are saved by patching their lines, and everything else by rewriting the file
+    if items and roll < 0.5:
+        item = rng.choice(items)
+        return SetStatus(item.path, rng.choice(list(TodoStatus)), item.node_id)
+    if roll < 0.65:
+        return SetSubtreeStatus(node.path, rng.choice(list(TodoStatus)), node.node_id)
+    if roll < 0.75 and node.parent is not None:
+        return RemoveNode(node.path, node.node_id)
+    if roll < 0.85 and node.parent is not None:
+        return ReplaceNode(node.path, [f"- replaced {rng.randint(0, 99)}", "-- child"], node.node_id)
+    return AppendLines(node.path, [f"- added {rng.randint(0, 99)}", "-- nested é"], node.node_id)
+
+
+class PatchedSaveTest(unittest.TestCase):
+    iterations = 300
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "list.md")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def assert_spans_match(self, todo: TodoList, contents: bytes) -> None:
+        for node in todo.root_section.walk():
+            if node.source_span is not None:
+                start, end = node.source_span
+                self.assertEqual(contents[start:end].decode(), node.line_text())
+
+    def test_patched_save_matches_full_save(self) -> None:
+        rng = random.Random(5)
+        with open(self.path, "w") as f:
+            f.write(generate_todo_text(60, seed=5))
+        todo = TodoList(self.path)
+        todo.parse()
+        todo.root_section.structure_changed = True
+        todo.save()
+        patched_saves = 0
+        for _ in range(self.iterations):
+            for _ in range(rng.randint(1, 3)):
+                operation = random_operation(rng, todo)
+                undo = operation.inverse(todo)
+                operation.apply(todo)
+                # Undoing straight away saves the same lines again, including any which were patched
+                if undo is not None and rng.random() < 0.2:
+                    undo.apply(todo)
+            plan = todo.render()
+            patched_saves += not plan.full and bool(plan.lines)
+            todo.write(plan)
+            contents = self.read()
+            self.assertEqual(contents, "\n".join(line for _, line in todo.root_section.render_lines()).encode())
+            self.assert_spans_match(todo, contents)
+        self.assertGreater(patched_saves, self.iterations // 4)
+
+    def test_patched_save_keeps_original_formatting(self) -> None:
+        original = "# List\r\n\r\n- first\r\n-- child é\r\n\r\n\r\n## Later\r\nINP- second\r\n- third"
+        with open(self.path, "wb") as f:
+            f.write(original.encode())
+        todo = TodoList(self.path)
+        todo.parse()
+        for path, status in [(["List", "first"], TodoStatus.COMPLETE), (["List", "Later", "second"], TodoStatus.TODO)]:
+            SetStatus(path, status).apply(todo)
+        SetStatus(["List", "first", "child é"], TodoStatus.IN_PROGRESS).apply(todo)
+        plan = todo.render()
+        self.assertFalse(plan.full)
+        todo.write(plan)
+        expected = original.replace("- first", "DONE- first").replace("-- child", "INP- -child")
+        expected = expected.replace("INP- second", "- second")
+        self.assertEqual(self.read(), expected.encode())
+        self.assert_spans_match(todo, self.read())
+        reparsed = TodoList(self.path)
+        reparsed.parse()
+        self.assertEqual(reparsed.to_text(), todo.to_text())
+
+
+if __name__ == "__main__":
+    unittest.main()
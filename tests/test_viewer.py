@@ -0,0 +1,74 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from todo_list_bot.document_cache import document_cache
+from todo_list_bot.operations import SetStatus
+from todo_list_bot.todo_list import TodoStatus, TodoListConflict
+from todo_list_bot.todo_viewer import TodoViewer
+
+
+class DeleteRootTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "list.md")
+        self.viewer = TodoViewer(1, self.directory.name)
+
+    def tearDown(self) -> None:
+        document_cache.remove(self.path)
+        self.directory.cleanup()
+
+    def open_list(self, text: str) -> None:
+        with open(self.path, "w") as f:
+            f.write(text)
+        self.viewer.current_todo = document_cache.get(self.path)
+        self.viewer.current_todo_path = []
+
+    def test_delete_non_empty_root_is_refused(self) -> None:
+        self.open_list("- foo\n- bar\n")
+        response = asyncio.run(self.viewer.handle_callback(b"delete"))
+        self.assertIn("Only an empty todo list can be deleted.", response.text)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "- foo\n- bar\n")
+        self.assertEqual(self.viewer.current_todo_path, [])
+
+    def test_delete_empty_root_removes_file(self) -> None:
+        self.open_list("")
+        asyncio.run(self.viewer.handle_callback(b"delete"))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNone(self.viewer.current_todo)
+
+
+class CommitErrorTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "list.md")
+        with open(self.path, "w") as f:
+            f.write("- foo\n")
+        self.viewer = TodoViewer(1, self.directory.name)
+        self.viewer.current_todo = document_cache.get(self.path)
+        self.viewer.current_todo_path = ["foo"]
+
+    def tearDown(self) -> None:
+        document_cache.remove(self.path)
+        self.directory.cleanup()
+
+    def test_deleted_file_resets_viewer(self) -> None:
+        os.remove(self.path)
+        response = asyncio.run(self.viewer.commit(SetStatus(["foo"], TodoStatus.COMPLETE)))
+        self.assertEqual(response.text, "The todo list has been deleted.")
+        self.assertIsNone(self.viewer.current_todo)
+
+    def test_conflict_replies_with_error(self) -> None:
+        with mock.patch.object(document_cache, "commit", side_effect=TodoListConflict("changed")):
+            response = asyncio.run(self.viewer.commit(SetStatus(["foo"], TodoStatus.COMPLETE)))
+        self.assertEqual(response.text, "The todo list kept changing while saving, please try again.")
+        self.assertEqual(self.viewer.current_todo.path, self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
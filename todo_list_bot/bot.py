@@ -1,21 +1,88 @@
+import asyncio
 import dataclasses
 import json
-from typing import Dict, Any, List, Optional
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Callable, Awaitable, Set, Tuple
 
-from prometheus_client import start_http_server, Counter
+from prometheus_client import start_http_server, Counter, Gauge, Histogram
 from telethon import TelegramClient
 from telethon.events import NewMessage, StopPropagation, CallbackQuery
+from telethon.tl.custom import Message
 
+from todo_list_bot.dispatcher import ChatDispatcher, Handler
+from todo_list_bot.document_cache import document_cache
+from todo_list_bot.eviction import IdleEvictor
+from todo_list_bot.file_io import file_io
+from todo_list_bot.journal import journal
+from todo_list_bot.menu_handler import MenuHandler, menu_entries
+from todo_list_bot.outbox import Outbox
+from todo_list_bot.persistence import ViewerPersistence
+from todo_list_bot.render_cache import render_cache
 from todo_list_bot.response import Response
+from todo_list_bot.search_index import SearchIndex
 from todo_list_bot.todo_viewer import TodoViewer
 
 start_usage = Counter("todolistbot_usage_start_total", "Count of how many times the start function is called")
 button_usage = Counter("todolistbot_usage_button_total", "Count of how many button callbacks have been processed")
+search_usage = Counter("todolistbot_usage_search_total", "Count of how many searches have been sent to the bot")
+undo_usage = Counter("todolistbot_usage_undo_total", "Count of how many undo commands have been sent to the bot")
 text_usage = Counter("todolistbot_usage_text_total", "Count of how many times text has been sent to the bot")
 access_denied = Counter(
     "todolistbot_start_denied_total",
     "Count of how many times unauthorised users have tried to start the bot"
 )
+startup_load_time = Gauge(
+    "todolistbot_startup_load_seconds",
+    "Time taken to restore the viewer store on startup"
+)
+startup_viewers = Gauge("todolistbot_startup_viewers", "Number of viewers restored from the viewer store on startup")
+handler_latency = Histogram(
+    "todolistbot_handler_seconds",
+    "Time taken to handle a message or button press, from receipt to the reply being sent",
+    ["handler", "command"]
+)
+viewers_resident = Gauge("todolistbot_viewers_resident", "Number of chat viewers held in memory")
+viewers_with_tree = Gauge(
+    "todolistbot_viewers_resident_with_tree",
+    "Number of chat viewers in memory which hold a parsed todo list"
+)
+
+# Callback data is sent back by the client, so only known commands are used as metric labels
+CALLBACK_COMMANDS = {
+    "file", "list", "folder", "up_folder", "section", "item", "up", "item_done", "item_inp", "item_todo", "delete",
+    "search", "replace", "cancel_replace", "page", "view", "bulk", "all_done", "all_inp", "all_todo", "clear_done",
+    "copy", "cut", "paste", "cancel_paste", "list_page"
+}
+
+
+# The handler and command labels of each message command
+MESSAGE_COMMANDS = {"/start": ("welcome", "start"), "/search": ("search", "search"), "/undo": ("undo", "undo")}
+
+LatencyLabels = Tuple[str, str]
+
+
+def callback_command(data: bytes) -> str:
+    command = data.split(b":", 1)[0].decode(errors="replace")
+    return command if command in CALLBACK_COMMANDS else "unknown"
+
+
+def message_labels(text: str) -> LatencyLabels:
+    for prefix, labels in MESSAGE_COMMANDS.items():
+        if text.startswith(prefix):
+            return labels
+    return "append", "text"
+
+
+def callback_labels(data: bytes) -> LatencyLabels:
+    return "callback", callback_command(data)
+
+
+async def observe_latency(outbox: Outbox, chat_id: int, labels: LatencyLabels, received: float) -> None:
+    # Edits are sent by the outbox after their handler returns, so the update is only done once the chat's are sent
+    await outbox.join(chat_id)
+    handler, command = labels
+    handler_latency.labels(handler=handler, command=command).observe(time.monotonic() - received)
 
 
 @dataclasses.dataclass
@@ -27,6 +94,26 @@ class BotConfig:
     allowed_chat_ids: List[int]
     viewer_store_filename: str = "viewer_store.json"
     prometheus_port: int = 8479
+    io_threads: int = 4
+    viewer_store_dir: str = "viewer_store/"
+    save_delay: float = 1.0
+    search_index_filename: str = "search_index.json"
+    search_refresh_interval: float = 300
+    render_cache_size: int = 256
+    max_concurrent_chats: int = 16
+    chat_queue_size: int = 20
+    edit_rate_per_chat: float = 1.0
+    edit_burst_per_chat: float = 5
+    edit_rate_global: float = 30.0
+    edit_burst_global: float = 30
+    shards: int = 1
+    journal_dir: Optional[str] = "journal/"
+    journal_max_records: int = 100
+    menu_cache_size: int = 10000
+    menu_cache_ttl: float = 7 * 24 * 60 * 60
+    viewer_idle_ttl: float = 24 * 60 * 60
+    max_resident_viewers: int = 10000
+    max_resident_trees: int = 100
 
     @classmethod
     def from_json(cls, json_data: Dict[str, Any]) -> 'BotConfig':
@@ -37,153 +124,263 @@ class BotConfig:
             json_data["storage_dir"],
             json_data["allowed_chat_ids"],
             json_data.get("viewer_store_filename", "viewer_store.json"),
-            json_data.get("prometheus_port", 8479)
+            json_data.get("prometheus_port", 8479),
+            json_data.get("io_threads", 4),
+            json_data.get("viewer_store_dir", "viewer_store/"),
+            json_data.get("save_delay", 1.0),
+            json_data.get("search_index_filename", "search_index.json"),
+            json_data.get("search_refresh_interval", 300),
+            json_data.get("render_cache_size", 256),
+            json_data.get("max_concurrent_chats", 16),
+            json_data.get("chat_queue_size", 20),
+            json_data.get("edit_rate_per_chat", 1.0),
+            json_data.get("edit_burst_per_chat", 5),
+            json_data.get("edit_rate_global", 30.0),
+            json_data.get("edit_burst_global", 30),
+            json_data.get("shards", 1),
+            json_data.get("journal_dir", "journal/"),
+            json_data.get("journal_max_records", 100),
+            json_data.get("menu_cache_size", 10000),
+            json_data.get("menu_cache_ttl", 7 * 24 * 60 * 60),
+            json_data.get("viewer_idle_ttl", 24 * 60 * 60),
+            json_data.get("max_resident_viewers", 10000),
+            json_data.get("max_resident_trees", 100)
         )
 
 
 class TodoListBot:
-    def __init__(self, config: BotConfig) -> None:
+    def __init__(
+            self,
+            config: BotConfig,
+            client: Optional[TelegramClient] = None,
+            outbox: Optional[Outbox] = None,
+            owns_chat: Optional[Callable[[int], bool]] = None
+    ) -> None:
         self.config = config
-        self.client = TelegramClient("todolistbot", self.config.api_id, self.config.api_hash)
-        self.viewer_store = ViewerStore.load_from_json(config.viewer_store_filename)
+        self.client = client
+        file_io.configure(self.config.io_threads)
+        journal.configure(self.config.journal_dir, self.config.journal_max_records)
+        render_cache.max_entries = self.config.render_cache_size
+        self.dispatcher = ChatDispatcher(config.max_concurrent_chats, config.chat_queue_size)
+        self.outbox = outbox or Outbox(
+            config.edit_rate_per_chat,
+            config.edit_burst_per_chat,
+            config.edit_rate_global,
+            config.edit_burst_global
+        )
+        self.viewer_store = ViewerStore(config.storage_dir)
+        self.viewer_store.menus.max_entries = config.menu_cache_size
+        self.viewer_store.menus.ttl = config.menu_cache_ttl
+        # Bound here rather than in ViewerStore, so a store built while migrating doesn't take over the gauges
+        viewers_resident.set_function(lambda: len(self.viewer_store.store))
+        viewers_with_tree.set_function(
+            lambda: sum(1 for viewer in self.viewer_store.store.values() if viewer.current_todo is not None)
+        )
+        menu_entries.set_function(lambda: len(self.viewer_store.menus.cache))
+        self.persistence = ViewerPersistence(self.viewer_store, config.viewer_store_dir, config.save_delay, owns_chat)
+        start_time = time.monotonic()
+        self.persistence.load(config.viewer_store_filename)
+        self.viewer_store.menus.loaded()
+        self.evictor = IdleEvictor(
+            self.viewer_store,
+            self.persistence,
+            config.viewer_idle_ttl,
+            config.max_resident_viewers,
+            config.max_resident_trees
+        )
+        startup_load_time.set(time.monotonic() - start_time)
+        startup_viewers.set(len(self.viewer_store.store))
+        self.search_index = SearchIndex(config.storage_dir, config.search_index_filename, config.search_refresh_interval)
+        self.search_index.load()
+        document_cache.add_listener(self.search_index)
+
+    def add_handlers(self) -> None:
+        self.client.add_event_handler(self.route_message, NewMessage(incoming=True))
+        self.client.add_event_handler(self.route_callback, CallbackQuery())
+
+    def message_handler(self, text: str) -> Callable[[NewMessage.Event], Awaitable[None]]:
+        if text.startswith("/start"):
+            return self.welcome
+        if text.startswith("/search"):
+            return self.search
+        if text.startswith("/undo"):
+            return self.undo
+        return self.append_todo
+
+    async def route_message(self, event: NewMessage.Event) -> None:
+        text = event.message.message or ""
+        await self.dispatcher.submit(event.chat_id, self.timed(self.message_handler(text), message_labels(text)), event)
+
+    async def route_callback(self, event: CallbackQuery.Event) -> None:
+        await self.dispatcher.submit(event.chat_id, self.timed(self.handle_callback, callback_labels(event.data)), event)
+
+    def timed(self, handler: Handler, labels: LatencyLabels) -> Handler:
+        # Timed from receipt, so time spent queued behind the chat's earlier updates is included
+        received = time.monotonic()
+
+        async def handle(event: Any) -> None:
+            try:
+                await handler(event)
+            finally:
+                # Observed in its own task, so the chat's next update isn't held up waiting for the edit to be sent
+                asyncio.get_running_loop().create_task(observe_latency(self.outbox, event.chat_id, labels, received))
+        return handle
 
     def start(self) -> None:
-        self.client.add_event_handler(self.welcome, NewMessage(pattern="/start", incoming=True))
-        self.client.add_event_handler(self.handle_callback, CallbackQuery())
-        self.client.add_event_handler(self.append_todo, NewMessage(incoming=True))
+        # Replay any edit which was journalled but not saved before the bot last stopped
+        journal.recover()
+        if self.client is None:
+            self.client = TelegramClient("todolistbot", self.config.api_id, self.config.api_hash)
+        self.add_handlers()
         self.client.start(bot_token=self.config.bot_token)
         start_http_server(self.config.prometheus_port)
+        self.client.loop.create_task(self.persistence.run())
+        self.client.loop.create_task(self.evictor.run())
+        self.client.loop.create_task(self.search_index.run())
         self.client.run_until_disconnected()
+        self.client.loop.run_until_complete(self.persistence.flush())
+        self.search_index.save()
+
+    async def get_viewer(self, chat_id: int) -> TodoViewer:
+        await self.persistence.rehydrate(chat_id)
+        return self.viewer_store.get_viewer(chat_id)
+
+    def save(self, chat_id: int) -> None:
+        self.persistence.mark_dirty(chat_id)
 
-    def save(self) -> None:
-        self.viewer_store.save_to_json(self.config.viewer_store_filename)
+    def add_menu(self, chat_id: int, message: Optional[Message], response: Response) -> None:
+        # Sharded workers don't see the sent message, and are told about it separately
+        if message is not None:
+            self.viewer_store.menus.add(chat_id, message.id, response)
 
     async def welcome(self, event: NewMessage.Event) -> None:
         start_usage.inc()
         if event.chat_id not in self.config.allowed_chat_ids:
             access_denied.inc()
-            await event.respond("Apologies, but this bot is only available to certain users.")
+            await self.outbox.respond(event, Response("Apologies, but this bot is only available to certain users."))
             raise StopPropagation
-        viewer = self.viewer_store.get_viewer(event.chat_id)
-        response = viewer.current_message()
-        self.viewer_store.response_cache.add_response(event.chat_id, response)
+        viewer = await self.get_viewer(event.chat_id)
+        response = await viewer.current_message()
         response.prefix("Welcome to Spangle's todo list bot.\n")
-        await event.reply(
-            response.text,
-            parse_mode="html",
-            buttons=response.buttons()
-        )
-        self.save()
+        message = await self.outbox.reply(event, response)
+        self.add_menu(event.chat_id, message, response)
+        self.save(event.chat_id)
         raise StopPropagation
 
-    async def handle_callback(self, event: CallbackQuery.Event) -> None:
-        button_usage.inc()
+    async def search(self, event: NewMessage.Event) -> None:
+        search_usage.inc()
         if not self.viewer_store.has_viewer(event.chat_id):
             raise StopPropagation
-        # Check if response cache does something
-        response = self.viewer_store.response_cache.handle_callback(event.chat_id, event.data)
-        self.viewer_store.response_cache.add_response(event.chat_id, response)
-        if response:
-            await event.edit(
-                response.text,
-                parse_mode="html",
-                buttons=response.buttons()
-            )
-            self.save()
-            raise StopPropagation
-        # Ask the viewer
-        viewer = self.viewer_store.get_viewer(event.chat_id)
-        response = viewer.handle_callback(event.data)
-        self.viewer_store.response_cache.add_response(event.chat_id, response)
-        await event.edit(
-            response.text,
-            parse_mode="html",
-            buttons=response.buttons()
-        )
-        self.save()
+        viewer = await self.get_viewer(event.chat_id)
+        query = event.message.message[len("/search"):].strip()
+        response = viewer.search_message(query, self.search_index.search(query))
+        message = await self.outbox.respond(event, response)
+        self.add_menu(event.chat_id, message, response)
+        self.save(event.chat_id)
         raise StopPropagation
 
-    async def append_todo(self, event: NewMessage.Event) -> None:
-        text_usage.inc()
+    async def undo(self, event: NewMessage.Event) -> None:
+        undo_usage.inc()
         if not self.viewer_store.has_viewer(event.chat_id):
             raise StopPropagation
-        viewer = self.viewer_store.get_viewer(event.chat_id)
-        response = viewer.append_todo(event.message.message)
-        self.viewer_store.response_cache.add_response(event.chat_id, response)
-        await event.respond(
-            response.text,
-            parse_mode="html",
-            buttons=response.buttons()
-        )
-        self.save()
+        viewer = await self.get_viewer(event.chat_id)
+        response = await viewer.undo()
+        message = await self.outbox.respond(event, response)
+        self.add_menu(event.chat_id, message, response)
+        self.save(event.chat_id)
         raise StopPropagation
 
-
-class ResponseCache:
-
-    def __init__(self):
-        self.store = {}
-
-    def add_response(self, chat_id: int, response: Response):
-        self.store[chat_id] = response
-
-    def handle_callback(self, chat_id: int, callback_data: bytes) -> Optional[Response]:
-        if chat_id not in self.store:
-            return None
-        if callback_data.split(b":", 1)[0] == b"page":
-            page_num = int(callback_data.split(b":")[1].decode())
-            response = self.store[chat_id]
-            if page_num > response.pages:
+    async def handle_callback(self, event: CallbackQuery.Event) -> None:
+        button_usage.inc()
+        try:
+            if not self.viewer_store.has_viewer(event.chat_id):
                 raise StopPropagation
-            response.page = page_num
-            return response
-
-    def to_json(self) -> Dict:
-        return {
-            str(chat_id): response.to_json() for chat_id, response in self.store.items()
-        }
+            viewer = await self.get_viewer(event.chat_id)
+            if event.data.startswith(b"page:"):
+                # Page buttons act on the message they were pressed on, which may not be the latest one
+                response = self.viewer_store.menus.handle_callback(event.chat_id, event.message_id, event.data)
+                if response is None:
+                    response = await viewer.current_message()
+                    response.prefix("That menu has expired, so here is the current view.\n")
+            else:
+                response = await viewer.handle_callback(event.data)
+            self.viewer_store.menus.add(event.chat_id, event.message_id, response)
+            await self.outbox.edit(event, response)
+            self.save(event.chat_id)
+            raise StopPropagation
+        finally:
+            # Whether or not an edit is sent, and even if handling failed
+            await self.outbox.answer(event)
 
-    @classmethod
-    def from_json(cls, data: Dict) -> 'ResponseCache':
-        cache = ResponseCache()
-        for chat_id, response_data in data.items():
-            cache.add_response(int(chat_id), Response.from_json(response_data))
-        return cache
+    async def append_todo(self, event: NewMessage.Event) -> None:
+        text_usage.inc()
+        if not self.viewer_store.has_viewer(event.chat_id):
+            raise StopPropagation
+        viewer = await self.get_viewer(event.chat_id)
+        response = await viewer.append_todo(event.message.message)
+        message = await self.outbox.respond(event, response)
+        self.add_menu(event.chat_id, message, response)
+        self.save(event.chat_id)
+        raise StopPropagation
 
 
 class ViewerStore:
 
-    def __init__(self):
-        self.store = {}
-        self.response_cache = ResponseCache()
+    def __init__(self, base_directory: str = "store/"):
+        self.base_directory = base_directory
+        # Ordered from least to most recently active
+        self.store: OrderedDict[int, TodoViewer] = OrderedDict()
+        self.last_active: Dict[int, float] = {}
+        self.evicted: Set[int] = set()
+        self.menus = MenuHandler()
 
     def add_viewer(self, viewer: TodoViewer) -> None:
         self.store[viewer.chat_id] = viewer
+        self.last_active[viewer.chat_id] = time.monotonic()
+        self.evicted.discard(viewer.chat_id)
 
     def create_viewer(self, chat_id: int) -> TodoViewer:
-        viewer = TodoViewer(chat_id)
-        self.store[chat_id] = viewer
+        viewer = TodoViewer(chat_id, self.base_directory)
+        self.add_viewer(viewer)
         return viewer
 
     def get_viewer(self, chat_id: int) -> TodoViewer:
+        if chat_id in self.evicted:
+            raise ValueError(f"Viewer for chat {chat_id} was evicted, and must be loaded before use")
         if chat_id not in self.store:
-            self.create_viewer(chat_id)
+            return self.create_viewer(chat_id)
+        self.store.move_to_end(chat_id)
+        self.last_active[chat_id] = time.monotonic()
         return self.store[chat_id]
 
     def has_viewer(self, chat_id: int) -> bool:
-        return chat_id in self.store
+        return chat_id in self.store or chat_id in self.evicted
 
-    def save_to_json(self, filename: str) -> None:
-        data = {
-            "viewers": [viewer.to_json() for viewer in self.store.values()],
-            "response_cache": self.response_cache.to_json()
+    def evict(self, chat_id: int) -> None:
+        # Only for chats whose record is saved, as the viewer is loaded from it again on the chat's next update
+        del self.store[chat_id]
+        del self.last_active[chat_id]
+        self.evicted.add(chat_id)
+
+    def chat_to_json(self, chat_id: int) -> Dict:
+        return {
+            "viewer": self.store[chat_id].to_json(),
+            "menus": self.menus.chat_to_json(chat_id)
         }
-        with open(filename, "w") as f:
-            json.dump(data, f, indent=2)
+
+    def load_chat_json(self, data: Dict) -> None:
+        viewer = self.load_viewer_json(data)
+        # Records from before menus were cached per message hold a single response, which can't be matched to one
+        self.menus.load_chat_json(viewer.chat_id, data.get("menus", []))
+
+    def load_viewer_json(self, data: Dict) -> TodoViewer:
+        viewer = TodoViewer.from_json(data["viewer"], self.base_directory)
+        self.add_viewer(viewer)
+        return viewer
 
     @classmethod
-    def load_from_json(cls, filename: str) -> 'ViewerStore':
-        store = ViewerStore()
+    def load_from_json(cls, filename: str, base_directory: str = "store/") -> 'ViewerStore':
+        store = ViewerStore(base_directory)
         try:
             with open(filename, "r") as f:
                 data = json.load(f)
@@ -191,7 +388,7 @@ class ViewerStore:
             return store
         else:
             for viewer_data in data["viewers"]:
-                viewer = TodoViewer.from_json(viewer_data)
+                viewer = TodoViewer.from_json(viewer_data, base_directory)
                 store.add_viewer(viewer)
-            store.response_cache = ResponseCache.from_json(data["response_cache"])
+            store.menus = MenuHandler.from_json(data.get("menus", {}))
             return store
@@ -0,0 +1,136 @@
+import bisect
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple, Iterator, Callable, ContextManager
+
+from prometheus_client import Counter, Gauge
+
+from todo_list_bot.file_io import TEMP_PREFIX
+
+listing_hits = Counter("todolistbot_directory_index_hits_total", "Number of directory listings served from the index")
+listing_misses = Counter("todolistbot_directory_index_misses_total", "Number of directory listings which required a scan")
+listing_updates = Counter(
+    "todolistbot_directory_index_updates_total",
+    "Number of incremental updates applied to cached directory listings"
+)
+cached_listings = Gauge("todolistbot_directory_index_size", "Number of directory listings held in the index")
+
+DIRECTORY_INITIAL = "📂"
+
+
+class DirectoryListing:
+
+    def __init__(self, path: str, mtime_ns: int, directories: List[str], files: List[str]):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.directories = directories
+        self.files = files
+        self.version = 0
+        self._initials: Optional[Dict[str, int]] = None
+        self._initials_version = -1
+
+    def __len__(self) -> int:
+        return len(self.directories) + len(self.files)
+
+    def page(self, start: int, end: int) -> Tuple[List[str], List[str]]:
+        # Directories are listed before files, so a page may span the end of one and the start of the other
+        directories = self.directories[start:end]
+        files = self.files[max(0, start - len(self.directories)):max(0, end - len(self.directories))]
+        return directories, files
+
+    @property
+    def initials(self) -> Dict[str, int]:
+        # The first position of each initial letter, built once per version of the listing
+        if self._initials_version != self.version:
+            # Directories are keyed apart from files, as they come first and would hide files with the same initial
+            initials = {}
+            for n, name in enumerate(self.directories):
+                initials.setdefault(DIRECTORY_INITIAL + name[:1].upper(), n)
+            for n, name in enumerate(self.files, len(self.directories)):
+                initials.setdefault(name[:1].upper(), n)
+            self._initials = initials
+            self._initials_version = self.version
+        return self._initials
+
+    @classmethod
+    def scan(cls, path: str) -> 'DirectoryListing':
+        mtime_ns = os.stat(path).st_mtime_ns
+        directories = []
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith(TEMP_PREFIX):
+                    continue
+                if entry.is_dir():
+                    directories.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+        return DirectoryListing(path, mtime_ns, sorted(directories), sorted(files))
+
+
+class DirectoryIndex:
+
+    def __init__(self) -> None:
+        self.store: Dict[str, DirectoryListing] = {}
+        self._lock = threading.Lock()
+        cached_listings.set_function(lambda: len(self.store))
+
+    def get(self, path: str) -> DirectoryListing:
+        key = os.path.abspath(path)
+        mtime_ns = os.stat(key).st_mtime_ns
+        with self._lock:
+            listing = self.store.get(key)
+            if listing is not None and listing.mtime_ns == mtime_ns:
+                listing_hits.inc()
+                return listing
+        listing_misses.inc()
+        listing = DirectoryListing.scan(key)
+        with self._lock:
+            self.store[key] = listing
+        return listing
+
+    def peek(self, path: str) -> Optional[DirectoryListing]:
+        with self._lock:
+            return self.store.get(os.path.abspath(path))
+
+    def replacing(self, path: str) -> ContextManager[None]:
+        # Saving a file replaces it through a temporary file, which moves the directory's mtime but not its entries
+        return self._updating(path, None)
+
+    def adding(self, path: str) -> ContextManager[None]:
+        return self._updating(path, lambda listing, name: self._insert(listing.files, name))
+
+    def removing(self, path: str) -> ContextManager[None]:
+        return self._updating(path, lambda listing, name: self._delete(listing.files, name))
+
+    @contextmanager
+    def _updating(self, path: str, update: Optional[Callable[[DirectoryListing, str], None]]) -> Iterator[None]:
+        parent, name = os.path.split(os.path.abspath(path))
+        mtime_ns = os.stat(parent).st_mtime_ns
+        yield
+        with self._lock:
+            listing = self.store.get(parent)
+            # Only a listing which was current before our change is still current after it, and any other is rescanned
+            if listing is None or listing.mtime_ns != mtime_ns:
+                return
+            if update is not None:
+                listing_updates.inc()
+                update(listing, name)
+                listing.version += 1
+            listing.mtime_ns = os.stat(parent).st_mtime_ns
+
+    # noinspection PyMethodMayBeStatic
+    def _insert(self, names: List[str], name: str) -> None:
+        index = bisect.bisect_left(names, name)
+        if index == len(names) or names[index] != name:
+            names.insert(index, name)
+
+    # noinspection PyMethodMayBeStatic
+    def _delete(self, names: List[str], name: str) -> None:
+        index = bisect.bisect_left(names, name)
+        if index < len(names) and names[index] == name:
+            del names[index]
+
+
+directory_index = DirectoryIndex()
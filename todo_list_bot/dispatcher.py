@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Callable, Awaitable, Any, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+from telethon.events import StopPropagation
+
+logger = logging.getLogger(__name__)
+
+updates_dispatched = Counter("todolistbot_dispatch_updates_total", "Number of updates queued for handling")
+updates_failed = Counter("todolistbot_dispatch_errors_total", "Number of updates whose handler raised an error")
+updates_blocked = Counter(
+    "todolistbot_dispatch_backpressure_total",
+    "Number of updates which waited for space because their chat's queue was full"
+)
+updates_queued = Gauge("todolistbot_dispatch_queued_updates", "Number of updates waiting for or being handled")
+chats_active = Gauge("todolistbot_dispatch_active_chats", "Number of chats with updates waiting for or being handled")
+chat_queue_depth = Gauge("todolistbot_dispatch_max_chat_queue_depth", "Number of updates queued in the busiest chat")
+handlers_running = Gauge("todolistbot_dispatch_running_handlers", "Number of handlers currently running")
+queue_wait_time = Histogram("todolistbot_dispatch_wait_seconds", "Time updates spent queued before being handled")
+
+Handler = Callable[[Any], Awaitable[None]]
+QueuedUpdate = Tuple[Handler, Any, float]
+
+
+class ChatDispatcher:
+    # Updates within a chat are handled one at a time in arrival order, and different chats are handled concurrently
+
+    def __init__(self, max_concurrent: int, max_queue: int) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queues: Dict[int, asyncio.Queue] = {}
+        # Updates waiting for space in each chat's queue
+        self.blocked: Dict[int, int] = {}
+        self.failures = 0
+        self._semaphore = None
+        chats_active.set_function(lambda: len(self.queues))
+        updates_queued.set_function(lambda: sum(queue.qsize() + 1 for queue in self.queues.values()))
+        chat_queue_depth.set_function(lambda: max((queue.qsize() for queue in self.queues.values()), default=0))
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created on first use, so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    async def submit(self, chat_id: int, handler: Handler, event: Any) -> None:
+        updates_dispatched.inc()
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = asyncio.Queue(self.max_queue)
+            self.queues[chat_id] = queue
+            asyncio.get_running_loop().create_task(self.work(chat_id, queue))
+        if not queue.full():
+            queue.put_nowait((handler, event, time.monotonic()))
+            return
+        updates_blocked.inc()
+        self.blocked[chat_id] = self.blocked.get(chat_id, 0) + 1
+        try:
+            await queue.put((handler, event, time.monotonic()))
+        finally:
+            self.blocked[chat_id] -= 1
+            if not self.blocked[chat_id]:
+                del self.blocked[chat_id]
+
+    async def join(self, chat_id: int) -> None:
+        queue = self.queues.get(chat_id)
+        if queue is not None:
+            await queue.join()
+
+    async def work(self, chat_id: int, queue: asyncio.Queue) -> None:
+        # Taking an update wakes a blocked submit, which only queues its update once it next runs, so wait for it
+        while not queue.empty() or self.blocked.get(chat_id):
+            handler, event, queued_at = await queue.get()
+            async with self.semaphore:
+                queue_wait_time.observe(time.monotonic() - queued_at)
+                with handlers_running.track_inprogress():
+                    await self.run(handler, event)
+            queue.task_done()
+        # Nothing is awaited between the empty check and here, so no update can be queued in between
+        del self.queues[chat_id]
+
+    async def run(self, handler: Handler, event: Any) -> None:
+        try:
+            await handler(event)
+        except StopPropagation:
+            pass
+        except Exception:
+            self.failures += 1
+            updates_failed.inc()
+            logger.exception("Error handling update in chat %s", event.chat_id)
@@ -0,0 +1,130 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, TYPE_CHECKING, List, Set
+
+from prometheus_client import Counter, Gauge
+
+from todo_list_bot.directory_index import directory_index
+from todo_list_bot.file_io import file_io
+from todo_list_bot.journal import journal
+from todo_list_bot.todo_list import TodoList, file_signature, TodoListConflict, SavePlan
+
+if TYPE_CHECKING:
+    from todo_list_bot.operations import TodoOperation
+
+cache_hits = Counter("todolistbot_document_cache_hits_total", "Number of todo list loads served from the document cache")
+cache_misses = Counter("todolistbot_document_cache_misses_total", "Number of todo list loads which required a parse")
+commit_conflicts = Counter(
+    "todolistbot_document_commit_conflicts_total",
+    "Number of times a todo list changed on disk during a commit, and the operation was replayed"
+)
+cached_documents = Gauge("todolistbot_document_cache_size", "Number of parsed todo lists held in the document cache")
+
+
+class DocumentListener(ABC):
+
+    @abstractmethod
+    def document_updated(self, todo: TodoList, structure_changed: bool = True) -> None:
+        # structure_changed is False when only item statuses have changed
+        raise NotImplementedError
+
+    @abstractmethod
+    def document_deleted(self, path: str) -> None:
+        raise NotImplementedError
+
+
+class DocumentCache:
+    def __init__(self) -> None:
+        self.store: Dict[str, TodoList] = {}
+        self.listeners: List[DocumentListener] = []
+        self._lock = threading.Lock()
+        cached_documents.set_function(lambda: len(self.store))
+
+    def add_listener(self, listener: DocumentListener) -> None:
+        self.listeners.append(listener)
+
+    def get(self, path: str) -> TodoList:
+        key = os.path.abspath(path)
+        signature = file_signature(key)
+        with self._lock:
+            todo = self.store.get(key)
+            if todo is not None and todo.signature == signature:
+                cache_hits.inc()
+                return todo
+        cache_misses.inc()
+        todo = TodoList(path)
+        todo.parse()
+        with self._lock:
+            self.store[key] = todo
+        for listener in self.listeners:
+            listener.document_updated(todo)
+        return todo
+
+    async def commit(
+            self,
+            path: str,
+            operation: 'TodoOperation',
+            max_attempts: int = 5,
+            undoes: Optional[str] = None
+    ) -> TodoList:
+        async with file_io.lock(path):
+            for attempt in range(max_attempts):
+                todo = await file_io.run(self.get, path)
+                try:
+                    undo = operation.inverse(todo) if journal.enabled else None
+                    operation.apply(todo)
+                except Exception:
+                    # Don't leave a partially applied operation in the shared tree
+                    self.remove(path)
+                    raise
+                plan = todo.render()
+                record_id = None
+                if journal.enabled and (plan.full or plan.lines):
+                    record_id = await file_io.run(journal.begin, todo, operation, undo, undoes)
+                try:
+                    await file_io.run(self.write, todo, plan)
+                except Exception as e:
+                    if record_id is not None:
+                        await file_io.run(journal.abort, path, record_id)
+                    if not isinstance(e, TodoListConflict):
+                        self.remove(path)
+                        raise
+                    # The file moved on under us: drop the stale tree, re-parse and replay the operation
+                    commit_conflicts.inc()
+                    self.remove(path)
+                    if attempt == max_attempts - 1:
+                        raise
+                else:
+                    if record_id is not None:
+                        await file_io.run(journal.compact, path)
+                    # Still under the file's lock, so no other commit changes the tree while listeners read it
+                    for listener in self.listeners:
+                        await file_io.run(listener.document_updated, todo, plan.full)
+                    return todo
+
+    # noinspection PyMethodMayBeStatic
+    def write(self, todo: TodoList, plan: SavePlan) -> None:
+        with directory_index.replacing(todo.path):
+            todo.write(plan)
+
+    def peek(self, path: str) -> Optional[TodoList]:
+        with self._lock:
+            return self.store.get(os.path.abspath(path))
+
+    def remove(self, path: str) -> None:
+        with self._lock:
+            self.store.pop(os.path.abspath(path), None)
+
+    def retain(self, keys: Set[str]) -> None:
+        # Drops parsed todo lists not in the given absolute paths
+        with self._lock:
+            self.store = {key: todo for key, todo in self.store.items() if key in keys}
+
+    def deleted(self, path: str) -> None:
+        self.remove(path)
+        for listener in self.listeners:
+            listener.document_deleted(path)
+
+
+document_cache = DocumentCache()
@@ -0,0 +1,77 @@
+import asyncio
+import os
+import time
+from typing import TYPE_CHECKING, Set
+
+from prometheus_client import Counter
+
+from todo_list_bot.document_cache import document_cache
+
+if TYPE_CHECKING:
+    from todo_list_bot.bot import ViewerStore
+    from todo_list_bot.persistence import ViewerPersistence
+
+viewers_evicted = Counter("todolistbot_viewers_evicted_total", "Number of chat viewers dropped from memory", ["reason"])
+trees_released = Counter(
+    "todolistbot_viewer_trees_released_total",
+    "Number of times a viewer has dropped its parsed todo list to stay within the tree budget"
+)
+
+
+class IdleEvictor:
+    # Drops viewers which are idle past the TTL or beyond the viewer budget, and parsed todo lists beyond the tree
+    # budget. Both are loaded again on the chat's next update.
+    interval = 60
+
+    def __init__(
+            self,
+            store: 'ViewerStore',
+            persistence: 'ViewerPersistence',
+            idle_ttl: float,
+            max_viewers: int,
+            max_trees: int
+    ) -> None:
+        self.store = store
+        self.persistence = persistence
+        self.idle_ttl = idle_ttl
+        self.max_viewers = max_viewers
+        self.max_trees = max_trees
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.evict()
+
+    def evict(self) -> None:
+        self.evict_viewers()
+        self.release_trees()
+
+    def evict_viewers(self) -> None:
+        now = time.monotonic()
+        for chat_id in list(self.store.store.keys()):
+            if now - self.store.last_active[chat_id] > self.idle_ttl:
+                reason = "idle"
+            elif len(self.store.store) > self.max_viewers:
+                reason = "budget"
+            else:
+                # Viewers are ordered by last activity, so the rest are more recent
+                return
+            # Unsaved viewers are kept until their record is written
+            if chat_id in self.persistence.dirty:
+                continue
+            self.store.evict(chat_id)
+            viewers_evicted.labels(reason=reason).inc()
+
+    def release_trees(self) -> None:
+        # The most recently active viewers keep their todo lists, and other lists are dropped from the document cache
+        kept: Set[str] = set()
+        for viewer in reversed(list(self.store.store.values())):
+            if viewer.current_todo is None:
+                continue
+            key = os.path.abspath(viewer.current_todo.path)
+            if key in kept or len(kept) < self.max_trees:
+                kept.add(key)
+            else:
+                viewer.release_todo()
+                trees_released.inc()
+        document_cache.retain(kept)
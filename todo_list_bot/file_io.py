@@ -0,0 +1,93 @@
+import asyncio
+import os
+import stat
+import tempfile
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, TypeVar, Iterator, BinaryIO
+
+from prometheus_client import Counter, Gauge
+
+T = TypeVar("T")
+TEMP_PREFIX = ".tmp-"
+
+io_tasks = Counter("todolistbot_io_tasks_total", "Number of blocking file operations run on the I/O thread pool")
+io_queued = Gauge("todolistbot_io_tasks_queued", "Number of file operations waiting for or running on the I/O thread pool")
+io_wait_time = Counter(
+    "todolistbot_io_wait_seconds_total",
+    "Total time file operations spent waiting for their per-file lock"
+)
+bytes_read = Counter("todolistbot_file_read_bytes_total", "Number of bytes read from todo lists and state files")
+bytes_written = Counter("todolistbot_file_written_bytes_total", "Number of bytes written to todo lists and state files")
+
+
+class FileIO:
+    def __init__(self, max_workers: int = 4) -> None:
+        self.max_workers = max_workers
+        self._executor = None
+        self._locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+    def configure(self, max_workers: int) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.max_workers = max_workers
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="todolistbot-io")
+        return self._executor
+
+    def lock(self, key: str) -> asyncio.Lock:
+        key = os.path.abspath(key)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        io_tasks.inc()
+        io_queued.inc()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            io_queued.dec()
+
+    async def run_ordered(self, key: str, func: Callable[..., T], *args) -> T:
+        # asyncio.Lock wakes waiters in FIFO order, so operations on the same key complete in the order requested
+        lock = self.lock(key)
+        wait_start = time.monotonic()
+        async with lock:
+            io_wait_time.inc(time.monotonic() - wait_start)
+            return await self.run(func, *args)
+
+
+@contextmanager
+def atomic_open(path: str) -> Iterator[BinaryIO]:
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if os.path.exists(path):
+                os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+            yield f
+            bytes_written.inc(f.tell())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def atomic_write(path: str, text: str) -> None:
+    with atomic_open(path) as f:
+        f.write(text.encode())
+
+
+file_io = FileIO()
+
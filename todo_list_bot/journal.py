@@ -0,0 +1,166 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import uuid
+from typing import Dict, List, Optional
+
+from prometheus_client import Counter
+
+from todo_list_bot.file_io import bytes_read, bytes_written
+from todo_list_bot.operations import TodoOperation, OperationError, operation_from_json
+from todo_list_bot.todo_list import TodoList, file_signature, TodoListConflict
+
+logger = logging.getLogger(__name__)
+
+journal_records = Counter("todolistbot_journal_records_total", "Number of operations recorded in todo list journals")
+journal_aborts = Counter("todolistbot_journal_aborts_total", "Number of journal records whose write did not happen")
+journal_compactions = Counter("todolistbot_journal_compactions_total", "Number of times a journal has been compacted")
+journal_replays = Counter(
+    "todolistbot_journal_replays_total",
+    "Number of operations replayed on startup, as the bot stopped before writing them to the todo list"
+)
+
+
+def undoable_records(records: List[Dict]) -> List[Dict]:
+    # Undo records, and records which were undone or never saved, can't be undone
+    aborted = set(record["aborts"] for record in records if "aborts" in record)
+    skipped = aborted | set(record.get("undoes") for record in records if record.get("id") not in aborted)
+    return [
+        record for record in records
+        if "op" in record and record["undo"] is not None and record["undoes"] is None and record["id"] not in skipped
+    ]
+
+
+class OperationJournal:
+    # An append-only log per todo list, written before each save of the markdown file, which still happens on every
+    # edit. Every record holds the operation, its inverse for undo, and the list's signature before the save, so a
+    # record whose save never happened can be replayed.
+
+    def __init__(self, directory: Optional[str] = None, max_records: int = 100) -> None:
+        self.directory = directory
+        self.max_records = max_records
+        self.counts: Dict[str, int] = {}
+
+    def configure(self, directory: Optional[str], max_records: int) -> None:
+        self.directory = directory
+        self.max_records = max_records
+        self.counts.clear()
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def journal_path(self, path: str) -> str:
+        name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.directory, f"{name}.jsonl")
+
+    # noinspection PyMethodMayBeStatic
+    def read(self, journal_path: str) -> List[Dict]:
+        try:
+            with open(journal_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        bytes_read.inc(len(data))
+        records = []
+        for line in data.splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A line cut short by a crash is never followed by a complete one, as it was never synced
+                break
+        return records
+
+    def append(self, journal_path: str, record: Dict) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        data = (json.dumps(record) + "\n").encode()
+        with open(journal_path, "ab") as f:
+            # Worker processes can share a todo list, so hold a lock to keep their records whole
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # Not synced: a record only needs to outlive the bot's process, as the save which follows it is synced
+            f.write(data)
+        bytes_written.inc(len(data))
+        if journal_path not in self.counts:
+            self.counts[journal_path] = len(self.read(journal_path))
+        else:
+            self.counts[journal_path] += 1
+
+    def begin(
+            self,
+            todo: TodoList,
+            operation: TodoOperation,
+            undo: Optional[TodoOperation],
+            undoes: Optional[str] = None
+    ) -> str:
+        record_id = uuid.uuid4().hex
+        self.append(self.journal_path(todo.path), {
+            "id": record_id,
+            "path": todo.path,
+            "signature": todo.signature,
+            "op": operation.to_json(),
+            "undo": undo.to_json() if undo is not None else None,
+            "undoes": undoes
+        })
+        journal_records.inc()
+        return record_id
+
+    def abort(self, path: str, record_id: str) -> None:
+        journal_aborts.inc()
+        self.append(self.journal_path(path), {"aborts": record_id})
+
+    def last_undoable(self, path: str) -> Optional[Dict]:
+        records = undoable_records(self.read(self.journal_path(path)))
+        return records[-1] if records else None
+
+    def compact(self, path: str) -> None:
+        # Only called after a save succeeds, so no record is waiting to be replayed and old ones can be dropped
+        journal_path = self.journal_path(path)
+        if self.counts.get(journal_path, 0) <= 2 * self.max_records:
+            return
+        with open(journal_path, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            kept = undoable_records(self.read(journal_path))[-self.max_records:]
+            data = "".join(json.dumps(record) + "\n" for record in kept).encode()
+            f.seek(0)
+            f.truncate()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        bytes_written.inc(len(data))
+        journal_compactions.inc()
+        self.counts[journal_path] = len(kept)
+
+    def recover(self) -> None:
+        if not self.enabled or not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".jsonl"):
+                self.recover_journal(os.path.join(self.directory, filename))
+
+    def recover_journal(self, journal_path: str) -> None:
+        records = self.read(journal_path)
+        if not records or "op" not in records[-1]:
+            return
+        record = records[-1]
+        path = record["path"]
+        try:
+            if record["signature"] is None or file_signature(path) != tuple(record["signature"]):
+                # Saving replaces the file, so a changed signature means the save happened
+                return
+            todo = TodoList(path)
+            todo.parse()
+            operation_from_json(record["op"]).apply(todo)
+            todo.write(todo.render())
+        except FileNotFoundError:
+            return
+        except (OperationError, TodoListConflict):
+            logger.warning("Could not replay journal record %s for %s", record["id"], path, exc_info=True)
+            self.abort(path, record["id"])
+            return
+        journal_replays.inc()
+        logger.info("Replayed unsaved operation %s on %s", record["id"], path)
+
+
+journal = OperationJournal()
@@ -1,37 +1,47 @@
-from abc import ABC, abstractmethod
-from typing import List, Dict
+import time
+from typing import Dict, Optional
 
+from telethon import Button
 
-class Menu(ABC):
-    @abstractmethod
-    @property
-    def text(self) -> str:
-        return None
+from todo_list_bot.response import Response
 
-    @abstractmethod
-    @property
-    def buttons(self) -> List[List[Button]]:
-        return None
 
-    @abstractmethod
-    def handle_callback(self, callback_data: bytes) -> None:
-        return None
+class SentMenu:
+    __slots__ = ("chat_id", "msg_id", "response", "last_used")
 
+    def __init__(self, chat_id: int, msg_id: int, response: Response, last_used: Optional[float] = None):
+        self.chat_id = chat_id
+        self.msg_id = msg_id
+        self.response = response
+        self.last_used = last_used if last_used is not None else time.time()
 
-class PersistentMenu(Menu, ABC):
-    @abstractmethod
-    def to_json(self) -> Dict:
-        return None
+    def touch(self) -> None:
+        self.last_used = time.time()
 
-    @classmethod
-    @abstractmethod
-    def from_json(cls, data: Dict) -> 'PersistentMenu':
-        raise NotImplementedError
+    def expired(self, ttl: float, now: float) -> bool:
+        return now - self.last_used > ttl
 
+    def to_json(self) -> Dict:
+        # Buttons are kept as [text, data] pairs, as every menu holds a full page set of them
+        data = {
+            "msg_id": self.msg_id,
+            "last_used": int(self.last_used),
+            "page": self.response.page,
+            "text": self.response.text,
+            "buttons": [[button.text, button.data.decode()] for button in self.response.all_buttons]
+        }
+        if self.response.footer is not None:
+            data["footer"] = [[[button.text, button.data.decode()] for button in row] for row in self.response.footer]
+        return data
 
-class SentMenu:
-    menu: Menu
-    msg: Message
-    ?
-    chat_id: int
-    msg_id: int
+    @classmethod
+    def from_json(cls, chat_id: int, data: Dict) -> 'SentMenu':
+        response = Response(
+            data["text"],
+            [Button.inline(text, button_data) for text, button_data in data["buttons"]],
+            [
+                [Button.inline(text, button_data) for text, button_data in row] for row in data["footer"]
+            ] if "footer" in data else None
+        )
+        response.page = data["page"]
+        return SentMenu(chat_id, data["msg_id"], response, data["last_used"])
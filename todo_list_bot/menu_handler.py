@@ -1,26 +1,114 @@
-from menu import Menu, SentMenu
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, List
+
+from prometheus_client import Counter, Gauge
+from telethon.events import StopPropagation
+
+from todo_list_bot.menu import SentMenu
+from todo_list_bot.response import Response
+
+menu_hits = Counter("todolistbot_menu_cache_hits_total", "Number of page buttons served from the menu cache")
+menu_misses = Counter(
+    "todolistbot_menu_cache_misses_total",
+    "Number of page buttons pressed on a message which is no longer in the menu cache"
+)
+menu_evictions = Counter("todolistbot_menu_cache_evictions_total", "Number of menus dropped from the cache", ["reason"])
+menu_entries = Gauge("todolistbot_menu_cache_entries", "Number of sent menus held in the menu cache")
+
+MenuKey = Tuple[int, int]
 
 
 class MenuHandler:
-    def __init__(self, client):
-        self.client = client
-        self.cache = {}
-
-    def add_menu(self, sent_menu: 'SentMenu'):
-        if sent_menu.chat_id not in self.cache:
-            self.cache[sent_menu.chat_id] = {}
-        self.cache[sent_menu.chat_id][sent_menu.msg_id] = sent_menu
-
-    def send_menu(self, menu: 'Menu'):
-        msg = self.client.send_message(menu)
-        sent_menu = SentMenu(menu, msg)
-        self.add_menu(sent_menu)
-
-    def handle_callback(self, callback):
-        chat_id = callback.chat_id
-        msg_id = callback.msg_id
-        if chat_id not in self.cache or msg_id not in self.cache[chat_id]:
-            event.edit_message(buttons=None)
-            event.answer("Sorry this menu was not recognised.")
-        self.cache[chat_id][msg_id].handle_callback(callback)
-        event.answer()
+    # Keeps the full response behind each sent message with more than one page of buttons, so that its page buttons
+    # keep working. Least recently used menus are dropped past max_entries, and any unused for ttl seconds.
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 7 * 24 * 60 * 60) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache: OrderedDict[MenuKey, SentMenu] = OrderedDict()
+        self.chats: Dict[int, Dict[int, SentMenu]] = {}
+
+    def add_menu(self, sent_menu: SentMenu) -> None:
+        key = (sent_menu.chat_id, sent_menu.msg_id)
+        self.cache[key] = sent_menu
+        self.cache.move_to_end(key)
+        self.chats.setdefault(sent_menu.chat_id, {})[sent_menu.msg_id] = sent_menu
+
+    def add(self, chat_id: int, msg_id: int, response: Response) -> None:
+        if response.pages is None or response.pages < 2:
+            # Single page messages have no page buttons, and an edited message no longer shows an older menu
+            self.remove(chat_id, msg_id)
+            return
+        self.add_menu(SentMenu(chat_id, msg_id, response))
+        self.evict()
+
+    def get(self, chat_id: int, msg_id: int) -> Optional[SentMenu]:
+        sent_menu = self.cache.get((chat_id, msg_id))
+        if sent_menu is None:
+            return None
+        if sent_menu.expired(self.ttl, time.time()):
+            menu_evictions.labels(reason="expired").inc()
+            self.remove(chat_id, msg_id)
+            return None
+        sent_menu.touch()
+        self.cache.move_to_end((chat_id, msg_id))
+        return sent_menu
+
+    def remove(self, chat_id: int, msg_id: int) -> None:
+        if self.cache.pop((chat_id, msg_id), None) is None:
+            return
+        chat_menus = self.chats[chat_id]
+        del chat_menus[msg_id]
+        if not chat_menus:
+            del self.chats[chat_id]
+
+    def evict(self) -> None:
+        now = time.time()
+        while self.cache:
+            chat_id, msg_id = key = next(iter(self.cache))
+            if self.cache[key].expired(self.ttl, now):
+                menu_evictions.labels(reason="expired").inc()
+            elif len(self.cache) > self.max_entries:
+                menu_evictions.labels(reason="capacity").inc()
+            else:
+                return
+            self.remove(chat_id, msg_id)
+
+    def handle_callback(self, chat_id: int, msg_id: int, callback_data: bytes) -> Optional[Response]:
+        sent_menu = self.get(chat_id, msg_id)
+        if sent_menu is None:
+            menu_misses.inc()
+            return None
+        menu_hits.inc()
+        page_num = int(callback_data.split(b":")[1].decode())
+        response = sent_menu.response
+        if page_num > response.pages:
+            raise StopPropagation
+        response.page = page_num
+        return response
+
+    def chat_to_json(self, chat_id: int) -> List[Dict]:
+        return [sent_menu.to_json() for sent_menu in self.chats.get(chat_id, {}).values()]
+
+    def load_chat_json(self, chat_id: int, data: List[Dict]) -> None:
+        for menu_data in data:
+            self.add_menu(SentMenu.from_json(chat_id, menu_data))
+
+    def loaded(self) -> None:
+        # Chats are loaded in no particular order, so restore the least recently used order before evicting
+        self.cache = OrderedDict(sorted(self.cache.items(), key=lambda item: item[1].last_used))
+        self.evict()
+
+    def to_json(self) -> Dict:
+        return {
+            str(chat_id): self.chat_to_json(chat_id) for chat_id in self.chats
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'MenuHandler':
+        handler = MenuHandler()
+        for chat_id, chat_data in data.items():
+            handler.load_chat_json(int(chat_id), chat_data)
+        handler.loaded()
+        return handler
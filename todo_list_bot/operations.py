@@ -0,0 +1,508 @@
+from abc import ABC, abstractmethod
+from typing import List, Dict, Optional, Tuple
+
+from todo_list_bot.todo_list import TodoList, TodoContainer, TodoStatus, TodoItem, TodoSection, line_is_empty, \
+    line_is_item, line_is_section
+
+
+class OperationError(Exception):
+    pass
+
+
+def snapshot_node(node: TodoContainer) -> Dict:
+    if isinstance(node, TodoItem):
+        return {
+            "status": node.status.value,
+            "name": node.name,
+            "depth": node.depth,
+            "items": [snapshot_node(item) for item in node.sub_items]
+        }
+    return {
+        "title": node.title,
+        "depth": node.depth,
+        "items": [snapshot_node(item) for item in node.root_items],
+        "sections": [snapshot_node(section) for section in node.sub_sections]
+    }
+
+
+def restore_item(snapshot: Dict, section: TodoSection, parent_item: Optional[TodoItem], depth_offset: int) -> TodoItem:
+    item = TodoItem(
+        TodoStatus(snapshot["status"]), snapshot["name"], snapshot["depth"] + depth_offset, section, parent_item
+    )
+    for sub_item in snapshot["items"]:
+        restore_item(sub_item, section, item, depth_offset)
+    return item
+
+
+def restore_section(snapshot: Dict, parent: TodoSection, depth_offset: int) -> TodoSection:
+    section = TodoSection(snapshot["title"], snapshot["depth"] + depth_offset, parent)
+    for item in snapshot["items"]:
+        restore_item(item, section, None, 0)
+    for sub_section in snapshot["sections"]:
+        restore_section(sub_section, section, depth_offset)
+    return section
+
+
+def insert_snapshot(snapshot: Dict, target: TodoContainer) -> None:
+    # Indent the copy to sit directly under the target, the same as appended text would be
+    if "name" in snapshot:
+        if isinstance(target, TodoItem):
+            restore_item(snapshot, target.parent_section, target, target.depth + 2 - snapshot["depth"])
+        else:
+            restore_item(snapshot, target, None, 2 - snapshot["depth"])
+        return
+    if isinstance(target, TodoItem):
+        raise OperationError("Cannot add sections under an item")
+    if snapshot["depth"] != 0:
+        restore_section(snapshot, target, target.depth + 1 - snapshot["depth"])
+        return
+    # A whole todo list is added as the contents of the target
+    for item in snapshot["items"]:
+        restore_item(item, target, None, 0)
+    for section in snapshot["sections"]:
+        restore_section(section, target, target.depth + 1 - section["depth"])
+
+
+def sibling_index(node: TodoContainer) -> int:
+    if isinstance(node, TodoItem):
+        siblings = node.parent_item.sub_items if node.parent_item else node.parent_section.root_items
+        return siblings.index(node)
+    return node.parent_section.sub_sections.index(node)
+
+
+def child_counts(node: TodoContainer) -> Tuple[int, int]:
+    if isinstance(node, TodoItem):
+        return len(node.sub_items), 0
+    return len(node.root_items), len(node.sub_sections)
+
+
+def resolve_node(todo: TodoList, path: List[str], node_id: Optional[int] = None) -> Optional[TodoContainer]:
+    # The node ID tells apart entries with the same name, but only in the tree it came from. Once the list has been
+    # parsed again, such as when replaying an operation, the path is used instead
+    node = todo.node(node_id)
+    if node is not None and node.path == path:
+        return node
+    return todo.find(path)
+
+
+class TodoOperation(ABC):
+
+    def __init__(self, path: List[str], node_id: Optional[int] = None):
+        self.path = list(path)
+        self.node_id = node_id
+
+    def find_target(self, todo: TodoList) -> TodoContainer:
+        target = resolve_node(todo, self.path, self.node_id)
+        if target is None:
+            raise OperationError("That todo list entry no longer exists.")
+        return target
+
+    @abstractmethod
+    def apply(self, todo: TodoList) -> None:
+        raise NotImplementedError
+
+    def inverse(self, todo: TodoList) -> Optional['TodoOperation']:
+        # Called before apply, returns an operation which undoes this one, or None if it can't be undone
+        return None
+
+    def to_json(self) -> Dict:
+        return {
+            "type": type(self).__name__,
+            "path": self.path,
+            "node_id": self.node_id
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'TodoOperation':
+        return cls(data["path"], data.get("node_id"))
+
+
+def restore_point(node: TodoContainer) -> 'RestoreNode':
+    # Undoes any change within the node, by putting a copy of it back in its current place
+    if node.parent is None:
+        return RestoreNode([], 0, snapshot_node(node), True)
+    return RestoreNode(node.parent.path, sibling_index(node), snapshot_node(node), True, node.parent.node_id)
+
+
+class SetStatus(TodoOperation):
+
+    def __init__(self, path: List[str], status: TodoStatus, node_id: Optional[int] = None):
+        super().__init__(path, node_id)
+        self.status = status
+
+    def apply(self, todo: TodoList) -> None:
+        item = self.find_target(todo)
+        if not isinstance(item, TodoItem):
+            raise OperationError("Item not currently selected.")
+        item.status = self.status
+
+    def inverse(self, todo: TodoList) -> Optional[TodoOperation]:
+        item = self.find_target(todo)
+        if not isinstance(item, TodoItem):
+            return None
+        return SetStatus(self.path, item.status, item.node_id)
+
+    def to_json(self) -> Dict:
+        return dict(super().to_json(), status=self.status.value)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'SetStatus':
+        return cls(data["path"], TodoStatus(data["status"]), data.get("node_id"))
+
+
+class RemoveNode(TodoOperation):
+
+    def apply(self, todo: TodoList) -> None:
+        self.find_target(todo).remove()
+
+    def inverse(self, todo: TodoList) -> Optional[TodoOperation]:
+        node = self.find_target(todo)
+        if node.parent is None:
+            return None
+        return RestoreNode(node.parent.path, sibling_index(node), snapshot_node(node), False, node.parent.node_id)
+
+
+class SetSubtreeStatus(TodoOperation):
+
+    def __init__(self, path: List[str], status: TodoStatus, node_id: Optional[int] = None):
+        super().__init__(path, node_id)
+        self.status = status
+
+    def apply(self, todo: TodoList) -> None:
+        for node in self.find_target(todo).walk():
+            if isinstance(node, TodoItem):
+                node.status = self.status
+
+    def inverse(self, todo: TodoList) -> Optional[TodoOperation]:
+        target = self.find_target(todo)
+        statuses = [node.status.value for node in target.walk() if isinstance(node, TodoItem)]
+        return RestoreStatuses(self.path, statuses, target.node_id)
+
+    def to_json(self) -> Dict:
+        return dict(super().to_json(), status=self.status.value)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'SetSubtreeStatus':
+        return cls(data["path"], TodoStatus(data["status"]), data.get("node_id"))
+
+
+class ClearCompleted(TodoOperation):
+
+    def apply(self, todo: TodoList) -> None:
+        self.clear(self.find_target(todo))
+
+    def inverse(self, todo: TodoList) -> Optional[TodoOperation]:
+        return restore_point(self.find_target(todo))
+
+    def clear(self, node: TodoContainer) -> None:
+        for child in list(node.children()):
+            if isinstance(child, TodoItem) and child.status == TodoStatus.COMPLETE:
+                child.remove()
+            else:
+                self.clear(child)
+
+
+class InsertSubtree(TodoOperation):
+
+    def __init__(self, path: List[str], snapshot: Dict, node_id: Optional[int] = None):
+        super().__init__(path, node_id)
+        self.snapshot = snapshot
+
+    def apply(self, todo: TodoList) -> None:
+        insert_snapshot(self.snapshot, self.find_target(todo))
+
+    def inverse(self, todo: TodoList) -> Optional[TodoOperation]:
+        # New nodes are always added after the target's existing children
+        target = self.find_target(todo)
+        return TrimChildren(self.path, *child_counts(target), target.node_id)
+
+    def to_json(self) -> Dict:
+        return dict(super().to_json(), snapshot=self.snapshot)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'InsertSubtree':
+        return cls(data["path"], data["snapshot"], data.get("node_id"))
+
+
+class MoveNode(TodoOperation):
+
+    def __init__(
+            self,
+            path: List[str],
+            destination: List[str],
+            node_id: Optional[int] = None,
+            destination_id: Optional[int] = None
+    ):
+        super().__init__(path, node_id)
+        self.destination = list(destination)
+        self.destination_id = destination_id
+
+    def find_destination(self, todo: TodoList) -> Optional[TodoContainer]:
+        return resolve_node(todo, self.destination, self.destination_id)
+
+    def apply(self, todo: TodoList) -> None:
+        node = self.find_target(todo)
+        if node.parent is None:
+            raise OperationError("Cannot move the whole todo list.")
+        target = self.find_destination(todo)
+        if target is None:
+            raise OperationError("That todo list entry no longer exists.")
+        ancestor = target
+        while ancestor is not None:
+            if ancestor is node:
+                raise OperationError("Cannot move an entry inside itself.")
+            ancestor = ancestor.parent
+        snapshot = snapshot_node(node)
+        node.remove()
+        insert_snapshot(snapshot, target)
+
+    def inverse(self, todo: TodoList) -> Optional[TodoOperation]:
+        node = self.find_target(todo)
+        target = self.find_destination(todo)
+        if node.parent is None or target is None:
+            return None
+        item_count, section_count = child_counts(target)
+        if target is node.parent:
+            # The node is removed from the destination before its copy is added
+            if isinstance(node, TodoItem):
+                item_count -= 1
+            else:
+                section_count -= 1
+        return OperationSequence([
+            TrimChildren(self.destination, item_count, section_count, target.node_id),
+            RestoreNode(node.parent.path, sibling_index(node), snapshot_node(node), False, node.parent.node_id)
+        ])
+
+    def to_json(self) -> Dict:
+        return dict(super().to_json(), destination=self.destination, destination_id=self.destination_id)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'MoveNode':
+        return cls(data["path"], data["destination"], data.get("node_id"), data.get("destination_id"))
+
+
+class AppendLines(TodoOperation):
+
+    def __init__(self, path: List[str], lines: List[str], node_id: Optional[int] = None):
+        super().__init__(path, node_id)
+        self.lines = list(lines)
+
+    def apply(self, todo: TodoList) -> None:
+        self.append_to(todo, self.find_target(todo))
+
+    def inverse(self, todo: TodoList) -> Optional[TodoOperation]:
+        # Parsed lines are always added after the target's existing children
+        target = self.find_target(todo)
+        return TrimChildren(self.path, *child_counts(target), target.node_id)
+
+    def to_json(self) -> Dict:
+        return dict(super().to_json(), lines=self.lines)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'AppendLines':
+        return cls(data["path"], data["lines"], data.get("node_id"))
+
+    def append_to(self, todo: TodoList, section: TodoContainer) -> None:
+        todo_contents = [line for line in self.lines if not line_is_empty(line)]
+        # Ensure items are minimally indented
+        items = [line for line in todo_contents if line_is_item(line)]
+        if items:
+            min_item_depth = min(len(line) - len(line.lstrip("- ")) for line in items)
+            if min_item_depth < 2:
+                add_depth = 2 - min_item_depth
+                for n in range(len(todo_contents)):
+                    if line_is_item(todo_contents[n]):
+                        todo_contents[n] = "-" * add_depth + todo_contents[n]
+        # Add to a section
+        if isinstance(section, TodoSection):
+            # Ensure subsections are minimally indented
+            base_depth = section.depth
+            sections = [line for line in todo_contents if line_is_section(line)]
+            if sections:
+                lowest_section = min(len(line) - len(line.lstrip("#")) for line in sections)
+                if lowest_section <= base_depth:
+                    for n in range(len(todo_contents)):
+                        if line_is_section(todo_contents[n]):
+                            todo_contents[n] = "#" * base_depth + todo_contents[n]
+            todo.parse_lines(todo_contents, section)
+            return
+        # Append sub items to an item
+        if isinstance(section, TodoItem):
+            if any(line for line in todo_contents if line_is_section(line)):
+                raise OperationError("Cannot add sections under an item")
+            # Ensure sub items are minimally indented
+            base_depth = section.depth
+            min_depth = min(len(line) - len(line.lstrip(" -")) for line in todo_contents)
+            add_depth = base_depth - min_depth + 2
+            for n in range(len(todo_contents)):
+                if add_depth > 0:
+                    todo_contents[n] = "-" * add_depth + todo_contents[n]
+                elif add_depth < 0:
+                    todo_contents[n] = todo_contents[n][-add_depth:]
+            current_item = section
+            parent_section = section.parent_section
+            for line in todo_contents:
+                current_item = todo.parse_item(line, parent_section, current_item)
+            return
+        raise OperationError("What")
+
+
+class ReplaceNode(AppendLines):
+
+    def apply(self, todo: TodoList) -> None:
+        # Remove the current section and add the replacement to its parent
+        del_section = self.find_target(todo)
+        section = del_section.parent
+        del_section.remove()
+        if section is None:
+            section = todo.clear()
+        self.append_to(todo, section)
+
+    def inverse(self, todo: TodoList) -> Optional[TodoOperation]:
+        node = self.find_target(todo)
+        parent = node.parent
+        if parent is None:
+            return restore_point(node)
+        item_count, section_count = child_counts(parent)
+        if isinstance(node, TodoItem):
+            item_count -= 1
+        else:
+            section_count -= 1
+        return OperationSequence([
+            TrimChildren(parent.path, item_count, section_count, parent.node_id),
+            RestoreNode(parent.path, sibling_index(node), snapshot_node(node), False, parent.node_id)
+        ])
+
+
+class RestoreNode(TodoOperation):
+    # Puts a snapshot back as the child at the given index of the node at the path, or as the whole list if it is one
+
+    def __init__(self, path: List[str], index: int, snapshot: Dict, replace: bool, node_id: Optional[int] = None):
+        super().__init__(path, node_id)
+        self.index = index
+        self.snapshot = snapshot
+        self.replace = replace
+
+    def apply(self, todo: TodoList) -> None:
+        if "title" in self.snapshot and self.snapshot["depth"] == 0:
+            root = todo.clear()
+            for item in self.snapshot["items"]:
+                restore_item(item, root, None, 0)
+            for section in self.snapshot["sections"]:
+                restore_section(section, root, 0)
+            return
+        parent = self.find_target(todo)
+        is_item = "name" in self.snapshot
+        if not is_item and isinstance(parent, TodoItem):
+            raise OperationError("Cannot add sections under an item")
+        if self.replace:
+            siblings = self.siblings(parent, is_item)
+            if self.index >= len(siblings):
+                raise OperationError("That todo list entry no longer exists.")
+            siblings[self.index].remove()
+        if self.index > len(self.siblings(parent, is_item)):
+            raise OperationError("That todo list entry has changed since.")
+        if not is_item:
+            restore_section(self.snapshot, parent, 0)
+        elif isinstance(parent, TodoItem):
+            restore_item(self.snapshot, parent.parent_section, parent, 0)
+        else:
+            restore_item(self.snapshot, parent, None, 0)
+        # The restored node was added last, so move it back to its old place
+        siblings = self.siblings(parent, is_item)
+        siblings.insert(self.index, siblings.pop())
+        parent._child_index = None
+
+    def siblings(self, parent: TodoContainer, is_item: bool) -> List[TodoContainer]:
+        if isinstance(parent, TodoItem):
+            return parent._sub_items if parent._sub_items is not None else []
+        return parent.root_items if is_item else parent.sub_sections
+
+    def to_json(self) -> Dict:
+        return dict(super().to_json(), index=self.index, snapshot=self.snapshot, replace=self.replace)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'RestoreNode':
+        return cls(data["path"], data["index"], data["snapshot"], data["replace"], data.get("node_id"))
+
+
+class TrimChildren(TodoOperation):
+    # Removes children added after the given number of items and sections
+
+    def __init__(self, path: List[str], item_count: int, section_count: int, node_id: Optional[int] = None):
+        super().__init__(path, node_id)
+        self.item_count = item_count
+        self.section_count = section_count
+
+    def apply(self, todo: TodoList) -> None:
+        node = self.find_target(todo)
+        if isinstance(node, TodoItem):
+            extra = list(node.sub_items[self.item_count:])
+        else:
+            extra = node.root_items[self.item_count:] + node.sub_sections[self.section_count:]
+        for child in extra:
+            child.remove()
+
+    def to_json(self) -> Dict:
+        return dict(super().to_json(), item_count=self.item_count, section_count=self.section_count)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'TrimChildren':
+        return cls(data["path"], data["item_count"], data["section_count"], data.get("node_id"))
+
+
+class RestoreStatuses(TodoOperation):
+
+    def __init__(self, path: List[str], statuses: List[str], node_id: Optional[int] = None):
+        super().__init__(path, node_id)
+        self.statuses = list(statuses)
+
+    def apply(self, todo: TodoList) -> None:
+        items = [node for node in self.find_target(todo).walk() if isinstance(node, TodoItem)]
+        if len(items) != len(self.statuses):
+            raise OperationError("That todo list entry has changed since.")
+        for item, status in zip(items, self.statuses):
+            item.status = TodoStatus(status)
+
+    def to_json(self) -> Dict:
+        return dict(super().to_json(), statuses=self.statuses)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'RestoreStatuses':
+        return cls(data["path"], data["statuses"], data.get("node_id"))
+
+
+class OperationSequence(TodoOperation):
+
+    def __init__(self, operations: List[TodoOperation]):
+        super().__init__([])
+        self.operations = list(operations)
+
+    def apply(self, todo: TodoList) -> None:
+        for operation in self.operations:
+            operation.apply(todo)
+
+    def to_json(self) -> Dict:
+        return {
+            "type": type(self).__name__,
+            "operations": [operation.to_json() for operation in self.operations]
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'OperationSequence':
+        return cls([operation_from_json(operation) for operation in data["operations"]])
+
+
+OPERATION_TYPES = {
+    cls.__name__: cls for cls in [
+        SetStatus, RemoveNode, SetSubtreeStatus, ClearCompleted, InsertSubtree, MoveNode, AppendLines, ReplaceNode,
+        RestoreNode, TrimChildren, RestoreStatuses, OperationSequence
+    ]
+}
+
+
+def operation_from_json(data: Dict) -> TodoOperation:
+    operation_type = OPERATION_TYPES.get(data["type"])
+    if operation_type is None:
+        raise OperationError(f"Unknown operation type: {data['type']}")
+    return operation_type.from_json(data)
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple, Optional, List, Any, Hashable
+
+from prometheus_client import Counter, Gauge, Histogram
+from telethon.errors import FloodWaitError, MessageNotModifiedError
+from telethon.tl.custom import Message
+from telethon.tl.types import KeyboardButtonCallback
+
+from todo_list_bot.response import Response
+
+logger = logging.getLogger(__name__)
+
+telegram_latency = Histogram("todolistbot_telegram_api_seconds", "Time taken by calls to the Telegram API", ["method"])
+edits_coalesced = Counter(
+    "todolistbot_outbox_edits_coalesced_total",
+    "Number of message edits dropped because a newer edit to the same message replaced them"
+)
+edits_unchanged = Counter(
+    "todolistbot_outbox_edits_unchanged_total",
+    "Number of message edits skipped because the message already shows the same text and buttons"
+)
+flood_waits = Counter("todolistbot_outbox_flood_waits_total", "Number of FloodWait errors returned by Telegram")
+flood_wait_time = Counter("todolistbot_outbox_flood_wait_seconds_total", "Total time Telegram has asked the bot to wait")
+budget_wait_time = Histogram(
+    "todolistbot_outbox_budget_wait_seconds",
+    "Time messages and edits waited for the per-chat and global rate budgets"
+)
+edits_pending = Gauge("todolistbot_outbox_pending_edits", "Number of messages with an edit waiting to be sent")
+
+MessageKey = Tuple[int, int]
+Buttons = Optional[List[List[KeyboardButtonCallback]]]
+PendingEdit = Tuple[Any, str, Buttons, Hashable]
+
+
+def fingerprint(text: str, buttons: Buttons) -> Hashable:
+    return text, tuple(tuple((button.text, button.data) for button in row) for row in buttons or [])
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        # Takes a token if one is available, otherwise returns how long until one will be
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def full(self) -> bool:
+        return self.rate <= 0 or self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class Outbox:
+    # Edits to each message are coalesced to the latest one, and sent within per-chat and global rate budgets
+    max_fingerprints = 10000
+    max_chat_buckets = 1000
+
+    def __init__(self, chat_rate: float, chat_burst: float, global_rate: float, global_burst: float) -> None:
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.paused_until = 0.0
+        self.pending: Dict[MessageKey, PendingEdit] = {}
+        self.senders: Dict[MessageKey, asyncio.Task] = {}
+        self.sent: OrderedDict[MessageKey, Hashable] = OrderedDict()
+        edits_pending.set_function(lambda: len(self.pending))
+
+    async def respond(self, event: Any, response: Response) -> Optional[Message]:
+        return await self.send(event, "respond", response)
+
+    async def reply(self, event: Any, response: Response) -> Optional[Message]:
+        return await self.send(event, "reply", response)
+
+    async def send(self, event: Any, method: str, response: Response) -> Optional[Message]:
+        text, buttons = response.text, response.buttons()
+        while True:
+            await self.wait_for_budget(event.chat_id)
+            try:
+                with telegram_latency.labels(method=method).time():
+                    message = await getattr(event, method)(text, parse_mode="html", buttons=buttons)
+            except FloodWaitError as e:
+                self.flood_wait(e.seconds)
+                continue
+            if message is not None:
+                self.remember((event.chat_id, message.id), fingerprint(text, buttons))
+            return message
+
+    async def answer(self, event: Any) -> None:
+        # The button shows as loading until its query is answered, and skipped or coalesced edits never answer it
+        try:
+            with telegram_latency.labels(method="answer").time():
+                await event.answer()
+        except Exception:
+            logger.warning("Failed to answer button press in chat %s", event.chat_id, exc_info=True)
+
+    async def edit(self, event: Any, response: Response) -> None:
+        key = (event.chat_id, event.message_id)
+        text, buttons = response.text, response.buttons()
+        edit_fingerprint = fingerprint(text, buttons)
+        if key not in self.pending and self.sent.get(key) == edit_fingerprint:
+            edits_unchanged.inc()
+            return
+        if key in self.pending:
+            edits_coalesced.inc()
+        self.pending[key] = (event, text, buttons, edit_fingerprint)
+        if key not in self.senders:
+            self.senders[key] = asyncio.get_running_loop().create_task(self.send_edits(key))
+
+    async def send_edits(self, key: MessageKey) -> None:
+        try:
+            while key in self.pending:
+                await self.wait_for_budget(key[0])
+                # Take the latest edit only once there is budget to send it, so any newer edit replaces it
+                edit = self.pending.pop(key)
+                event, text, buttons, edit_fingerprint = edit
+                if self.sent.get(key) == edit_fingerprint:
+                    edits_unchanged.inc()
+                    continue
+                try:
+                    with telegram_latency.labels(method="edit").time():
+                        await event.edit(text, parse_mode="html", buttons=buttons)
+                except FloodWaitError as e:
+                    self.flood_wait(e.seconds)
+                    self.pending.setdefault(key, edit)
+                    continue
+                except MessageNotModifiedError:
+                    edits_unchanged.inc()
+                self.remember(key, edit_fingerprint)
+        except Exception:
+            logger.exception("Failed to edit message %s in chat %s", key[1], key[0])
+        finally:
+            del self.senders[key]
+
+    async def join(self, chat_id: int) -> None:
+        senders = [sender for key, sender in self.senders.items() if key[0] == chat_id]
+        if senders:
+            await asyncio.gather(*senders)
+
+    async def wait_for_budget(self, chat_id: int) -> None:
+        start = time.monotonic()
+        chat_bucket = self.chat_buckets.get(chat_id)
+        if chat_bucket is None:
+            if len(self.chat_buckets) >= self.max_chat_buckets:
+                self.prune_buckets()
+            chat_bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = chat_bucket
+        for bucket in [chat_bucket, self.global_bucket]:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                delay = bucket.delay()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        budget_wait_time.observe(time.monotonic() - start)
+
+    def flood_wait(self, seconds: float) -> None:
+        flood_waits.inc()
+        flood_wait_time.inc(seconds)
+        logger.warning("Telegram asked for a wait of %s seconds", seconds)
+        # Flood limits apply to the whole bot account, so every chat waits it out
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def remember(self, key: MessageKey, message_fingerprint: Hashable) -> None:
+        self.sent[key] = message_fingerprint
+        self.sent.move_to_end(key)
+        while len(self.sent) > self.max_fingerprints:
+            self.sent.popitem(last=False)
+
+    def prune_buckets(self) -> None:
+        # A refilled bucket is the same as a new one, so only chats which have sent recently need to keep theirs
+        self.chat_buckets = {chat_id: bucket for chat_id, bucket in self.chat_buckets.items() if not bucket.full}
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Set, Dict, TYPE_CHECKING, Optional, Callable
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from todo_list_bot.file_io import file_io, atomic_write, bytes_read
+
+if TYPE_CHECKING:
+    from todo_list_bot.bot import ViewerStore
+
+logger = logging.getLogger(__name__)
+
+records_written = Counter("todolistbot_persistence_records_written_total", "Number of chat records written to disk")
+flushes = Counter("todolistbot_persistence_flushes_total", "Number of times dirty chat records have been flushed")
+dirty_chats = Gauge("todolistbot_persistence_dirty_chats", "Number of chats with unsaved viewer state")
+viewers_rehydrated = Counter(
+    "todolistbot_persistence_viewers_rehydrated_total",
+    "Number of evicted chat viewers loaded again from their record"
+)
+flush_time = Histogram("todolistbot_persistence_flush_seconds", "Time taken to write all dirty chat records")
+
+
+class ViewerPersistence:
+
+    def __init__(
+            self,
+            store: 'ViewerStore',
+            directory: str,
+            save_delay: float,
+            owns_chat: Optional[Callable[[int], bool]] = None
+    ) -> None:
+        self.store = store
+        self.directory = directory
+        self.save_delay = save_delay
+        self.owns_chat = owns_chat
+        self.dirty: Set[int] = set()
+        self._dirty_event = asyncio.Event()
+        dirty_chats.set_function(lambda: len(self.dirty))
+
+    def record_path(self, chat_id: int) -> str:
+        return os.path.join(self.directory, f"{chat_id}.json")
+
+    def mark_dirty(self, chat_id: int) -> None:
+        self.dirty.add(chat_id)
+        self._dirty_event.set()
+
+    async def run(self) -> None:
+        while True:
+            await self._dirty_event.wait()
+            # Wait out the save delay, so a burst of updates is written once
+            await asyncio.sleep(self.save_delay)
+            await self.flush()
+
+    async def flush(self) -> None:
+        self._dirty_event.clear()
+        dirty, self.dirty = self.dirty, set()
+        if not dirty:
+            return
+        flushes.inc()
+        with flush_time.time():
+            # Records are serialised before anything is awaited, so an idle viewer can't be evicted part way through
+            records = {}
+            for chat_id in dirty:
+                # A chat evicted since it was marked dirty is loaded from its last record on its next update
+                if chat_id not in self.store.store:
+                    continue
+                try:
+                    records[chat_id] = json.dumps(self.store.chat_to_json(chat_id))
+                except Exception:
+                    logger.exception("Failed to serialise the viewer for chat %s", chat_id)
+            results = await asyncio.gather(
+                *[self.write_record(chat_id, text) for chat_id, text in records.items()],
+                return_exceptions=True
+            )
+            for chat_id, result in zip(records.keys(), results):
+                if isinstance(result, Exception):
+                    logger.error("Failed to save the viewer for chat %s", chat_id, exc_info=result)
+                    # Tried again on the next flush
+                    self.mark_dirty(chat_id)
+
+    async def write_record(self, chat_id: int, text: str) -> None:
+        path = self.record_path(chat_id)
+        await file_io.run_ordered(path, atomic_write, path, text)
+        records_written.inc()
+
+    async def rehydrate(self, chat_id: int) -> None:
+        if chat_id not in self.store.evicted:
+            return
+        path = self.record_path(chat_id)
+        # Ordered with writes to the record, so the last save has finished before it is read
+        data = await file_io.run_ordered(path, self.read_record, path)
+        if chat_id in self.store.evicted:
+            self.store.load_viewer_json(data)
+            viewers_rehydrated.inc()
+
+    # noinspection PyMethodMayBeStatic
+    def read_record(self, path: str) -> Dict:
+        with open(path, "rb") as f:
+            contents = f.read()
+        bytes_read.inc(len(contents))
+        return json.loads(contents)
+
+    def load(self, legacy_filename: str) -> None:
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+            self.migrate(legacy_filename)
+            return
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                chat_id = int(filename[:-len(".json")])
+            except ValueError:
+                logger.warning("Ignoring %s in %s, as it is not a viewer record", filename, self.directory)
+                continue
+            # When chats are sharded across processes, each only loads the chats it handles
+            if self.owns_chat is not None and not self.owns_chat(chat_id):
+                continue
+            self.store.load_chat_json(self.read_record(os.path.join(self.directory, filename)))
+
+    def migrate(self, legacy_filename: str) -> None:
+        legacy_store = self.store.load_from_json(legacy_filename, self.store.base_directory)
+        for chat_id, viewer in legacy_store.store.items():
+            self.store.add_viewer(viewer)
+            self.mark_dirty(chat_id)
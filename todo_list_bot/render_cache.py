@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple, List
+
+from prometheus_client import Counter, Gauge
+from telethon.tl.types import KeyboardButtonCallback
+
+from todo_list_bot.response import Response
+
+render_hits = Counter("todolistbot_render_cache_hits_total", "Number of responses served from the render cache", ["view"])
+render_misses = Counter("todolistbot_render_cache_misses_total", "Number of responses which had to be rendered", ["view"])
+render_evictions = Counter("todolistbot_render_cache_evictions_total", "Number of rendered responses evicted")
+render_entries = Gauge("todolistbot_render_cache_entries", "Number of rendered responses held in the render cache")
+
+RenderedView = Tuple[str, List[KeyboardButtonCallback], Optional[List[List[KeyboardButtonCallback]]]]
+
+
+class RenderCache:
+
+    def __init__(self, max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self.store: OrderedDict[Hashable, RenderedView] = OrderedDict()
+        render_entries.set_function(lambda: len(self.store))
+
+    def get(self, view: str, key: Hashable) -> Optional[Response]:
+        rendered = self.store.get((view, key))
+        if rendered is None:
+            render_misses.labels(view=view).inc()
+            return None
+        render_hits.labels(view=view).inc()
+        self.store.move_to_end((view, key))
+        return self.response(rendered)
+
+    def add(
+            self,
+            view: str,
+            key: Hashable,
+            text: str,
+            buttons: List[KeyboardButtonCallback],
+            footer: Optional[List[List[KeyboardButtonCallback]]] = None
+    ) -> Response:
+        rendered = (text, buttons, footer)
+        self.store[(view, key)] = rendered
+        self.store.move_to_end((view, key))
+        while len(self.store) > self.max_entries:
+            self.store.popitem(last=False)
+            render_evictions.inc()
+        return self.response(rendered)
+
+    # noinspection PyMethodMayBeStatic
+    def response(self, rendered: RenderedView) -> Response:
+        # Responses are paged and prefixed in place, so each caller gets its own copy
+        text, buttons, footer = rendered
+        return Response(text, list(buttons), footer)
+
+
+render_cache = RenderCache()
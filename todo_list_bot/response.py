@@ -8,9 +8,16 @@ class Response:
     per_page = 6
     text_length_limit = 4096
 
-    def __init__(self, text: str, buttons: Optional[List[KeyboardButtonCallback]] = None):
+    def __init__(
+            self,
+            text: str,
+            buttons: Optional[List[KeyboardButtonCallback]] = None,
+            footer: Optional[List[List[KeyboardButtonCallback]]] = None
+    ):
         self._text = text
         self.all_buttons = buttons
+        # Rows shown under the buttons on every page
+        self.footer = footer
         self.page = 1
 
     def prefix(self, prefix: str) -> None:
@@ -43,10 +50,11 @@ class Response:
 
     def buttons(self) -> Optional[List[List[KeyboardButtonCallback]]]:
         if self.all_buttons is None:
-            return None
+            return self.footer
         buttons = self.all_buttons[(self.page - 1) * self.per_page: self.page * self.per_page]
+        footer = self.footer or []
         if self.pages == 1:
-            return [[b] for b in buttons]
+            return [*([b] for b in buttons), *footer]
         page_buttons = [
             Button.inline(
                 "< Prev" if self.has_prev else " ",
@@ -59,7 +67,8 @@ class Response:
         ]
         return [
             *([b] for b in buttons),
-            page_buttons
+            page_buttons,
+            *footer
         ]
 
     def to_json(self) -> Dict:
@@ -71,6 +80,9 @@ class Response:
                     "data": button.data.decode()
                 } for button in self.all_buttons
             ] if self.all_buttons is not None else None,
+            "footer": [
+                [{"text": button.text, "data": button.data.decode()} for button in row] for row in self.footer
+            ] if self.footer is not None else None,
             "page": self.page
         }
 
@@ -78,7 +90,10 @@ class Response:
     def from_json(cls, data: Dict) -> 'Response':
         response = Response(
             data["text"],
-            [Button.inline(d["text"], d["data"]) for d in data["all_buttons"]] if data["all_buttons"] is not None else None
+            [Button.inline(d["text"], d["data"]) for d in data["all_buttons"]] if data["all_buttons"] is not None else None,
+            [
+                [Button.inline(d["text"], d["data"]) for d in row] for row in data["footer"]
+            ] if data.get("footer") is not None else None
         )
         response.page = data["page"]
         return response
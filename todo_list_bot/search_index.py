@@ -0,0 +1,224 @@
+import asyncio
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Set, Tuple, Optional
+
+from prometheus_client import Counter, Gauge
+
+from todo_list_bot.document_cache import DocumentListener
+from todo_list_bot.file_io import file_io, atomic_write, TEMP_PREFIX
+from todo_list_bot.todo_list import TodoList, TodoSection, TodoContainer
+
+searches = Counter("todolistbot_search_queries_total", "Number of search queries run against the search index")
+documents_indexed = Counter("todolistbot_search_documents_indexed_total", "Number of todo lists (re)indexed for search")
+indexed_documents = Gauge("todolistbot_search_index_documents", "Number of todo lists in the search index")
+indexed_terms = Gauge("todolistbot_search_index_terms", "Number of distinct terms in the search index")
+
+NodePath = Tuple[str, ...]
+Posting = Tuple[str, NodePath]
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> Set[str]:
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+
+def index_key(path: str) -> str:
+    return os.path.relpath(os.path.abspath(path))
+
+
+class SearchResult:
+
+    def __init__(self, path: str, node_path: NodePath, text: str):
+        self.path = path
+        self.node_path = node_path
+        self.text = text
+
+
+class IndexedDocument:
+
+    def __init__(self, mtime_ns: int, size: int, nodes: Dict[NodePath, str]):
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.nodes = nodes
+
+    def to_json(self) -> Dict:
+        return {
+            "mtime_ns": self.mtime_ns,
+            "size": self.size,
+            "nodes": [[list(node_path), text] for node_path, text in self.nodes.items()]
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'IndexedDocument':
+        return IndexedDocument(
+            data["mtime_ns"],
+            data["size"],
+            {tuple(node_path): text for node_path, text in data["nodes"]}
+        )
+
+
+class SearchIndex(DocumentListener):
+    max_results = 20
+
+    def __init__(self, root_dir: str, filename: str, refresh_interval: float, scans: bool = True):
+        self.root_dir = index_key(root_dir)
+        self.filename = filename
+        self.refresh_interval = refresh_interval
+        # An index which doesn't scan loads the file saved by one which does, whenever it changes
+        self.scans = scans
+        self.documents: Dict[str, IndexedDocument] = {}
+        self.postings: Dict[str, Set[Posting]] = {}
+        self.dirty = False
+        self.loaded_mtime_ns: Optional[int] = None
+        self._lock = threading.Lock()
+        indexed_documents.set_function(lambda: len(self.documents))
+        indexed_terms.set_function(lambda: len(self.postings))
+
+    def in_root(self, key: str) -> bool:
+        return os.path.commonpath([self.root_dir, key]) == self.root_dir
+
+    def document_updated(self, todo: TodoList, structure_changed: bool = True) -> None:
+        key = index_key(todo.path)
+        if not self.in_root(key):
+            return
+        mtime_ns, size, _ = todo.signature
+        if not structure_changed:
+            # Statuses aren't indexed, so only the file's signature needs updating
+            with self._lock:
+                document = self.documents.get(key)
+                if document is not None:
+                    document.mtime_ns, document.size = mtime_ns, size
+                    self.dirty = True
+                    return
+        self.update_document(key, IndexedDocument(mtime_ns, size, dict(self.document_nodes(todo))))
+
+    def document_deleted(self, path: str) -> None:
+        self.update_document(index_key(path), None)
+
+    # noinspection PyMethodMayBeStatic
+    def document_nodes(self, todo: TodoList) -> List[Tuple[NodePath, str]]:
+        nodes = []
+        stack: List[Tuple[TodoContainer, NodePath]] = [(todo.root_section, ())]
+        while stack:
+            node, node_path = stack.pop()
+            if isinstance(node, TodoSection):
+                children = node.sub_sections + node.root_items
+            else:
+                children = node.sub_items
+            for child in children:
+                text = child.title if isinstance(child, TodoSection) else child.name
+                child_path = node_path + (text,)
+                nodes.append((child_path, text))
+                stack.append((child, child_path))
+        return nodes
+
+    def update_document(self, key: str, document: Optional[IndexedDocument]) -> None:
+        with self._lock:
+            old_document = self.documents.pop(key, None)
+            old_nodes = old_document.nodes if old_document else {}
+            new_nodes = document.nodes if document else {}
+            # Only touch postings for nodes which have appeared or disappeared
+            for node_path in old_nodes.keys() - new_nodes.keys():
+                for term in tokenize(old_nodes[node_path]):
+                    postings = self.postings.get(term)
+                    if postings is not None:
+                        postings.discard((key, node_path))
+                        if not postings:
+                            del self.postings[term]
+            for node_path in new_nodes.keys() - old_nodes.keys():
+                for term in tokenize(new_nodes[node_path]):
+                    self.postings.setdefault(term, set()).add((key, node_path))
+            if document is not None:
+                self.documents[key] = document
+                documents_indexed.inc()
+            self.dirty = True
+
+    def search(self, query: str) -> List[SearchResult]:
+        searches.inc()
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            posting_sets = sorted((self.postings.get(term, set()) for term in terms), key=len)
+            matches = set(posting_sets[0])
+            for postings in posting_sets[1:]:
+                matches &= postings
+            return [
+                SearchResult(key, node_path, self.documents[key].nodes[node_path])
+                for key, node_path in sorted(matches)[:self.max_results]
+            ]
+
+    def scan_changes(self) -> None:
+        seen = set()
+        for directory, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                if filename.startswith(TEMP_PREFIX):
+                    continue
+                key = index_key(os.path.join(directory, filename))
+                seen.add(key)
+                stat = os.stat(key)
+                document = self.documents.get(key)
+                if document is not None and (document.mtime_ns, document.size) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                todo = TodoList(key)
+                try:
+                    todo.parse()
+                except (UnicodeDecodeError, OSError):
+                    continue
+                self.document_updated(todo)
+        with self._lock:
+            removed = set(self.documents.keys()) - seen
+        for key in removed:
+            self.update_document(key, None)
+
+    def to_json(self) -> Dict:
+        with self._lock:
+            return {key: document.to_json() for key, document in self.documents.items()}
+
+    def save(self) -> None:
+        if not self.scans:
+            return
+        self.dirty = False
+        atomic_write(self.filename, json.dumps(self.to_json()))
+
+    def load(self) -> None:
+        try:
+            mtime_ns = os.stat(self.filename).st_mtime_ns
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        # Built aside and swapped in, so searches never see a partly loaded index
+        documents = {key: IndexedDocument.from_json(document_data) for key, document_data in data.items()}
+        postings: Dict[str, Set[Posting]] = {}
+        for key, document in documents.items():
+            for node_path, text in document.nodes.items():
+                for term in tokenize(text):
+                    postings.setdefault(term, set()).add((key, node_path))
+        with self._lock:
+            self.documents = documents
+            self.postings = postings
+            self.dirty = False
+        self.loaded_mtime_ns = mtime_ns
+
+    def reload(self) -> None:
+        try:
+            mtime_ns = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime_ns != self.loaded_mtime_ns:
+            self.load()
+
+    async def run(self) -> None:
+        while True:
+            if self.scans:
+                await file_io.run(self.scan_changes)
+                if self.dirty:
+                    await file_io.run_ordered(self.filename, self.save)
+            else:
+                await file_io.run(self.reload)
+            await asyncio.sleep(self.refresh_interval)
@@ -0,0 +1,279 @@
+import asyncio
+import dataclasses
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+from typing import Dict, List, Optional, Any, Tuple
+
+from prometheus_client import start_http_server, Counter
+from telethon import TelegramClient
+from telethon.events import NewMessage, CallbackQuery
+
+from todo_list_bot.bot import BotConfig, TodoListBot, ViewerStore, LatencyLabels, message_labels, callback_labels, \
+    observe_latency
+from todo_list_bot.dispatcher import ChatDispatcher, Handler
+from todo_list_bot.journal import journal
+from todo_list_bot.outbox import Outbox
+from todo_list_bot.persistence import ViewerPersistence
+from todo_list_bot.response import Response
+
+logger = logging.getLogger(__name__)
+
+updates_routed = Counter("todolistbot_shard_updates_total", "Number of updates sent to worker processes", ["shard"])
+worker_results = Counter("todolistbot_shard_results_total", "Number of replies and edits returned by worker processes")
+
+# Results sent back from workers are (method, update ID, response JSON); "done" means the update has been handled, and
+# "answer" that a button press can be answered
+ShardResult = Tuple[str, int, Optional[Dict]]
+
+
+def shard_for(chat_id: int, shards: int) -> int:
+    return hash(chat_id) % shards
+
+
+@dataclasses.dataclass
+class UpdateMessage:
+    message: str
+
+
+@dataclasses.dataclass
+class ShardUpdate:
+    # A picklable copy of the parts of a telethon event which the handlers use
+    update_id: int
+    chat_id: int
+    message_id: Optional[int] = None
+    message: Optional[UpdateMessage] = None
+    data: Optional[bytes] = None
+    # Set when the front process has sent a menu, so the worker can keep it for the message's page buttons
+    menu: Optional[Dict] = None
+
+
+@dataclasses.dataclass
+class ShardReply:
+    chat_id: int
+    event: Any
+    method: str
+    response_data: Dict
+
+
+@dataclasses.dataclass
+class ShardLatency:
+    chat_id: int
+    labels: LatencyLabels
+    received: float
+
+
+class ShardOutbox:
+    # Stands in for the outbox in a worker, passing each reply back to the front process to send
+
+    def __init__(self, results: multiprocessing.Queue) -> None:
+        self.results = results
+
+    async def respond(self, event: ShardUpdate, response: Response) -> None:
+        self.results.put(("respond", event.update_id, response.to_json()))
+
+    async def reply(self, event: ShardUpdate, response: Response) -> None:
+        self.results.put(("reply", event.update_id, response.to_json()))
+
+    async def edit(self, event: ShardUpdate, response: Response) -> None:
+        self.results.put(("edit", event.update_id, response.to_json()))
+
+    async def answer(self, event: ShardUpdate) -> None:
+        self.results.put(("answer", event.update_id, None))
+
+
+class ShardWorker:
+
+    def __init__(
+            self,
+            config: BotConfig,
+            shard: int,
+            updates: multiprocessing.Queue,
+            results: multiprocessing.Queue
+    ) -> None:
+        self.shard = shard
+        self.updates = updates
+        self.results = results
+        self.config = dataclasses.replace(config, prometheus_port=config.prometheus_port + 1 + shard)
+        self.bot = TodoListBot(
+            self.config,
+            outbox=ShardOutbox(results),
+            owns_chat=lambda chat_id: shard_for(chat_id, config.shards) == shard
+        )
+        # Only the first worker scans the storage directory and saves the search index, and the others load its saves
+        self.bot.search_index.scans = shard == 0
+
+    async def run(self) -> None:
+        start_http_server(self.config.prometheus_port)
+        loop = asyncio.get_running_loop()
+        tasks = [
+            loop.create_task(self.bot.persistence.run()),
+            loop.create_task(self.bot.evictor.run()),
+            loop.create_task(self.bot.search_index.run())
+        ]
+        while True:
+            update: Optional[ShardUpdate] = await loop.run_in_executor(None, self.updates.get)
+            if update is None:
+                break
+            if update.menu is not None:
+                # Any button press on the menu is sent after this, so it can be added straight away
+                self.bot.viewer_store.menus.add(update.chat_id, update.message_id, Response.from_json(update.menu))
+                # An evicted chat's menus are saved with its viewer, once it is loaded again
+                if update.chat_id in self.bot.viewer_store.store:
+                    self.bot.save(update.chat_id)
+                continue
+            if update.data is not None:
+                handler = self.bot.handle_callback
+            else:
+                handler = self.bot.message_handler(update.message.message or "")
+            await self.bot.dispatcher.submit(update.chat_id, self.handled(handler), update)
+        for chat_id in list(self.bot.dispatcher.queues.keys()):
+            await self.bot.dispatcher.join(chat_id)
+        for task in tasks:
+            task.cancel()
+        await self.bot.persistence.flush()
+        self.bot.search_index.save()
+
+    def handled(self, handler: Handler) -> Handler:
+        async def handle(update: ShardUpdate) -> None:
+            try:
+                await handler(update)
+            finally:
+                self.results.put(("done", update.update_id, None))
+        return handle
+
+
+async def run_shard(
+        config: BotConfig,
+        shard: int,
+        updates: multiprocessing.Queue,
+        results: multiprocessing.Queue
+) -> None:
+    # Built inside the running loop, so anything the worker creates belongs to it
+    await ShardWorker(config, shard, updates, results).run()
+
+
+def run_worker(config: BotConfig, shard: int, updates: multiprocessing.Queue, results: multiprocessing.Queue) -> None:
+    asyncio.run(run_shard(config, shard, updates, results))
+
+
+class ShardedBot:
+    # Receives updates from Telegram and passes each chat's updates to the same worker process, sending their replies
+
+    def __init__(self, config: BotConfig) -> None:
+        self.config = config
+        self.client = TelegramClient("todolistbot", self.config.api_id, self.config.api_hash)
+        self.outbox = Outbox(
+            config.edit_rate_per_chat,
+            config.edit_burst_per_chat,
+            config.edit_rate_global,
+            config.edit_burst_global
+        )
+        # Replies for one chat are sent in order, while replies to different chats can wait on rate limits separately
+        self.dispatcher = ChatDispatcher(config.max_concurrent_chats, config.chat_queue_size)
+        self.context = multiprocessing.get_context("spawn")
+        self.updates: List[multiprocessing.Queue] = [self.context.Queue() for _ in range(config.shards)]
+        self.results: multiprocessing.Queue = self.context.Queue()
+        self.workers: List[multiprocessing.Process] = []
+        self.events: Dict[int, Any] = {}
+        self.received: Dict[int, Tuple[LatencyLabels, float]] = {}
+        self.update_ids = itertools.count()
+
+    def migrate(self) -> None:
+        # Workers only load their own chats, so a legacy viewer store is split into per chat files before they start
+        if os.path.isdir(self.config.viewer_store_dir):
+            return
+        persistence = ViewerPersistence(
+            ViewerStore(self.config.storage_dir),
+            self.config.viewer_store_dir,
+            self.config.save_delay
+        )
+        persistence.load(self.config.viewer_store_filename)
+        self.client.loop.run_until_complete(persistence.flush())
+
+    def start(self) -> None:
+        # Recovered once here, as workers replaying the same journals at once would race each other
+        journal.configure(self.config.journal_dir, self.config.journal_max_records)
+        journal.recover()
+        self.migrate()
+        for shard in range(self.config.shards):
+            worker = self.context.Process(
+                target=run_worker,
+                args=(self.config, shard, self.updates[shard], self.results),
+                name=f"todolistbot-shard-{shard}"
+            )
+            worker.start()
+            self.workers.append(worker)
+        self.client.add_event_handler(self.route_message, NewMessage(incoming=True))
+        self.client.add_event_handler(self.route_callback, CallbackQuery())
+        self.client.start(bot_token=self.config.bot_token)
+        start_http_server(self.config.prometheus_port)
+        results_task = self.client.loop.create_task(self.read_results())
+        self.client.run_until_disconnected()
+        self.client.loop.run_until_complete(self.stop_workers(results_task))
+
+    async def stop_workers(self, results_task: asyncio.Task) -> None:
+        # Results are still read while the workers finish, so none of them block writing to a full results pipe
+        loop = asyncio.get_running_loop()
+        for updates in self.updates:
+            updates.put(None)
+        for worker in self.workers:
+            await loop.run_in_executor(None, worker.join)
+        self.results.put(None)
+        await results_task
+
+    def route(self, event: Any, update: ShardUpdate, labels: LatencyLabels) -> None:
+        shard = shard_for(update.chat_id, self.config.shards)
+        self.events[update.update_id] = event
+        self.received[update.update_id] = (labels, time.monotonic())
+        updates_routed.labels(shard=str(shard)).inc()
+        self.updates[shard].put(update)
+
+    async def route_message(self, event: NewMessage.Event) -> None:
+        update_id = next(self.update_ids)
+        update = ShardUpdate(update_id, event.chat_id, message=UpdateMessage(event.message.message))
+        self.route(event, update, message_labels(event.message.message or ""))
+
+    async def route_callback(self, event: CallbackQuery.Event) -> None:
+        update_id = next(self.update_ids)
+        update = ShardUpdate(update_id, event.chat_id, message_id=event.message_id, data=event.data)
+        self.route(event, update, callback_labels(event.data))
+
+    async def read_results(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            result: Optional[ShardResult] = await loop.run_in_executor(None, self.results.get)
+            if result is None:
+                return
+            worker_results.inc()
+            method, update_id, response_data = result
+            if method == "done":
+                event = self.events.pop(update_id, None)
+                timing = self.received.pop(update_id, None)
+                if event is not None and timing is not None:
+                    # Queued behind the update's replies, so its edits are with the outbox by the time it runs
+                    latency = ShardLatency(event.chat_id, *timing)
+                    await self.dispatcher.submit(event.chat_id, self.track_latency, latency)
+                continue
+            event = self.events.get(update_id)
+            if event is None:
+                continue
+            if method == "answer":
+                # Answered straight away, rather than waiting behind the chat's earlier replies
+                loop.create_task(self.outbox.answer(event))
+                continue
+            reply = ShardReply(event.chat_id, event, method, response_data)
+            await self.dispatcher.submit(event.chat_id, self.send_reply, reply)
+
+    async def track_latency(self, latency: ShardLatency) -> None:
+        loop = asyncio.get_running_loop()
+        loop.create_task(observe_latency(self.outbox, latency.chat_id, latency.labels, latency.received))
+
+    async def send_reply(self, reply: ShardReply) -> None:
+        response = Response.from_json(reply.response_data)
+        message = await getattr(self.outbox, reply.method)(reply.event, response)
+        if message is not None and response.pages is not None and response.pages > 1:
+            update = ShardUpdate(next(self.update_ids), reply.chat_id, message_id=message.id, menu=reply.response_data)
+            self.updates[shard_for(reply.chat_id, self.config.shards)].put(update)
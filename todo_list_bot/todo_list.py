@@ -1,12 +1,50 @@
+import bisect
+import dataclasses
+import fcntl
+import itertools
+import os
+import random
+import re
+import shutil
 from abc import ABC, abstractmethod
 from enum import Enum
-from typing import List, Optional, Dict, Tuple
+from typing import List, Optional, Dict, Tuple, Iterable, Iterator, BinaryIO, Sequence
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
+
+from todo_list_bot.file_io import atomic_open, bytes_read
 
 list_parsed = Counter("todolistbot_parse_list_total", "Number of todo lists parsed")
 sections_parsed = Counter("todolistbot_parse_section_total", "Number of todo list sections parsed")
 items_parsed = Counter("todolistbot_parse_items_total", "Number of todo list items parsed")
+saves_full = Counter("todolistbot_save_full_total", "Number of todo list saves which rewrote every line")
+saves_patched = Counter("todolistbot_save_patched_total", "Number of todo list saves which patched changed lines")
+saves_skipped = Counter("todolistbot_save_skipped_total", "Number of todo list saves skipped as nothing had changed")
+lines_patched = Counter("todolistbot_save_patched_lines_total", "Number of lines patched in todo list saves")
+parse_time = Histogram("todolistbot_parse_seconds", "Time taken to read and parse a todo list file")
+save_time = Histogram("todolistbot_save_seconds", "Time taken to write a todo list file")
+
+# Node IDs are unique within the process. Starting at a random offset means IDs on buttons sent before a restart
+# are unlikely to match a node in a freshly parsed list. They are only given to nodes which are asked for one, such as
+# for a button, so parsing a large list doesn't hold an ID and an index entry for every node
+node_ids = itertools.count(random.randrange(1, 1 << 31))
+
+FileSignature = Tuple[int, int, int]
+SourceSpan = Tuple[int, int]
+
+
+def file_signature(path: str) -> FileSignature:
+    return stat_signature(os.stat(path))
+
+
+def stat_signature(stat: os.stat_result) -> FileSignature:
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+# Classifies a line in one pass: blank, a section heading, or an item with optional status prefix and indent
+ITEM_REGEX = r"(?P<status>DONE|INP)?(?P<indent>[ -]*)(?P<name>.*)"
+LINE_PATTERN = re.compile(r"(?P<empty>\s*\Z)|(?P<hashes>#+)(?P<title>.*)|" + ITEM_REGEX, re.DOTALL)
+ITEM_PATTERN = re.compile(ITEM_REGEX, re.DOTALL)
 
 
 def line_is_section(line: str) -> bool:
@@ -21,49 +59,99 @@ def line_is_item(line: str) -> bool:
     return not line_is_empty(line) and not line_is_section(line)
 
 
+class TodoListConflict(Exception):
+    pass
+
+
+def read_lines(f: BinaryIO) -> Iterator[Tuple[str, SourceSpan]]:
+    offset = 0
+    for raw_line in f:
+        yield raw_line.decode(), (offset, offset + len(raw_line.rstrip(b"\r\n")))
+        offset += len(raw_line)
+
+
+@dataclasses.dataclass
+class SavePlan:
+    full: bool
+    lines: List[Tuple[Optional['TodoContainer'], str]]
+
+
 # noinspection PyMethodMayBeStatic
 class TodoList:
     def __init__(self, path: str):
         self.path = path
-        self.root_section = TodoSection("root", 0, None)
+        self.root_section = TodoRootSection()
+        self.signature: Optional[FileSignature] = None
 
+    @parse_time.time()
     def parse(self) -> None:
         list_parsed.inc()
-        with open(self.path, "r") as f:
-            contents = f.readlines()
-        self.parse_lines(contents)
+        with open(self.path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.signature = stat_signature(stat)
+            self._parse(read_lines(f), self.root_section)
+        bytes_read.inc(stat.st_size)
 
     def parse_lines(self, contents: List[str], current_section: Optional['TodoSection'] = None):
-        current_section = current_section or self.root_section
+        self._parse(((line, None) for line in contents), current_section or self.root_section)
+
+    def _parse(self, contents: Iterable[Tuple[str, Optional[SourceSpan]]], current_section: 'TodoSection') -> None:
         current_item = None
-        for line in contents:
-            if line_is_empty(line):
+        for line, span in contents:
+            match = LINE_PATTERN.match(line)
+            if match.group("empty") is not None:
                 continue
-            if line_is_section(line):
-                current_section = self.parse_section(line, current_section)
+            if match.group("hashes") is not None:
+                current_section = self.add_section(match, current_section, span)
                 current_item = None
             else:
-                current_item = self.parse_item(line, current_section, current_item)
+                current_item = self.add_item(match, current_section, current_item, span)
 
-    def parse_section(self, line: str, current_section: 'TodoSection') -> 'TodoSection':
+    def parse_section(
+            self,
+            line: str,
+            current_section: 'TodoSection',
+            source_span: Optional[SourceSpan] = None
+    ) -> 'TodoSection':
+        return self.add_section(LINE_PATTERN.match(line), current_section, source_span)
+
+    def add_section(
+            self,
+            match: re.Match,
+            current_section: 'TodoSection',
+            source_span: Optional[SourceSpan]
+    ) -> 'TodoSection':
         sections_parsed.inc()
-        section_title = line.lstrip("#")
-        section_depth = len(line) - len(section_title)
-        section_title = section_title.strip()
+        section_depth = len(match.group("hashes"))
+        section_title = match.group("title").strip()
         if section_depth > current_section.depth:
             parent_section = current_section
         else:
             while section_depth <= current_section.depth:
                 current_section = current_section.parent_section
             parent_section = current_section
-        return TodoSection(section_title, section_depth, parent_section)
-   
-    def parse_item(self, line: str, current_section: 'TodoSection', current_item: Optional['TodoItem']) -> 'TodoItem':
+        return TodoSection(section_title, section_depth, parent_section, source_span)
+
+    def parse_item(
+            self,
+            line: str,
+            current_section: 'TodoSection',
+            current_item: Optional['TodoItem'],
+            source_span: Optional[SourceSpan] = None
+    ) -> 'TodoItem':
+        return self.add_item(ITEM_PATTERN.match(line), current_section, current_item, source_span)
+
+    def add_item(
+            self,
+            match: re.Match,
+            current_section: 'TodoSection',
+            current_item: Optional['TodoItem'],
+            source_span: Optional[SourceSpan]
+    ) -> 'TodoItem':
         items_parsed.inc()
-        status, line = self.parse_status(line)
-        item_text = line.lstrip(" -")
-        item_depth = len(line) - len(item_text)
-        item_text = item_text.strip()
+        status = TodoStatus(match.group("status") or "")
+        item_depth = len(match.group("indent"))
+        item_text = match.group("name").strip()
         if current_item is None:
             parent_item = None
         elif item_depth > current_item.depth:
@@ -76,31 +164,122 @@ class TodoList:
                 else:
                     parent_item = None
                     break
-        return TodoItem(status, item_text, item_depth, current_section, parent_item)
-
-    def parse_status(self, line: str) -> Tuple['TodoStatus', str]:
-        status = TodoStatus.TODO
-        for enum_status in TodoStatus:
-            if line.startswith(enum_status.value):
-                status = enum_status
-                line = line[len(enum_status.value):]
-                break
-        return status, line
-
-    def to_text(self, section: Optional['TodoSection'] = None) -> str:
+        return TodoItem(status, item_text, item_depth, current_section, parent_item, source_span)
+
+    def node(self, node_id: Optional[int]) -> Optional['TodoContainer']:
+        return self.root_section.nodes.get(node_id)
+
+    def find(self, path: List[str]) -> Optional['TodoContainer']:
+        node = self.root_section
+        for path_part in path:
+            node = node.find_child(path_part)
+            if node is None:
+                return None
+        return node
+
+    def to_text(self, section: Optional['TodoContainer'] = None) -> str:
         section = section or self.root_section
         max_length = 4096
         text = section.to_text()
-        if len(text) < max_length:
+        if len(text) < max_length or not isinstance(section, TodoSection):
             return text
+        # Work out the length of the headings-only text at every max_depth in one pass, then render it once
+        heading_lengths = [0] * 11
+        heading_counts = [0] * 11
+        for parent_depth, heading_length in section.sub_section_headings():
+            if parent_depth < 10:
+                heading_lengths[parent_depth] += heading_length
+                heading_counts[parent_depth] += 1
+        total_length = len(section.line_text()) if section.depth != 0 else 0
+        total_count = 1 if section.depth != 0 else 0
+        depth_lengths = []
+        for depth in range(11):
+            depth_lengths.append(total_length + max(total_count - 1, 0))
+            total_length += heading_lengths[depth]
+            total_count += heading_counts[depth]
         max_depth = 10
-        while len(section.to_text(max_depth)) > max_length and max_depth >= 1:
+        while depth_lengths[max_depth] > max_length and max_depth >= 1:
             max_depth -= 1
         return section.to_text(max_depth)
 
+    def clear(self) -> 'TodoSection':
+        self.root_section = TodoRootSection()
+        self.root_section.structure_changed = True
+        return self.root_section
+
+    def render(self) -> SavePlan:
+        root = self.root_section
+        changed_lines, root.changed_lines = root.changed_lines, []
+        if root.structure_changed:
+            root.structure_changed = False
+            return SavePlan(True, list(root.render_lines()))
+        return SavePlan(False, [(node, node.line_text()) for node in changed_lines])
+
+    @save_time.time()
+    def write(self, plan: SavePlan) -> None:
+        if not plan.full and not plan.lines:
+            saves_skipped.inc()
+            return
+        with open(self.path, "rb") as lock_file:
+            # Hold an advisory lock while checking the version, so other processes can't write in between
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self.signature is not None and self.signature != file_signature(self.path):
+                raise TodoListConflict(f"{self.path} has been modified since it was parsed")
+            if plan.full:
+                self.write_full(plan.lines)
+            else:
+                self.write_patches(plan.lines)
+            self.signature = file_signature(self.path)
+
+    def write_full(self, lines: List[Tuple[Optional['TodoContainer'], str]]) -> None:
+        saves_full.inc()
+        offset = 0
+        chunks = []
+        spans = []
+        for node, line in lines:
+            data = line.encode()
+            if node is not None:
+                spans.append((node, (offset, offset + len(data))))
+            chunks.append(data)
+            offset += len(data) + 1
+        with atomic_open(self.path) as f:
+            f.write(b"\n".join(chunks))
+        for node, span in spans:
+            node.source_span = span
+
+    def write_patches(self, lines: List[Tuple['TodoContainer', str]]) -> None:
+        saves_patched.inc()
+        patches = sorted({id(node): (node, line) for node, line in lines}.values(), key=lambda p: p[0].source_span)
+        lines_patched.inc(len(patches))
+        patch_ends = []
+        patch_shifts = []
+        shift = 0
+        with open(self.path, "rb") as src, atomic_open(self.path) as dst:
+            position = 0
+            for node, line in patches:
+                start, end = node.source_span
+                dst.write(src.read(start - position))
+                data = line.encode()
+                dst.write(data)
+                src.seek(end)
+                position = end
+                node.source_span = (start + shift, start + shift + len(data))
+                shift += len(data) - (end - start)
+                patch_ends.append(end)
+                patch_shifts.append(shift)
+            shutil.copyfileobj(src, dst)
+            bytes_read.inc(src.tell())
+        patched = set(id(node) for node, _ in patches)
+        for node in self.root_section.walk():
+            if node.source_span is None or id(node) in patched:
+                continue
+            index = bisect.bisect_right(patch_ends, node.source_span[0])
+            if index:
+                start, end = node.source_span
+                node.source_span = (start + patch_shifts[index - 1], end + patch_shifts[index - 1])
+
     def save(self) -> None:
-        with open(self.path, "w") as f:
-            f.write(self.root_section.to_text())
+        self.write(self.render())
 
     def to_json(self) -> Dict:
         return {
@@ -115,15 +294,129 @@ class TodoList:
 
 
 class TodoContainer(ABC):
-
-    def __init__(self, parent_section: Optional['TodoSection']):
+    # Spans are held as two plain int slots rather than a tuple, to keep large trees compact
+    __slots__ = (
+        "_node_id", "parent_section", "_span_start", "_span_end", "_child_index", "_text",
+        "done_count", "inp_count", "todo_count"
+    )
+
+    def __init__(self, parent_section: Optional['TodoSection'], source_span: Optional[SourceSpan]):
+        self._node_id: Optional[int] = None
         self.parent_section: Optional[TodoSection] = parent_section
+        self.source_span = source_span
+        self._child_index: Optional[Dict[str, TodoContainer]] = None
+        self._text: Optional[str] = None
+        # Number of items below this node with each status, kept up to date as the tree changes
+        self.done_count: int = 0
+        self.inp_count: int = 0
+        self.todo_count: int = 0
+
+    @property
+    def node_id(self) -> int:
+        if self._node_id is None:
+            self._node_id = next(node_ids)
+            self.root.nodes[self._node_id] = self
+        return self._node_id
+
+    @property
+    def source_span(self) -> Optional[SourceSpan]:
+        if self._span_start is None:
+            return None
+        return self._span_start, self._span_end
+
+    @source_span.setter
+    def source_span(self, span: Optional[SourceSpan]) -> None:
+        self._span_start, self._span_end = span or (None, None)
 
     @property
     @abstractmethod
     def parent(self) -> Optional['TodoContainer']:
         raise NotImplementedError
 
+    @property
+    def root(self) -> 'TodoRootSection':
+        section = self.parent_section or self
+        while section.parent_section is not None:
+            section = section.parent_section
+        return section
+
+    @property
+    def path(self) -> List[str]:
+        path = []
+        node = self
+        while node.parent is not None:
+            path.append(node.name)
+            node = node.parent
+        return path[::-1]
+
+    @property
+    def progress(self) -> 'Progress':
+        return self.done_count, self.inp_count, self.todo_count
+
+    def own_progress(self) -> 'Progress':
+        return 0, 0, 0
+
+    def progress_changed(self, done: int, inp: int, todo: int) -> None:
+        # Applies a change in the counts below a node to it and each of its ancestors
+        node = self
+        while node is not None:
+            node.done_count += done
+            node.inp_count += inp
+            node.todo_count += todo
+            node = node.parent
+
+    def text_changed(self) -> None:
+        # A cached ancestor text implies every descendant's text is cached, so stop at the first empty cache
+        node = self
+        while node is not None and node._text is not None:
+            node._text = None
+            node = node.parent
+
+    def attached(self, parent: 'TodoContainer') -> None:
+        parent.text_changed()
+        parent.progress_changed(*self.own_progress())
+        root = self.root
+        root.version += 1
+        if parent._child_index is not None:
+            # Keep the same precedence as a linear scan: sections before items, then the first with a given name
+            existing = parent._child_index.get(self.name)
+            if existing is None or (isinstance(self, TodoSection) and not isinstance(existing, TodoSection)):
+                parent._child_index[self.name] = self
+        if self.source_span is None:
+            root.structure_changed = True
+
+    def detached(self, parent: 'TodoContainer', root: 'TodoRootSection') -> None:
+        for node in self.walk():
+            if node._node_id is not None:
+                root.nodes.pop(node._node_id, None)
+        parent._child_index = None
+        parent.text_changed()
+        own_done, own_inp, own_todo = self.own_progress()
+        parent.progress_changed(-self.done_count - own_done, -self.inp_count - own_inp, -self.todo_count - own_todo)
+        root.version += 1
+        root.structure_changed = True
+
+    def find_child(self, name: str) -> Optional['TodoContainer']:
+        if self._child_index is None:
+            index = {}
+            for child in reversed(list(self.children())):
+                index[child.name] = child
+            self._child_index = index
+        return self._child_index.get(name)
+
+    def line_changed(self) -> None:
+        self.text_changed()
+        root = self.root
+        root.version += 1
+        if self.source_span is None:
+            root.structure_changed = True
+        else:
+            root.changed_lines.append(self)
+
+    @abstractmethod
+    def children(self) -> Iterator['TodoContainer']:
+        raise NotImplementedError
+
     @abstractmethod
     def remove(self) -> None:
         raise NotImplementedError
@@ -132,21 +425,45 @@ class TodoContainer(ABC):
     def is_empty(self) -> bool:
         raise NotImplementedError
 
+    @abstractmethod
+    def line_text(self) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def render_lines(self) -> Iterator[Tuple[Optional['TodoContainer'], str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def walk(self) -> Iterator['TodoContainer']:
+        raise NotImplementedError
+
     @abstractmethod
     def to_text(self, max_depth: Optional[int] = None) -> str:
         raise NotImplementedError
 
 
 class TodoSection(TodoContainer):
+    __slots__ = ("title", "depth", "sub_sections", "root_items")
 
-    def __init__(self, title: str, depth: int, parent: Optional['TodoSection']):
-        super().__init__(parent)
+    def __init__(
+            self,
+            title: str,
+            depth: int,
+            parent: Optional['TodoSection'],
+            source_span: Optional[SourceSpan] = None
+    ):
+        super().__init__(parent, source_span)
         self.title: str = title
         self.depth: int = depth
         self.sub_sections: List['TodoSection'] = []
+        self.root_items: List['TodoItem'] = []
         if parent:
             parent.sub_sections.append(self)
-        self.root_items: List['TodoItem'] = []
+            self.attached(parent)
+
+    @property
+    def name(self) -> str:
+        return self.title
 
     @property
     def parent(self) -> Optional['TodoSection']:
@@ -155,22 +472,70 @@ class TodoSection(TodoContainer):
     def is_empty(self) -> bool:
         return not self.sub_sections and not self.root_items
 
+    def children(self) -> Iterator[TodoContainer]:
+        yield from self.sub_sections
+        yield from self.root_items
+
     def remove(self) -> None:
         if self.parent_section:
+            root = self.root
             self.parent_section.sub_sections.remove(self)
+            self.detached(self.parent_section, root)
+
+    def line_text(self) -> str:
+        return "#" * self.depth + " " + self.title
+
+    def render_lines(self) -> Iterator[Tuple[Optional[TodoContainer], str]]:
+        if self.depth != 0:
+            yield self, self.line_text()
+        for item in self.root_items:
+            yield from item.render_lines()
+        for section in self.sub_sections:
+            yield None, ""
+            yield from section.render_lines()
+
+    def walk(self) -> Iterator[TodoContainer]:
+        yield self
+        for item in self.root_items:
+            yield from item.walk()
+        for section in self.sub_sections:
+            yield from section.walk()
+
+    def sub_section_headings(self) -> Iterator[Tuple[int, int]]:
+        for section in self.sub_sections:
+            yield self.depth, len(section.line_text())
+            yield from section.sub_section_headings()
 
     def to_text(self, max_depth: Optional[int] = None) -> str:
+        if max_depth is None and self._text is not None:
+            return self._text
         lines = []
         if self.depth != 0:
-            lines += ["#" * self.depth + " " + self.title]
+            lines += [self.line_text()]
         if max_depth is None:
             lines += [item.to_text(max_depth) for item in self.root_items]
         if max_depth is None or self.depth < max_depth:
             lines += [("\n" if max_depth is None else "") + section.to_text(max_depth) for section in self.sub_sections]
-        return "\n".join(lines)
+        text = "\n".join(lines)
+        if max_depth is None:
+            self._text = text
+        return text
+
+
+class TodoRootSection(TodoSection):
+    __slots__ = ("nodes", "version", "changed_lines", "structure_changed")
+
+    def __init__(self):
+        # Only the nodes which have been given an ID
+        self.nodes: Dict[int, TodoContainer] = {}
+        self.version: int = 0
+        super().__init__("root", 0, None)
+        self.changed_lines: List[TodoContainer] = []
+        self.structure_changed: bool = False
 
 
 class TodoItem(TodoContainer):
+    __slots__ = ("_status", "name", "depth", "parent_item", "_sub_items")
 
     def __init__(
             self,
@@ -178,18 +543,46 @@ class TodoItem(TodoContainer):
             name: str,
             depth: int,
             parent_section: TodoSection,
-            parent_item: Optional['TodoItem']
+            parent_item: Optional['TodoItem'],
+            source_span: Optional[SourceSpan] = None
     ):
-        super().__init__(parent_section)
-        self.status: 'TodoStatus' = status
+        super().__init__(parent_section, source_span)
+        self._status: 'TodoStatus' = status
         self.name: str = name
         self.depth: int = depth
         self.parent_item: Optional['TodoItem'] = parent_item
-        self.sub_items: List['TodoItem'] = []
+        self._sub_items: Optional[List['TodoItem']] = None
         if parent_item:
-            parent_item.sub_items.append(self)
+            parent_item.add_sub_item(self)
         else:
             parent_section.root_items.append(self)
+        self.attached(self.parent)
+
+    @property
+    def sub_items(self) -> Sequence['TodoItem']:
+        # Most items are leaves, so the child list is only allocated once one is added
+        return self._sub_items if self._sub_items is not None else ()
+
+    def add_sub_item(self, item: 'TodoItem') -> None:
+        if self._sub_items is None:
+            self._sub_items = []
+        self._sub_items.append(item)
+
+    @property
+    def status(self) -> 'TodoStatus':
+        return self._status
+
+    @status.setter
+    def status(self, status: 'TodoStatus') -> None:
+        if status != self._status:
+            old_done, old_inp, old_todo = self.own_progress()
+            self._status = status
+            new_done, new_inp, new_todo = self.own_progress()
+            self.parent.progress_changed(new_done - old_done, new_inp - old_inp, new_todo - old_todo)
+            self.line_changed()
+
+    def own_progress(self) -> 'Progress':
+        return STATUS_PROGRESS[self._status]
 
     @property
     def parent(self) -> TodoContainer:
@@ -200,20 +593,52 @@ class TodoItem(TodoContainer):
     def is_empty(self) -> bool:
         return not self.sub_items
 
+    def children(self) -> Iterator[TodoContainer]:
+        yield from self.sub_items
+
     def remove(self) -> None:
+        root = self.root
         if self.parent_item:
-            self.parent_item.sub_items.remove(self)
+            self.parent_item._sub_items.remove(self)
         else:
             self.parent_section.root_items.remove(self)
+        self.detached(self.parent, root)
+
+    def line_text(self) -> str:
+        return self.status.value + ("- " * self.depth)[:self.depth] + self.name
+
+    def render_lines(self) -> Iterator[Tuple[Optional[TodoContainer], str]]:
+        yield self, self.line_text()
+        for item in self.sub_items:
+            yield from item.render_lines()
+
+    def walk(self) -> Iterator[TodoContainer]:
+        yield self
+        for item in self.sub_items:
+            yield from item.walk()
 
     def to_text(self, max_depth: Optional[int] = None) -> str:
-        lines = [self.status.value + ("- " * self.depth)[:self.depth] + self.name]
+        if max_depth is None and self._text is not None:
+            return self._text
+        lines = [self.line_text()]
         if not max_depth or (self.parent_item.depth + self.depth) < max_depth:
             lines += [item.to_text(max_depth) for item in self.sub_items]
-        return "\n".join(lines)
+        text = "\n".join(lines)
+        if max_depth is None:
+            self._text = text
+        return text
 
 
 class TodoStatus(Enum):
     COMPLETE = "DONE"
     IN_PROGRESS = "INP"
     TODO = ""
+
+
+# Counts of done, in progress, and to do items
+Progress = Tuple[int, int, int]
+STATUS_PROGRESS: Dict[TodoStatus, Progress] = {
+    TodoStatus.COMPLETE: (1, 0, 0),
+    TodoStatus.IN_PROGRESS: (0, 1, 0),
+    TodoStatus.TODO: (0, 0, 1),
+}
@@ -1,18 +1,27 @@
+import html
 import os
-from os import listdir
-from os.path import isfile, join, isdir
-from typing import Dict, Optional, List
+from os.path import join
+from typing import Dict, Optional, List, Hashable, Tuple
 
 from prometheus_client import Counter
 from telethon import Button
+from telethon.tl.types import KeyboardButtonCallback
 
+from todo_list_bot.directory_index import directory_index, DirectoryListing, DIRECTORY_INITIAL
+from todo_list_bot.document_cache import document_cache
+from todo_list_bot.file_io import file_io
+from todo_list_bot.journal import journal
+from todo_list_bot.render_cache import render_cache
 from todo_list_bot.response import Response
-from todo_list_bot.todo_list import TodoList, TodoSection, TodoItem, TodoStatus, TodoContainer, line_is_item, \
-    line_is_section, line_is_empty
+from todo_list_bot.search_index import SearchResult
+from todo_list_bot.operations import TodoOperation, OperationError, SetStatus, RemoveNode, AppendLines, ReplaceNode, \
+    SetSubtreeStatus, ClearCompleted, InsertSubtree, MoveNode, snapshot_node, operation_from_json, resolve_node
+from todo_list_bot.todo_list import TodoList, TodoSection, TodoItem, TodoStatus, TodoContainer, TodoListConflict
 
 errors = Counter("todolistbot_viewer_errors_total", "Number of errors in the todo viewer")
 file_selected = Counter("todolistbot_cmd_file_total", "Number of times a file has been opened")
 file_list = Counter("todolistbot_cmd_file_list_total", "Number of times a user has listed the files")
+listing_page = Counter("todolistbot_cmd_list_page_total", "Number of times a user has moved to another page of files")
 folder_selected = Counter("todolistbot_cmd_folder_total", "Number of times a user has selected a folder")
 up_folder = Counter("todolistbot_cmd_folder_up_total", "Number of times user has requested to go up a directors")
 section_selected = Counter("todolistbot_cmd_section_total", "Number of times user has selected a section")
@@ -27,101 +36,260 @@ cancel_replace = Counter("todolist_cmd_replace_total", "Number of times a replac
 create_file = Counter("todolistbot_create_file_total", "Number of files created")
 create_section = Counter("todolistbot_create_section_total", "Number of sections created")
 create_item = Counter("todolistbot_create_item_total", "Number of items created")
+search_selected = Counter("todolistbot_cmd_search_total", "Number of times a user has opened a search result")
+bulk_menu = Counter("todolistbot_cmd_bulk_total", "Number of times a user has opened the bulk actions menu")
+bulk_status = Counter(
+    "todolistbot_cmd_bulk_status_total",
+    "Number of times a user has set the status of every item in a section or item",
+    ["status"]
+)
+clear_done = Counter("todolistbot_cmd_clear_done_total", "Number of times a user has cleared completed items")
+copy_node = Counter("todolistbot_cmd_copy_total", "Number of times a user has copied a section or item", ["cut"])
+paste_node = Counter("todolistbot_cmd_paste_total", "Number of times a user has pasted a section or item", ["cut"])
+undo_applied = Counter("todolistbot_cmd_undo_total", "Number of todo list changes which have been undone")
+viewers_hydrated = Counter(
+    "todolistbot_viewer_hydrated_total",
+    "Number of times a restored viewer has loaded its todo list on first access"
+)
+
+
+BULK_STATUSES = {
+    b"all_done": TodoStatus.COMPLETE,
+    b"all_inp": TodoStatus.IN_PROGRESS,
+    b"all_todo": TodoStatus.TODO,
+}
+LETTERS_PER_ROW = 8
+# Past this many initials, neighbouring ones share a button, keeping the keyboard within Telegram's button limit
+MAX_LETTER_BUTTONS = 4 * LETTERS_PER_ROW
+BULK_COMMANDS = [b"view", b"bulk", *BULK_STATUSES.keys(), b"clear_done", b"copy", b"cut", b"paste", b"cancel_paste"]
+
+
+def listing_page_size(show_up: bool) -> int:
+    # Pages of files fill a response page, including the up button
+    return Response.per_page - 1 if show_up else Response.per_page
+
+
+def listing_pages(listing: DirectoryListing, per_page: int) -> int:
+    return max(1, (len(listing) + per_page - 1) // per_page)
+
+
+def letter_buttons(initials: List[Tuple[str, int]], per_page: int) -> List[KeyboardButtonCallback]:
+    # Each button jumps to the page holding the first entry of its initials
+    size = 1
+    if len(initials) > MAX_LETTER_BUTTONS:
+        # Folders and files are grouped apart, which can add a group, so one fewer is allowed for
+        size = (len(initials) + MAX_LETTER_BUTTONS - 2) // (MAX_LETTER_BUTTONS - 1)
+    groups = []
+    for is_folder in [True, False]:
+        entries = [entry for entry in initials if entry[0].startswith(DIRECTORY_INITIAL) == is_folder]
+        groups += [entries[n:n + size] for n in range(0, len(entries), size)]
+    buttons = []
+    for group in groups:
+        (first, index), (last, _) = group[0], group[-1]
+        label = first if first == last else f"{first}–{last.replace(DIRECTORY_INITIAL, '')}"
+        buttons.append(Button.inline(label, f"list_page:{index // per_page + 1}"))
+    return buttons
+
+
+def progress_label(node: TodoContainer) -> str:
+    done, inp, todo = node.progress
+    if not done + inp + todo:
+        return ""
+    return f" ✔️{done} ⏳{inp} ❌{todo}"
 
 
 class TodoViewer:
 
-    def __init__(self, chat_id: int):
+    def __init__(self, chat_id: int, base_directory: str = "store/"):
         self.chat_id = chat_id
-        self.base_directory = "store/"
-        self.current_directory = self.base_directory
-        self.current_todo: Optional[TodoList] = None
-        self.current_todo_path: Optional[List[str]] = None
+        self.base_directory = base_directory
+        self.listing_page = 1
+        self._current_directory = self.base_directory
+        self.current_todo_file: Optional[str] = None
+        self._current_todo: Optional[TodoList] = None
+        self._current_todo_path: Optional[List[str]] = None
+        self._current_node_id: Optional[int] = None
         self.replacing: bool = False
         self._dir_list = None
         self._file_list = None
+        self._search_results: Optional[List[List]] = None
+        self.clipboard: Optional[Dict] = None
+
+    @property
+    def current_directory(self) -> str:
+        return self._current_directory
+
+    @current_directory.setter
+    def current_directory(self, directory: str) -> None:
+        # Never browse outside the storage directory, such as from a record saved with another one
+        self._current_directory = directory if self.in_base_directory(directory) else self.base_directory
+        self.listing_page = 1
+
+    def in_base_directory(self, path: str) -> bool:
+        base = os.path.abspath(self.base_directory)
+        return os.path.commonpath([base, os.path.abspath(path)]) == base
+
+    @property
+    def current_todo(self) -> Optional[TodoList]:
+        return self._current_todo
+
+    @current_todo.setter
+    def current_todo(self, todo: Optional[TodoList]) -> None:
+        self._current_todo = todo
+        self.current_todo_file = todo.path if todo is not None else None
+
+    @property
+    def current_todo_path(self) -> Optional[List[str]]:
+        return self._current_todo_path
+
+    @current_todo_path.setter
+    def current_todo_path(self, path: Optional[List[str]]) -> None:
+        self._current_todo_path = path
+        self._current_node_id = None
+
+    def select_node(self, node: TodoContainer, path: List[str]) -> None:
+        self._current_todo_path = path
+        self._current_node_id = node.node_id
+
+    def release_todo(self) -> None:
+        # Keeps the file and path, so the todo list is parsed again on next use
+        self._current_todo = None
+
+    async def refresh_todo(self) -> None:
+        if self.current_todo_file is None:
+            return
+        if self._current_todo is None:
+            viewers_hydrated.inc()
+        try:
+            self._current_todo = await file_io.run(document_cache.get, self.current_todo_file)
+        except FileNotFoundError:
+            self.current_todo = None
+            self.current_todo_path = []
+
+    async def commit(
+            self,
+            operation: TodoOperation,
+            prefix: Optional[str] = None,
+            undoes: Optional[str] = None
+    ) -> Response:
+        try:
+            self.current_todo = await document_cache.commit(self.current_todo_file, operation, undoes=undoes)
+        except OperationError as e:
+            errors.inc()
+            await self.refresh_todo()
+            return Response(str(e))
+        except TodoListConflict:
+            errors.inc()
+            await self.refresh_todo()
+            return Response("The todo list kept changing while saving, please try again.")
+        except FileNotFoundError:
+            errors.inc()
+            await self.refresh_todo()
+            return Response("The todo list has been deleted.")
+        return self.current_todo_list_message(prefix)
 
     def to_json(self) -> Dict:
         return {
             "chat_id": self.chat_id,
             "directory": self.base_directory,
             "current_directory": self.current_directory,
-            "current_todo": self.current_todo.to_json() if self.current_todo is not None else None,
+            "listing_page": self.listing_page,
+            "current_todo": {"path": self.current_todo_file} if self.current_todo_file is not None else None,
             "current_todo_path": self.current_todo_path,
             "replacing": self.replacing,
             "_dir_list": self._dir_list,
-            "_file_list": self._file_list
+            "_file_list": self._file_list,
+            "_search_results": self._search_results,
+            "clipboard": self.clipboard
         }
 
     @classmethod
-    def from_json(cls, json_data) -> 'TodoViewer':
-        viewer = TodoViewer(json_data["chat_id"])
-        viewer.directory = json_data["directory"]
+    def from_json(cls, json_data, base_directory: str = "store/") -> 'TodoViewer':
+        viewer = TodoViewer(json_data["chat_id"], base_directory)
         viewer.current_directory = json_data.get("current_directory", json_data["directory"])
+        viewer.listing_page = json_data.get("listing_page", 1)
         if json_data["current_todo"]:
-            viewer.current_todo = TodoList.from_json(json_data["current_todo"])
+            viewer.current_todo_file = json_data["current_todo"]["path"]
         viewer.current_todo_path = json_data.get("current_todo_path")
         viewer.replacing = json_data.get("replacing", False)
         viewer._dir_list = json_data.get("_dir_list")
         viewer._file_list = json_data["_file_list"]
+        viewer._search_results = json_data.get("_search_results")
+        viewer.clipboard = json_data.get("clipboard")
         return viewer
 
-    def list_directories(self) -> List[str]:
-        directories = sorted([f for f in listdir(self.current_directory) if isdir(join(self.current_directory, f))])
-        self._dir_list = directories
-        return directories
+    def show_up(self) -> bool:
+        return os.path.abspath(self.current_directory) != os.path.abspath(self.base_directory)
 
-    def list_files(self) -> List[str]:
-        files = sorted([f for f in listdir(self.current_directory) if isfile(join(self.current_directory, f))])
-        self._file_list = files
-        return files
+    async def list_directory(self) -> DirectoryListing:
+        # Only the current page of the listing is kept, and the folder and file buttons number entries within it
+        listing = await file_io.run(directory_index.get, self.current_directory)
+        per_page = listing_page_size(self.show_up())
+        self.listing_page = min(max(self.listing_page, 1), listing_pages(listing, per_page))
+        start = (self.listing_page - 1) * per_page
+        self._dir_list, self._file_list = listing.page(start, start + per_page)
+        return listing
 
-    def handle_callback(self, callback_data: bytes) -> Response:
+    async def handle_callback(self, callback_data: bytes) -> Response:
+        await self.refresh_todo()
         cmd, *args = callback_data.split(b":", 1)
         args = args[0] if args else None
         if cmd == b"file":
             file_selected.inc()
             file_num = int(args.decode())
+            if not self._file_list or file_num >= len(self._file_list):
+                errors.inc()
+                return Response("That list of files is out of date, please list them again.")
             filename = self._file_list[file_num]
-            self.current_todo = TodoList(join(self.current_directory, filename))
+            self.current_todo = await file_io.run(document_cache.get, join(self.current_directory, filename))
             self.current_todo_path = []
-            self.current_todo.parse()
             return self.current_todo_list_message()
         if cmd == b"list":
             file_list.inc()
             self.current_todo = None
             self.current_todo_path = []
-            return self.list_files_message()
+            return await self.list_files_message()
+        if cmd == b"list_page":
+            listing_page.inc()
+            self.current_todo = None
+            self.current_todo_path = []
+            self.listing_page = int(args.decode())
+            return await self.list_files_message()
         if cmd == b"folder":
             folder_selected.inc()
             self.current_todo = None
             self.current_todo_path = []
             folder_num = int(args.decode())
+            if not self._dir_list or folder_num >= len(self._dir_list):
+                errors.inc()
+                return Response("That list of files is out of date, please list them again.")
             dir_split = self.current_directory.strip("/").split("/")
             self.current_directory = "/".join(dir_split + [self._dir_list[folder_num]])
-            return self.list_files_message()
+            return await self.list_files_message()
         if cmd == b"up_folder":
             up_folder.inc()
             self.current_todo = None
             self.current_todo_path = []
-            if self.current_directory.strip("/") == self.base_directory.strip("/"):
+            if not self.show_up():
                 errors.inc()
                 return Response("Can't go up from base directory")
             dir_split = self.current_directory.strip("/").split("/")
             self.current_directory = "/".join(dir_split[:len(dir_split)-1])
-            return self.list_files_message()
+            return await self.list_files_message()
         if cmd == b"section":
             section_selected.inc()
             if self.current_todo is None:
                 errors.inc()
                 return Response("No todo list is selected.")
             section = self.current_section()
-            if isinstance(section, TodoSection):
-                new_section = section.sub_sections[int(args.decode())]
-            else:
+            if not isinstance(section, TodoSection):
                 errors.inc()
                 return Response("Invalid section")
-            self.current_todo_path.append(new_section.title)
+            new_section = self.current_todo.node(int(args.decode()))
+            if not isinstance(new_section, TodoSection) or new_section.parent is not section:
+                errors.inc()
+                return self.current_todo_list_message("That section has changed, please choose again.")
+            self.select_node(new_section, self.current_todo_path + [new_section.title])
             return self.current_todo_list_message()
         if cmd == b"item":
             item_selected.inc()
@@ -129,21 +297,23 @@ class TodoViewer:
                 errors.inc()
                 return Response("No todo list is selected.")
             section = self.current_section()
-            if isinstance(section, TodoSection):
-                new_section = section.root_items[int(args.decode())]
-            elif isinstance(section, TodoItem):
-                new_section = section.sub_items[int(args.decode())]
-            else:
+            if section is None:
                 errors.inc()
                 return Response("Invalid item")
-            self.current_todo_path.append(new_section.name)
+            new_section = self.current_todo.node(int(args.decode()))
+            if not isinstance(new_section, TodoItem) or new_section.parent is not section:
+                errors.inc()
+                return self.current_todo_list_message("That item has changed, please choose again.")
+            self.select_node(new_section, self.current_todo_path + [new_section.name])
             return self.current_todo_list_message()
         if cmd == b"up":
             nav_up.inc()
             if self.current_todo is None:
                 errors.inc()
                 return Response("No todo list is selected.")
-            self.current_todo_path = self.current_todo_path[:len(self.current_todo_path)-1]
+            parent = self.current_section().parent
+            if parent is not None:
+                self.select_node(parent, self.current_todo_path[:len(self.current_todo_path)-1])
             return self.current_todo_list_message()
         if cmd == b"item_done":
             item_done.inc()
@@ -151,41 +321,59 @@ class TodoViewer:
             if not isinstance(item, TodoItem):
                 errors.inc()
                 return Response("Item not currently selected.")
-            item.status = TodoStatus.COMPLETE
-            self.current_todo.save()
-            return self.current_todo_list_message()
+            return await self.commit(SetStatus(self.current_todo_path, TodoStatus.COMPLETE, item.node_id))
         if cmd == b"item_inp":
             item_inp.inc()
             item = self.current_section()
             if not isinstance(item, TodoItem):
                 errors.inc()
                 return Response("Item not currently selected.")
-            item.status = TodoStatus.IN_PROGRESS
-            self.current_todo.save()
-            return self.current_todo_list_message()
+            return await self.commit(SetStatus(self.current_todo_path, TodoStatus.IN_PROGRESS, item.node_id))
         if cmd == b"item_todo":
             item_todo.inc()
             item = self.current_section()
             if not isinstance(item, TodoItem):
                 errors.inc()
                 return Response("Item not currently selected.")
-            item.status = TodoStatus.TODO
-            self.current_todo.save()
-            return self.current_todo_list_message()
+            return await self.commit(SetStatus(self.current_todo_path, TodoStatus.TODO, item.node_id))
         if cmd == b"delete":
             delete.inc()
             section = self.current_section()
             if section is None:
                 errors.inc()
                 return Response("Unknown section.")
-            if section == self.current_todo.root_section and section.is_empty():
-                os.remove(self.current_todo.path)
+            if section == self.current_todo.root_section:
+                if not section.is_empty():
+                    # Such as from a stale button, after another chat has added to the list
+                    errors.inc()
+                    return self.current_todo_list_message("Only an empty todo list can be deleted.")
+                await file_io.run_ordered(self.current_todo.path, self.delete_file, self.current_todo.path)
                 self.current_todo = None
                 self.current_todo_path = []
-                return self.list_files_message()
-            section.remove()
-            self.current_todo_path = self.current_todo_path[:len(self.current_todo_path)-1]
-            self.current_todo.save()
+                return await self.list_files_message()
+            operation = RemoveNode(self.current_todo_path, section.node_id)
+            self.select_node(section.parent, self.current_todo_path[:len(self.current_todo_path)-1])
+            return await self.commit(operation)
+        if cmd == b"search":
+            search_selected.inc()
+            if not self._search_results:
+                errors.inc()
+                return Response("There are no search results to open.")
+            # Buttons from before a restart or an older search may not match the current results
+            if args is None or not args.isdigit() or int(args) >= len(self._search_results):
+                errors.inc()
+                return Response("Those search results have expired, please search again.")
+            path, node_path = self._search_results[int(args)]
+            if not self.in_base_directory(path):
+                errors.inc()
+                return Response("Those search results have expired, please search again.")
+            try:
+                self.current_todo = await file_io.run(document_cache.get, path)
+            except FileNotFoundError:
+                errors.inc()
+                return Response("That todo list no longer exists.")
+            self.current_directory = os.path.dirname(path)
+            self.current_todo_path = list(node_path)
             return self.current_todo_list_message()
         if cmd == b"replace":
             replace.inc()
@@ -195,120 +383,193 @@ class TodoViewer:
             cancel_replace.inc()
             self.replacing = False
             return self.current_todo_list_message("Replacement cancelled.")
+        section = self.current_section() if cmd in BULK_COMMANDS else None
+        if cmd in BULK_COMMANDS and section is None:
+            errors.inc()
+            return Response("No todo list section selected.")
+        if cmd == b"view":
+            return self.current_todo_list_message()
+        if cmd == b"bulk":
+            bulk_menu.inc()
+            return self.bulk_message()
+        if cmd in BULK_STATUSES:
+            status = BULK_STATUSES[cmd]
+            bulk_status.labels(status=status.name.lower()).inc()
+            return await self.commit(
+                SetSubtreeStatus(self.current_todo_path, status, section.node_id), "Updated every item."
+            )
+        if cmd == b"clear_done":
+            clear_done.inc()
+            return await self.commit(
+                ClearCompleted(self.current_todo_path, section.node_id), "Cleared completed items."
+            )
+        if cmd in [b"copy", b"cut"]:
+            cut = cmd == b"cut"
+            copy_node.labels(cut=str(cut).lower()).inc()
+            self.clipboard = {
+                "path": self.current_todo_file,
+                "node_path": list(self.current_todo_path),
+                "node_id": section.node_id,
+                "cut": cut
+            }
+            return self.current_todo_list_message(
+                f"{'Cut' if cut else 'Copied'}. Choose a section or item, and press paste to put it there."
+            )
+        if cmd == b"paste":
+            return await self.paste()
+        if cmd == b"cancel_paste":
+            self.clipboard = None
+            return self.current_todo_list_message("Paste cancelled.")
         errors.inc()
         return Response("I do not understand that button.")
 
-    def append_todo(self, entry_text: str) -> Response:
+    async def paste(self) -> Response:
+        clipboard = self.clipboard
+        if clipboard is None:
+            errors.inc()
+            return Response("Nothing has been copied.")
+        paste_node.labels(cut=str(clipboard["cut"]).lower()).inc()
+        try:
+            source_todo = await file_io.run(document_cache.get, clipboard["path"])
+        except FileNotFoundError:
+            source_todo = None
+        node_id = clipboard.get("node_id")
+        source = resolve_node(source_todo, clipboard["node_path"], node_id) if source_todo is not None else None
+        if source is None:
+            errors.inc()
+            self.clipboard = None
+            return Response("The copied todo list entry no longer exists.")
+        section = self.current_section()
+        same_file = os.path.abspath(clipboard["path"]) == os.path.abspath(self.current_todo_file)
+        if clipboard["cut"] and same_file:
+            operation = MoveNode(clipboard["node_path"], self.current_todo_path, source.node_id, section.node_id)
+        else:
+            operation = InsertSubtree(self.current_todo_path, snapshot_node(source), section.node_id)
+        try:
+            self.current_todo = await document_cache.commit(self.current_todo_file, operation)
+        except OperationError as e:
+            errors.inc()
+            await self.refresh_todo()
+            return Response(str(e))
+        if clipboard["cut"]:
+            self.clipboard = None
+            if not same_file:
+                # Only remove the original once the copy is saved, so a failure can't lose it
+                try:
+                    await document_cache.commit(clipboard["path"], RemoveNode(clipboard["node_path"], source.node_id))
+                except (OperationError, FileNotFoundError):
+                    errors.inc()
+        return self.current_todo_list_message("Moved here." if clipboard["cut"] else "Pasted here.")
+
+    async def undo(self) -> Response:
+        await self.refresh_todo()
+        if self.current_todo is None:
+            return Response("No todo list is selected.")
+        if not journal.enabled:
+            return Response("Undo is not enabled.")
+        # Undo is per todo list, so this undoes the latest change from any chat
+        record = await file_io.run(journal.last_undoable, self.current_todo_file)
+        if record is None:
+            return Response("Nothing to undo.")
+        undo_applied.inc()
+        return await self.commit(operation_from_json(record["undo"]), "Undid the last change.", record["id"])
+
+    def bulk_message(self) -> Response:
+        section = self.current_section()
+        buttons = [
+            Button.inline("🔙 Back", "view"),
+            Button.inline("✔️ Mark all done", "all_done"),
+            Button.inline("⏳ Mark all in progress", "all_inp"),
+            Button.inline("❌ Mark all not done", "all_todo"),
+            Button.inline("🧹 Clear completed", "clear_done"),
+            Button.inline("📋 Copy", "copy"),
+        ]
+        if section.parent is not None:
+            buttons += [Button.inline("✂️ Cut", "cut")]
+        if section.parent is None:
+            text = "Bulk actions for the whole todo list."
+        else:
+            text = f"Bulk actions for <code>{html.escape(section.name)}</code> and everything under it."
+        return Response(text, buttons)
+
+    async def append_todo(self, entry_text: str) -> Response:
+        await self.refresh_todo()
         if self.current_todo is None:
             create_file.inc()
             full_path = join(self.current_directory, entry_text)
-            with open(full_path, "w") as f:
-                f.write("")
-            self.current_todo = TodoList(full_path)
+            if not self.in_base_directory(full_path):
+                errors.inc()
+                return Response("Todo lists can only be created in the storage directory.")
+            await file_io.run_ordered(full_path, self.create_file, full_path)
+            self.current_todo = await file_io.run(document_cache.get, full_path)
             self.current_todo_path = []
-            self.current_todo.parse()
             return self.current_todo_list_message("Created new todo list")
         section = self.current_section()
         if section is None:
             errors.inc()
             return Response("No todo list section selected.")
-        # If replacing, then remove the current section and set current to parent
+        todo_contents = entry_text.split("\n")
+        # If replacing, then remove the current section and add to its parent
         if self.replacing:
             self.replacing = False
-            del_section = section
+            operation = ReplaceNode(self.current_todo_path, todo_contents, section.node_id)
+            if section.parent is not None:
+                self.select_node(section.parent, self.current_todo_path[:len(self.current_todo_path)-1])
+            else:
+                self.current_todo_path = []
             section = section.parent
-            del_section.remove()
-            if section is None:
-                section = TodoSection("root", 0, None)
-                self.current_todo.root_section = section
-        # Prepare for adding
-        todo_contents = [l for l in entry_text.split("\n") if not line_is_empty(l)]
-        # Ensure items are minimally indented
-        items = [line for line in todo_contents if line_is_item(line)]
-        if items:
-            min_item_depth = min(len(line) - len(line.lstrip("- ")) for line in items)
-            if min_item_depth < 2:
-                add_depth = 2 - min_item_depth
-                for n in range(len(todo_contents)):
-                    if line_is_item(todo_contents[n]):
-                        todo_contents[n] = "-" * add_depth + todo_contents[n]
-        # Add to a section
-        if isinstance(section, TodoSection):
-            # Ensure subsections are minimally indented
-            base_depth = section.depth
-            sections = [line for line in todo_contents if line_is_section(line)]
-            if sections:
-                lowest_section = min(len(line) - len(line.lstrip("#")) for line in sections)
-                if lowest_section <= base_depth:
-                    for n in range(len(todo_contents)):
-                        if line_is_section(todo_contents[n]):
-                            todo_contents[n] = "#" * base_depth + todo_contents[n]
-            self.current_todo.parse_lines(todo_contents, section)
-            self.current_todo.save()
-            return self.current_todo_list_message("Added to todo list section")
-        # Append sub items to an item
+        else:
+            operation = AppendLines(self.current_todo_path, todo_contents, section.node_id)
         if isinstance(section, TodoItem):
-            if any(l for l in todo_contents if line_is_section(l)):
-                return Response("Cannot add sections under an item")
-            # Ensure sub items are minimally indented
-            base_depth = section.depth
-            min_depth = min(len(line) - len(line.lstrip(" -")) for line in todo_contents)
-            add_depth = base_depth - min_depth + 2
-            for n in range(len(todo_contents)):
-                if add_depth > 0:
-                    todo_contents[n] = "-" * add_depth + todo_contents[n]
-                elif add_depth < 0:
-                    todo_contents[n] = todo_contents[n][-add_depth:]
-            current_item = section
-            parent_section = section.parent_section
-            for line in todo_contents:
-                current_item = self.current_todo.parse_item(line, parent_section, current_item)
-            self.current_todo.save()
-            return self.current_todo_list_message("Added to sub-items to todo list item")
-        errors.inc()
-        return Response("What")
+            return await self.commit(operation, "Added to sub-items to todo list item")
+        return await self.commit(operation, "Added to todo list section")
+
+    # noinspection PyMethodMayBeStatic
+    def create_file(self, full_path: str) -> None:
+        with directory_index.adding(full_path):
+            with open(full_path, "w") as f:
+                f.write("")
+
+    # noinspection PyMethodMayBeStatic
+    def delete_file(self, full_path: str) -> None:
+        with directory_index.removing(full_path):
+            os.remove(full_path)
+        document_cache.deleted(full_path)
 
     def current_section(self) -> Optional[TodoContainer]:
         if self.current_todo is None:
             return None
+        current_section = self.current_todo.node(self._current_node_id)
+        if current_section is not None:
+            return current_section
+        # The node ID is unknown after a restart or re-parse, so resolve the path by name instead
         current_section = self.current_todo.root_section
         found_path = []
         for path_part in self.current_todo_path:
-            found = self.find_in_section(current_section, path_part)
+            found = current_section.find_child(path_part)
             if not found:
-                self.current_todo_path = found_path
-                return current_section
-            else:
-                found_path.append(path_part)
-                current_section = found
+                break
+            found_path.append(path_part)
+            current_section = found
+        self.select_node(current_section, found_path)
         return current_section
 
-    # noinspection PyMethodMayBeStatic
-    def find_in_section(
-            self,
-            current_section: TodoContainer,
-            path_part: str
-    ) -> Optional[TodoContainer]:
-        if isinstance(current_section, TodoSection):
-            for sub_section in current_section.sub_sections:
-                if sub_section.title == path_part:
-                    return sub_section
-            for item in current_section.root_items:
-                if item.name == path_part:
-                    return item
-        if isinstance(current_section, TodoItem):
-            for item in current_section.sub_items:
-                if item.name == path_part:
-                    return item
-        return None
-
-    def current_message(self) -> Response:
+    async def current_message(self) -> Response:
+        await self.refresh_todo()
         if self.current_todo is None:
-            return self.list_files_message()
+            return await self.list_files_message()
         return self.current_todo_list_message()
 
     def current_todo_list_message(self, prefix: Optional[str] = None) -> Response:
         section = self.current_section()
+        root = self.current_todo.root_section
+        key = (root.node_id, root.version, section.node_id, self.replacing, self.clipboard is not None)
+        response = render_cache.get("todo", key) or self.render_todo_list(key, section)
+        if prefix:
+            response.prefix(prefix + "\n-----\n")
+        return response
+
+    def render_todo_list(self, key: Hashable, section: TodoContainer) -> Response:
         buttons = []
         if section == self.current_todo.root_section:
             buttons += [Button.inline("🔙 Back to listing", "list")]
@@ -321,12 +582,15 @@ class TodoViewer:
                 Button.inline("🗑 Delete", "delete")
             ]
         buttons += [Button.inline("✏️ Edit/Replace", "replace")]
+        if self.clipboard is not None:
+            buttons += [Button.inline("📥 Paste here", "paste"), Button.inline("🚫 Cancel paste", "cancel_paste")]
+        buttons += [Button.inline("⚙️ Bulk actions", "bulk")]
         if isinstance(section, TodoSection):
             buttons += [
-                Button.inline(item.name, f"item:{n}") for n, item in enumerate(section.root_items)
+                Button.inline(item.name + progress_label(item), f"item:{item.node_id}") for item in section.root_items
             ]
             buttons += [
-                Button.inline(f"📂 {s.title}", f"section:{n}") for n, s in enumerate(section.sub_sections)
+                Button.inline(f"📂 {s.title}{progress_label(s)}", f"section:{s.node_id}") for s in section.sub_sections
             ]
         if isinstance(section, TodoItem):
             if section.status != TodoStatus.COMPLETE:
@@ -336,32 +600,67 @@ class TodoViewer:
             if section.status != TodoStatus.TODO:
                 buttons += [Button.inline("❌ Not done", "item_todo")]
             buttons += [
-                Button.inline(item.name, f"item:{n}") for n, item in enumerate(section.sub_items)
+                Button.inline(item.name + progress_label(item), f"item:{item.node_id}") for item in section.sub_items
             ]
         if self.replacing:
             buttons = [Button.inline("❌ Cancel edit", "cancel_replace")]
         text = f"Opened todo list: <code>{self.current_todo.path}</code>.\n"
+        done, inp, todo = section.progress
+        if done + inp + todo:
+            text += f"Progress: {done} done, {inp} in progress, {todo} to do.\n"
         text += f"<pre>{self.current_todo.to_text(section)}</pre>"
-        if prefix:
-            text = prefix + "\n-----\n" + text
-        return Response(
-            text,
-            buttons=buttons
+        return render_cache.add("todo", key, text, buttons)
+
+    def search_message(self, query: str, results: List[SearchResult]) -> Response:
+        self._search_results = [[result.path, list(result.node_path)] for result in results]
+        if not results:
+            return Response(f"No todo list entries found for <code>{html.escape(query)}</code>.")
+        text = f"Search results for <code>{html.escape(query)}</code>:\n"
+        text += "\n".join(
+            f"- <code>{html.escape(result.path)}</code>: {html.escape(' > '.join(result.node_path))}"
+            for result in results
         )
+        buttons = [Button.inline(f"🔍 {result.text}", f"search:{n}") for n, result in enumerate(results)]
+        return Response(text, buttons)
+
+    async def list_files_message(self) -> Response:
+        listing = await self.list_directory()
+        show_up = self.show_up()
+        key = (listing.path, listing.mtime_ns, listing.version, show_up, self.listing_page)
+        return render_cache.get("listing", key) or self.render_listing(key, listing, show_up, self.listing_page)
 
-    def list_files_message(self) -> Response:
-        directories = self.list_directories()
-        files = self.list_files()
+    # noinspection PyMethodMayBeStatic
+    def render_listing(self, key: Hashable, listing: DirectoryListing, show_up: bool, page: int) -> Response:
+        per_page = listing_page_size(show_up)
+        pages = listing_pages(listing, per_page)
+        start = (page - 1) * per_page
+        directories, files = listing.page(start, start + per_page)
         buttons = []
         text = "You have not selected a todo list. Please choose one:\n"
-        if self.current_directory.strip("/").count("/") > self.base_directory.strip("/").count("/"):
+        if pages > 1:
+            text += f"Page {page} of {pages}, with {len(listing)} entries.\n"
+        if show_up:
             buttons += [Button.inline("🔼 Up directory", "up_folder")]
         buttons += [Button.inline(f"📂 {directory}", f"folder:{n}") for n, directory in enumerate(directories)]
         entries = [f"📂 <code>{directory}</code>" for directory in directories]
         buttons += [Button.inline(file, f"file:{n}") for n, file in enumerate(files)]
         entries += [f"- <code>{file}</code>" for file in files]
         text += "\n".join(entries)
-        return Response(
-            text,
-            buttons
-        )
+        footer = None
+        if pages > 1:
+            footer = [[
+                Button.inline("< Prev" if page > 1 else " ", f"list_page:{max(page - 1, 1)}"),
+                Button.inline(f"{page}/{pages}", f"list_page:{page}"),
+                Button.inline("> Next" if page < pages else " ", f"list_page:{min(page + 1, pages)}")
+            ]]
+            # Jump to the page holding the first entry starting with each letter, and for folders only if they fill a page
+            show_folders = len(listing.directories) > per_page
+            letters = letter_buttons(
+                [
+                    (initial, index) for initial, index in listing.initials.items()
+                    if show_folders or not initial.startswith(DIRECTORY_INITIAL)
+                ],
+                per_page
+            )
+            footer += [letters[n:n + LETTERS_PER_ROW] for n in range(0, len(letters), LETTERS_PER_ROW)]
+        return render_cache.add("listing", key, text, buttons, footer)